@@ -12,6 +12,16 @@ def add_build_args(ap):
     ap.add_argument('-k', metavar='KEEP_BUILD', default="error", type=str,
             help='keep build directory: always, never, error (default: error)')
     ap.add_argument('--debug', action='store_true', help='enter interactive debug mode')
+    ap.add_argument('--build-jobs', metavar='N', default=1, type=int,
+                    help='number of packages to build concurrently, sharing the -j '
+                    'cores (default: 1)')
+    ap.add_argument('--keep-going', action='store_true',
+                    help='after a failed build, still build what does not depend on it')
+    add_fetch_args(ap)
+
+def add_fetch_args(ap):
+    ap.add_argument('--fetch-jobs', metavar='N', default=8, type=int,
+                    help='number of sources to download concurrently (default: 8)')
 
 def add_profile_args(ap):
     ap.add_argument('profile', nargs='?', default='default.yaml', help='yaml file describing profile to build (default: default.yaml)')
@@ -39,21 +49,23 @@ class ProfileFrontendBase(object):
     def run(cls, ctx, args):
         self = cls(ctx, args)
         try:
-            self.profile_builder_action()
+            return self.profile_builder_action()
         finally:
             self.checkouts.close()
 
     def build_profile_deps(self):
+        self.builder.prefetch_sources(self.args.fetch_jobs)
         ready = self.builder.get_ready_list()
         if len(ready) == 0:
             sys.stdout.write('[Profile dependencies are up to date]\n')
         else:
-            while len(ready) != 0:
-                self.builder.build(ready[0], self.ctx.get_config(),
-                        self.args.j, self.args.k)
-                ready = self.builder.get_ready_list()
+            self.build_all()
             sys.stdout.write('[Profile dependency build successful]\n')
 
+    def build_all(self):
+        self.builder.build_all(self.ctx.get_config(), self.args.j, self.args.build_jobs,
+                               self.args.k, self.args.debug, self.args.keep_going)
+
     def ensure_target(self, target):
         if os.path.exists(target):
             if self.args.force:
@@ -92,21 +104,15 @@ class Build(ProfileFrontendBase):
             self.builder.build(self.args.package, self.ctx.get_config(), self.args.j,
                                self.args.k, self.args.debug)
         else:
+            self.builder.prefetch_sources(self.args.fetch_jobs)
             ready = self.builder.get_ready_list()
             was_done = len(ready) == 0
-            while len(ready) != 0:
-                self.builder.build(ready[0], self.ctx.get_config(), self.args.j,
-                                   self.args.k, self.args.debug)
-                ready = self.builder.get_ready_list()
+            self.build_all()
             artifact_id, artifact_dir = self.builder.build_profile(self.ctx.get_config())
             self.build_store.create_symlink_to_artifact(artifact_id, profile_symlink)
             if was_done:
                 sys.stdout.write('Up to date, link at: %s\n' % profile_symlink)
             else:
-                while len(ready) != 0:
-                    self.builder.build(ready[0], self.ctx.get_config(),
-                            self.args.j, self.args.k)
-                    ready = self.builder.get_ready_list()
                 sys.stdout.write('Profile build successful, link at: %s\n' % profile_symlink)
 
 @register_subcommand
@@ -143,6 +149,28 @@ class Develop(ProfileFrontendBase):
         sys.stdout.write('Development profile build %s successful\n' % target)
 
 
+@register_subcommand
+class FetchSources(ProfileFrontendBase):
+    """
+    Download the sources of all packages in a profile that need to be built.
+
+    Downloads run concurrently (see ``--fetch-jobs``); a summary with size,
+    time and status of each downloaded source is printed at the end. Use
+    ``--all`` to also fetch sources of packages that are already built.
+    """
+    command = 'fetch-sources'
+
+    @classmethod
+    def setup(cls, ap):
+        add_profile_args(ap)
+        add_fetch_args(ap)
+        ap.add_argument('--all', action='store_true', help='include packages that are already built')
+
+    def profile_builder_action(self):
+        results = self.builder.prefetch_sources(self.args.fetch_jobs, self.args.all)
+        if any(not r.ok for r in results):
+            return 1
+
 @register_subcommand
 class Status(ProfileFrontendBase):
     """
@@ -216,11 +244,23 @@ class GC(object):
     Anything not in use of current profiles will be cleaned out. The list
     of current profiles is kept in a directory of symlinks configured
     in %s.
+
+    Artifacts built or used during the last ``--grace-hours``, and builds
+    in progress, are kept, so that garbage collection can run while other
+    builds proceed. Example::
+
+        $ hit gc --dry-run
+
     """ % DEFAULT_CONFIG_FILENAME_REPR
 
     @staticmethod
     def setup(ap):
         ap.add_argument('--list', action='store_true', help='Show list of GC roots')
+        ap.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be removed')
+        ap.add_argument('-j', '--jobs', type=int, help='Number of threads deleting artifacts')
+        ap.add_argument('--grace-hours', type=float, default=1,
+                        help='Keep artifacts built or used this recently (default: 1)')
 
     @staticmethod
     def run(ctx, args):
@@ -233,7 +273,11 @@ class GC(object):
                 sys.stdout.write("%s\n" % os.readlink(pjoin(gc_roots_dir, gc_root)))
         else:
             build_store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
-            build_store.gc()
+            removed = build_store.gc(dry_run=args.dry_run, jobs=args.jobs,
+                                     grace_seconds=args.grace_hours * 3600)
+            nbytes = sum(item[0] for item in removed)
+            ctx.logger.info('%s %d artifacts, %.1f MB' % (
+                'Would remove' if args.dry_run else 'Removed', len(removed), nbytes / 1024.**2))
 
 class MvCpBase(object):
     @classmethod
@@ -1,6 +1,7 @@
 import sys
 import os
 import shutil
+import json
 from os.path import join as pjoin, exists as pexists
 from textwrap import dedent
 
@@ -79,6 +80,57 @@ class ClearSources(object):
         source_cache = SourceCache.create_from_config(ctx.get_config(), ctx.logger)
         source_cache.delete_all()
 
+@register_subcommand
+class GCSources(object):
+    """
+    Removes sources from the source cache, least recently used first.
+
+    Sources used by any artifact reachable from the GC roots (see ``hit
+    gc``) are always kept. Of the rest, those not used for
+    ``--max-age-days`` are removed, and then more until the cache takes
+    at most ``--max-mb``, counting the shared object pool of the git
+    repositories. Objects of the pool that no repository has used for an
+    hour are pruned as well. The defaults are taken from ``gc_max_age_days``
+    and ``gc_max_mb`` of the writable entry in ``source_caches`` in the
+    configuration; without any limits nothing is removed.
+
+    Example::
+
+        $ hit gc-sources --max-mb 20480 --dry-run
+
+    """
+    command = 'gc-sources'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('--max-mb', type=int, help='Size quota for the source cache')
+        ap.add_argument('--max-age-days', type=float,
+                        help='Remove sources not used for this many days')
+        ap.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be removed')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import SourceCache, BuildStore
+        config = ctx.get_config()
+        local = SourceCache.get_local_config(config, ctx.logger)
+        max_mb = args.max_mb if args.max_mb is not None else local.get('gc_max_mb')
+        max_age_days = (args.max_age_days if args.max_age_days is not None
+                        else local.get('gc_max_age_days'))
+        if max_mb is None and max_age_days is None:
+            ctx.logger.error('No quota or age limit given, nothing to do')
+            return 1
+        source_cache = SourceCache.create_from_config(config, ctx.logger)
+        build_store = BuildStore.create_from_config(config, ctx.logger)
+        removed = source_cache.gc(
+            keep_keys=build_store.get_gc_rooted_source_keys(),
+            max_bytes=max_mb * 1024**2 if max_mb is not None else None,
+            max_age=max_age_days * 24 * 3600 if max_age_days is not None else None,
+            dry_run=args.dry_run)
+        nbytes = sum(item[1] for item in removed)
+        ctx.logger.info('%s %d source items, %.1f MB' % (
+            'Would remove' if args.dry_run else 'Removed', len(removed), nbytes / 1024.**2))
+
 @register_subcommand
 class Purge(object):
     """
@@ -114,3 +166,150 @@ class Purge(object):
                 sys.stderr.write('Artifact %s not found\n' % args.artifact_id)
             else:
                 sys.stderr.write('Removed directory: %s\n' % path)
+
+@register_subcommand
+class Reindex(object):
+    """
+    Rebuilds the index of the build store from the artifacts on disk.
+
+    Hashdist keeps the index up to date itself; this is only needed after
+    artifacts have been added or removed by other means, e.g., by hand::
+
+        $ hit reindex
+
+    """
+    command = 'reindex'
+
+    @staticmethod
+    def setup(ap):
+        pass
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        count = store.reindex()
+        ctx.logger.info('Indexed %d artifacts in %s' % (count, store.artifact_root))
+
+@register_subcommand
+class OptimiseStore(object):
+    """
+    Saves disk space by replacing identical files of the artifacts in the
+    build store by hard links to a single copy.
+
+    Only artifacts not optimised before are looked at, and only files
+    whose digest is not known from earlier runs are hashed, so running
+    it regularly is cheap. Setting ``optimise: true`` on the build store
+    in the configuration does the same for each artifact as it is built::
+
+        $ hit optimise-store -j 8
+
+    """
+    command = 'optimise-store'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('-j', '--jobs', type=int, help='Number of threads hashing files')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        saved = store.optimise(jobs=args.jobs)
+        ctx.logger.info('Saved %.1f MB' % (saved / 1024.**2))
+
+def _resolve_artifact_arg(arg):
+    # An artifact ID, or the path of an artifact (or of a link to one)
+    if os.path.exists(pjoin(arg, 'id')):
+        with open(pjoin(arg, 'id')) as f:
+            return f.read().strip()
+    return arg
+
+def _artifact_dependencies(store, artifact_id):
+    artifact_dir = store.resolve(artifact_id)
+    with open(pjoin(artifact_dir, 'artifact.json')) as f:
+        doc = json.load(f)
+    return [dep for dep in doc.get('dependencies', []) if not dep.startswith('virtual:')]
+
+@register_subcommand
+class Push(object):
+    """
+    Adds built artifacts to a binary cache, so that other hosts configured
+    with it under ``binary_caches`` fetch them instead of building them.
+
+    Artifacts are given by artifact ID or by path (e.g., of a profile
+    link); with ``--deps`` everything they depend on is pushed as well.
+    The default is to push to the first entry of ``binary_caches``::
+
+        $ hit push --deps ./default
+
+    """
+    command = 'push'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('artifacts', nargs='+', help='artifact IDs or paths')
+        ap.add_argument('--to', help='directory of binary cache to push to')
+        ap.add_argument('--deps', action='store_true', help='also push all dependencies')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore, BinaryCache
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        binary_cache = BinaryCache(args.to, ctx.logger) if args.to else None
+        if binary_cache is None and not store.binary_caches:
+            ctx.logger.error('No binary cache given, and none configured in binary_caches')
+            return 1
+        todo = [_resolve_artifact_arg(arg) for arg in args.artifacts]
+        artifact_ids = set()
+        while todo:
+            artifact_id = todo.pop()
+            if artifact_id in artifact_ids:
+                continue
+            if store.resolve(artifact_id) is None:
+                ctx.logger.error('Artifact %s not found' % artifact_id)
+                return 1
+            artifact_ids.add(artifact_id)
+            if args.deps:
+                todo.extend(_artifact_dependencies(store, artifact_id))
+        pushed = 0
+        for artifact_id in sorted(artifact_ids):
+            if store.push(artifact_id, binary_cache):
+                pushed += 1
+        ctx.logger.info('Pushed %d artifacts, %d were present' %
+                        (pushed, len(artifact_ids) - pushed))
+
+@register_subcommand
+class Pull(object):
+    """
+    Installs artifacts, and everything they depend on, from the binary
+    caches configured in ``binary_caches`` into the build store::
+
+        $ hit pull python/2qbgsltd4mwzfkvdpbzbsd5hwbz2mpsa
+
+    """
+    command = 'pull'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('artifact_ids', nargs='+')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        todo = list(args.artifact_ids)
+        seen = set()
+        missing = []
+        while todo:
+            artifact_id = todo.pop()
+            if artifact_id in seen:
+                continue
+            seen.add(artifact_id)
+            if store.resolve(artifact_id) is None and store.pull(artifact_id) is None:
+                ctx.logger.error('Artifact %s not found in any binary cache' % artifact_id)
+                missing.append(artifact_id)
+                continue
+            todo.extend(_artifact_dependencies(store, artifact_id))
+        if missing:
+            return 1
@@ -115,3 +115,116 @@ class Unpack(object):
 
 register_subcommand(Unpack)
 
+class ServeSources(object):
+    """
+    Serves the source cache over HTTP, for use as a mirror by others
+
+    The archives are served laid out as ``packs/<type>/<hash>``, which
+    is what is expected of the URLs listed in ``source_caches`` in the
+    configuration, e.g.::
+
+        $ hit serve-sources --port 8000
+
+    and on the other hosts::
+
+        source_caches:
+         - dir: ./src
+         - url: http://cachehost:8000
+
+    With ``--read-through``, archives that are not present are first
+    fetched from the mirrors configured on this host.
+    """
+    command = 'serve-sources'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('--host', default='', help='Address to listen on (default: all)')
+        ap.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+        ap.add_argument('--read-through', action='store_true',
+                        help='Fetch missing archives from the configured mirrors')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core.source_server import SourceCacheServer
+        store = SourceCache.create_from_config(ctx.get_config(), ctx.logger)
+        server = SourceCacheServer(store, args.host, args.port, read_through=args.read_through)
+        ctx.logger.info('Serving %s on %s' % (store.cache_path, server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+register_subcommand(ServeSources)
+
+
+class VerifySources(object):
+    """
+    Checks the integrity of everything in the source cache
+
+    The digest of every archive is checked against its key (using
+    ``--jobs`` processes, by default one per CPU), and every git
+    repository is checked with ``git fsck --connectivity-only``.
+    Verification records, extracted trees and access times of sources
+    that are no longer present are reported as orphaned. Example::
+
+        $ hit verify-sources --jobs 8 --quarantine
+
+    With ``--quarantine``, corrupt sources are moved aside to
+    ``quarantine/`` in the source cache, so that they are downloaded
+    again when next needed, and orphaned files are removed. The exit
+    code is 1 if any problem was found.
+    """
+    command = 'verify-sources'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('-j', '--jobs', type=int, help='Number of processes (default: CPU count)')
+        ap.add_argument('--quarantine', action='store_true',
+                        help='Move corrupt sources aside and remove orphaned files')
+
+    @staticmethod
+    def run(ctx, args):
+        store = SourceCache.create_from_config(ctx.get_config(), ctx.logger)
+        problems = store.verify(jobs=args.jobs, quarantine=args.quarantine)
+        for problem, type, name, message in problems:
+            sys.stdout.write('%s %s:%s\n' % (problem, type, name))
+        if problems:
+            return 1
+        ctx.logger.info('No problems found')
+        return 0
+
+register_subcommand(VerifySources)
+
+
+class MaintainSources(object):
+    """
+    Packs the refs and objects of the git repositories in the source cache
+
+    Each fetch of a git commit leaves a branch and some loose objects
+    behind in the bare repositories of the source cache, which makes
+    git slower over time. This packs the refs and objects of each
+    repository (using ``--jobs`` threads, by default one per CPU) and
+    writes their commit-graphs. Example::
+
+        $ hit maintain-sources --jobs 8
+
+    Set ``git_maintain_after`` on the source cache in the configuration
+    to do this automatically for a repository after every so many
+    fetches into it. With ``--prune-pool``, objects of the shared object
+    pool that no repository has used for an hour are removed, as done by
+    ``hit gc-sources``.
+    """
+    command = 'maintain-sources'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('-j', '--jobs', type=int, help='Number of threads (default: CPU count)')
+        ap.add_argument('--prune-pool', action='store_true',
+                        help='Remove unused objects from the shared object pool')
+
+    @staticmethod
+    def run(ctx, args):
+        store = SourceCache.create_from_config(ctx.get_config(), ctx.logger)
+        store.maintain(jobs=args.jobs, prune_pool=args.prune_pool)
+
+register_subcommand(MaintainSources)
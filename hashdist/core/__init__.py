@@ -2,6 +2,7 @@
 from .common import InvalidBuildSpecError, BuildFailedError
 from .source_cache import (SourceCache, archive_types, hit_pack)
 from .build_store import (ArtifactBuilder, BuildStore, BuildSpec, shorten_artifact_id)
+from .binary_cache import BinaryCache
 from .hit_recipe import hit_cli_build_spec, HIT_CLI_ARTIFACT_NAME, HIT_CLI_ARTIFACT_VERSION
 from .cache import DiskCache, null_cache, cached_method
 from .run_job import InvalidJobSpecError, JobFailedError
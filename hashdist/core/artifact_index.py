@@ -0,0 +1,334 @@
+"""
+:mod:`hashdist.core.artifact_index` --- Catalog of the build store
+==================================================================
+
+Finding out whether an artifact is present in the build store by looking
+at the disk means a ``stat`` and a read of its ``id`` file, and finding
+its dependencies means parsing its ``artifact.json``. That is fine for a
+handful of artifacts on a local disk, but ``hit status`` and ``hit gc``
+do it for every artifact, which on a network filesystem holding tens of
+thousands of them takes minutes.
+
+:class:`ArtifactIndex` keeps an SQLite database, ``.index.sqlite`` in the
+artifact root, with a row for each complete artifact: its ID, path
+relative to the artifact root, name, version, size, build time and last
+use, and its (complete) dependencies. The build store adds rows when an
+artifact is completed and removes them when it is deleted, each in a
+single transaction. The database is created from what is on disk the
+first time it is used, and ``hit reindex`` rebuilds it after the store
+has been changed by other means than Hashdist. The database is writable
+by whoever may write to the artifact root; users that can only read the
+store can still use it, but their use of artifacts is not recorded, and
+if the database is missing or outdated they get an index in memory,
+filled from the disk.
+
+The database also remembers which artifacts ``hit optimise-store`` has
+deduplicated, and the digests of the files in its pool of shared files,
+keyed by their ``stat`` data (including the ctime, which can not be set
+and changes when an inode is reused), so that it only needs to hash new
+files. Rows are dropped when the pool file is removed.
+
+Module reference
+----------------
+
+"""
+
+import os
+from os.path import join as pjoin
+import errno
+import json
+import sqlite3
+import stat
+import threading
+import time
+from contextlib import contextmanager
+
+INDEX_FILENAME = '.index.sqlite'
+SCHEMA_VERSION = 3
+
+_SCHEMA = """
+CREATE TABLE artifacts (
+    id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT,
+    size INTEGER NOT NULL,
+    build_time REAL NOT NULL,
+    last_used REAL NOT NULL,
+    optimised INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE dependencies (
+    artifact_id TEXT NOT NULL,
+    dependency_id TEXT NOT NULL,
+    PRIMARY KEY (artifact_id, dependency_id)
+);
+CREATE INDEX dependencies_by_dependency_id ON dependencies (dependency_id);
+CREATE TABLE file_digests (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    ctime REAL NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (dev, ino)
+);
+"""
+
+
+def get_tree_size(path):
+    """Total size of the files below `path` (not following symlinks)"""
+    size = os.lstat(path).st_size
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            size += os.lstat(pjoin(dirpath, name)).st_size
+    return size
+
+
+class ArtifactIndex(object):
+    """
+    Index of the complete artifacts below `artifact_root`.
+
+    The database is opened on first use, separately in each process and
+    thread, so a build store may be shared with the children of
+    :mod:`multiprocessing` and with threads.
+
+    Parameters
+    ----------
+
+    artifact_root : str
+        Root directory of the artifacts; the database is stored in it.
+
+    logger : Logger
+
+    timeout : float
+        Seconds to wait for other processes to finish writing.
+    """
+
+    def __init__(self, artifact_root, logger, timeout=60):
+        self.artifact_root = artifact_root
+        self.filename = pjoin(artifact_root, INDEX_FILENAME)
+        self.logger = logger
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # connections must not be used across fork()
+            try:
+                self._open(self.filename)
+            except (sqlite3.OperationalError, OSError), e:
+                local.pid = None
+                if isinstance(e, OSError) and e.errno not in (errno.EACCES, errno.EPERM,
+                                                              errno.EROFS):
+                    raise
+                self.logger.debug('Can not set up the index of the build store (%s), '
+                                  'indexing it in memory' % e)
+                self._open(':memory:')
+        return local.conn
+
+    def _open(self, filename):
+        local = self._local
+        in_memory = filename == ':memory:'
+        if not in_memory and not os.path.exists(filename):
+            self._create_file()
+        conn = sqlite3.connect(filename, timeout=self.timeout, isolation_level=None)
+        conn.text_factory = str
+        local.conn, local.pid = conn, os.getpid()
+        if in_memory:
+            with self.transaction() as conn:
+                self._fill(conn)
+        elif conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self._create()
+
+    def _create_file(self):
+        # An empty file is an empty database; it gets the permissions and
+        # group of the artifact root, which SQLite carries over to its
+        # journal files
+        st = os.stat(self.artifact_root)
+        mode = 0o644 | (stat.S_IMODE(st.st_mode) & 0o022)
+        try:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return
+        try:
+            # not subject to the umask
+            os.fchmod(fd, mode)
+            if os.fstat(fd).st_gid != st.st_gid:
+                try:
+                    os.fchown(fd, -1, st.st_gid)
+                except OSError:
+                    pass
+        finally:
+            os.close(fd)
+
+    def _create(self):
+        with self.transaction() as conn:
+            # somebody else may have won the race
+            if conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+                return
+            self._fill(conn)
+
+    def _fill(self, conn):
+        for table in ['artifacts', 'dependencies', 'file_digests']:
+            conn.execute('DROP TABLE IF EXISTS %s' % table)
+        for statement in _SCHEMA.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+        self.logger.info('Indexing the build store at %s' % self.artifact_root)
+        self._index_disk(conn)
+        conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    @contextmanager
+    def transaction(self):
+        """Runs the body in a write transaction, yielding the connection"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    def lookup(self, artifact_id):
+        """Returns the path of the artifact relative to the artifact root, or `None`"""
+        row = self._connect().execute('SELECT path FROM artifacts WHERE id = ?',
+                                      (artifact_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_dependencies(self, artifact_id):
+        """Returns the sorted list of (complete) dependencies of the artifact,
+        or `None` if it is not in the index
+        """
+        conn = self._connect()
+        if conn.execute('SELECT 1 FROM artifacts WHERE id = ?', (artifact_id,)).fetchone() is None:
+            return None
+        return [row[0] for row in conn.execute(
+            'SELECT dependency_id FROM dependencies WHERE artifact_id = ? ORDER BY dependency_id',
+            (artifact_id,))]
+
+    def list_artifacts(self):
+        """Returns a list of ``(artifact_id, path, size, last_used)`` of all
+        indexed artifacts"""
+        return self._connect().execute(
+            'SELECT id, path, size, last_used FROM artifacts ORDER BY id').fetchall()
+
+    def add(self, artifact_id, artifact_dir):
+        """Adds the complete artifact in `artifact_dir` (replacing any previous entry)"""
+        with self.transaction() as conn:
+            self._add(conn, artifact_id, artifact_dir)
+
+    def _add(self, conn, artifact_id, artifact_dir):
+        try:
+            with open(pjoin(artifact_dir, 'artifact.json')) as f:
+                doc = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            doc = {}
+        build_time = os.stat(pjoin(artifact_dir, 'id')).st_mtime
+        conn.execute('DELETE FROM dependencies WHERE artifact_id = ?', (artifact_id,))
+        conn.execute('INSERT OR REPLACE INTO artifacts '
+                     '(id, path, name, version, size, build_time, last_used) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (artifact_id, os.path.relpath(artifact_dir, self.artifact_root),
+                      artifact_id.split('/')[0], doc.get('version'), get_tree_size(artifact_dir),
+                      build_time, build_time))
+        conn.executemany('INSERT OR IGNORE INTO dependencies VALUES (?, ?)',
+                         [(artifact_id, dep) for dep in doc.get('dependencies', [])])
+
+    def get_last_used_in(self, conn, artifact_id):
+        """Returns when the artifact was last used, or `None` if it is not
+        in the index, within the transaction of `conn`"""
+        row = conn.execute('SELECT last_used FROM artifacts WHERE id = ?',
+                           (artifact_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def remove(self, artifact_id):
+        with self.transaction() as conn:
+            self.remove_in(conn, artifact_id)
+
+    def remove_in(self, conn, artifact_id):
+        """Removes the artifact within the transaction of `conn`"""
+        conn.execute('DELETE FROM artifacts WHERE id = ?', (artifact_id,))
+        conn.execute('DELETE FROM dependencies WHERE artifact_id = ?', (artifact_id,))
+
+    def clear(self):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM artifacts')
+            conn.execute('DELETE FROM dependencies')
+
+    def touch(self, artifact_id, when=None):
+        """Records that the artifact was used (at `when`, default now), if
+        the database can be written to"""
+        try:
+            with self.transaction() as conn:
+                conn.execute('UPDATE artifacts SET last_used = ? WHERE id = ?',
+                             (time.time() if when is None else when, artifact_id))
+        except sqlite3.OperationalError, e:
+            self.logger.debug('Could not record use of %s: %s' % (artifact_id, e))
+
+    def list_unoptimised(self):
+        """Returns a list of ``(artifact_id, path)`` of the artifacts not
+        yet deduplicated"""
+        return self._connect().execute(
+            'SELECT id, path FROM artifacts WHERE optimised = 0 ORDER BY id').fetchall()
+
+    def set_optimised(self, artifact_ids):
+        with self.transaction() as conn:
+            conn.executemany('UPDATE artifacts SET optimised = 1 WHERE id = ?',
+                             [(artifact_id,) for artifact_id in artifact_ids])
+
+    def get_file_digest(self, st):
+        """Returns the recorded digest of the file with ``stat`` result `st`,
+        or `None` if it is not known or the file has changed since"""
+        row = self._connect().execute(
+            'SELECT digest FROM file_digests WHERE dev = ? AND ino = ? AND size = ? '
+            'AND mtime = ? AND ctime = ?',
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_file_digests(self, items, removed=()):
+        """Records digests, given as a list of ``(stat result, digest)``, and
+        forgets those of the files with ``stat`` results in `removed`"""
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM file_digests WHERE dev = ? AND ino = ?',
+                             [(st.st_dev, st.st_ino) for st in removed])
+            conn.executemany('INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?, ?, ?)',
+                             [(st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime, digest)
+                              for st, digest in items])
+
+    def rebuild(self):
+        """Rebuilds the index from the artifacts on disk. Returns the number found"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM artifacts')
+            conn.execute('DELETE FROM dependencies')
+            return self._index_disk(conn)
+
+    def _index_disk(self, conn):
+        # Only directories with an 'id' file are complete artifacts; names
+        # starting with '.' are temporary directories or our own files
+        count = 0
+        for name in sorted(os.listdir(self.artifact_root)):
+            name_dir = pjoin(self.artifact_root, name)
+            if name.startswith('.') or not os.path.isdir(name_dir):
+                continue
+            for short_digest in sorted(os.listdir(name_dir)):
+                artifact_dir = pjoin(name_dir, short_digest)
+                if short_digest.startswith('.'):
+                    continue
+                try:
+                    with open(pjoin(artifact_dir, 'id')) as f:
+                        artifact_id = f.read().strip()
+                except IOError, e:
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        raise
+                    self.logger.debug('Not indexing incomplete artifact %s' % artifact_dir)
+                    continue
+                self._add(conn, artifact_id, artifact_dir)
+                count += 1
+        return count
@@ -0,0 +1,266 @@
+"""
+:mod:`hashdist.core.binary_cache` --- Caches of built artifacts
+===============================================================
+
+Artifact IDs are a pure function of the build spec, so an artifact built
+on one host can be installed into the build store of another instead of
+being rebuilt there. A binary cache is a directory (or a URL serving one,
+e.g., over HTTP) laid out by artifact ID::
+
+    <name>/<digest>.tar.gz    the contents of the artifact directory
+    <name>/<digest>.json      {"id": ..., "sha256": ..., "size": ...,
+                               "artifact_root": ...}
+
+Artifacts are added with ``hit push``, and :meth:`BuildStore.ensure_present
+<hashdist.core.build_store.BuildStore.ensure_present>` looks in the
+configured ``binary_caches`` before building. The pack is hashed while it
+is unpacked, the ``build.json`` in it must hash to the artifact ID, and the
+unpacked tree is only renamed into place, with its ``id`` file written
+last, once both check out.
+
+Artifacts are unpacked at the same place relative to the artifact root as
+they were built, so the relative RPATHs, shebangs and symlinks written by
+``hit build-postprocess`` remain valid. Artifacts still containing the
+artifact root of the host they were built on are only installed into a
+build store with the same artifact root.
+
+Module reference
+----------------
+
+"""
+
+import os
+from os.path import join as pjoin
+import errno
+import json
+import hashlib
+import tarfile
+import tempfile
+import urllib2
+import zlib
+from contextlib import closing
+
+from .hasher import format_digest, HashingReadStream
+from .fileutils import (silent_makedirs, silent_unlink, rmtree_write_protected, allow_writes,
+                        checked_tar_members)
+from .common import json_formatting_options
+
+
+class BinaryCacheError(Exception):
+    pass
+
+class CorruptArtifactPackError(BinaryCacheError):
+    pass
+
+
+class BinaryCache(object):
+    """
+    A binary cache at a local directory or at a URL; only the former can
+    be pushed to.
+
+    Parameters
+    ----------
+
+    location : str
+        Directory, or URL (e.g., ``http://`` or ``file:``) of the cache.
+
+    logger : Logger
+    """
+
+    def __init__(self, location, logger):
+        self.is_url = ':' in location.split('/')[0]
+        self.location = location.rstrip('/') if self.is_url else location
+        self.logger = logger
+
+    @staticmethod
+    def create_from_config(config, logger):
+        """Returns the list of BinaryCache for ``binary_caches`` in the configuration
+        """
+        return [BinaryCache(entry['dir'] if 'dir' in entry else entry['url'], logger)
+                for entry in config.get('binary_caches', [])]
+
+    def _get_path(self, artifact_id, ext):
+        name, digest = artifact_id.split('/')
+        return '%s/%s.%s' % (name, digest, ext)
+
+    def _open(self, path):
+        """Returns a stream for `path` in the cache, or `None` if it is not present"""
+        try:
+            if self.is_url:
+                return urllib2.urlopen('%s/%s' % (self.location, path))
+            else:
+                return open(pjoin(self.location, path), 'rb')
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            raise
+        except (IOError, urllib2.URLError), e:
+            if getattr(e, 'errno', None) == errno.ENOENT or (
+                    isinstance(e, urllib2.URLError) and
+                    getattr(e.reason, 'errno', None) == errno.ENOENT):
+                return None
+            raise
+
+    def get_info(self, artifact_id):
+        """Returns the JSON document stored with the artifact, or `None`"""
+        f = self._open(self._get_path(artifact_id, 'json'))
+        if f is None:
+            return None
+        try:
+            info = json.load(f)
+        except ValueError, e:
+            raise CorruptArtifactPackError('%s in %s is not valid JSON: %s' % (
+                self._get_path(artifact_id, 'json'), self.location, e))
+        finally:
+            f.close()
+        if not isinstance(info, dict) or info.get('id') != artifact_id:
+            raise CorruptArtifactPackError('%s in %s is for %s' % (
+                self._get_path(artifact_id, 'json'), self.location,
+                info.get('id') if isinstance(info, dict) else info))
+        return info
+
+    def contains(self, artifact_id):
+        return self.get_info(artifact_id) is not None
+
+    def push(self, build_store, artifact_id):
+        """
+        Packs the artifact `artifact_id` of `build_store` into the cache
+        (if it is not there already). Returns whether it was added.
+        """
+        if self.is_url:
+            raise NotImplementedError('Can only push to binary caches in local directories')
+        artifact_dir = build_store.resolve(artifact_id)
+        if artifact_dir is None:
+            raise KeyError('Artifact %s is not present in the build store' % artifact_id)
+        if self.contains(artifact_id):
+            return False
+        tarball = pjoin(self.location, self._get_path(artifact_id, 'tar.gz'))
+        d = os.path.dirname(tarball)
+        silent_makedirs(d)
+        fd, temp_tarball = tempfile.mkstemp(prefix='.tmp-', dir=d)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with tarfile.open(fileobj=f, mode='w:gz') as archive:
+                    # the directory itself first, for its permissions
+                    archive.add(artifact_dir, arcname='.', recursive=False)
+                    for name in sorted(os.listdir(artifact_dir)):
+                        archive.add(pjoin(artifact_dir, name), arcname=name)
+            hasher = hashlib.sha256()
+            with open(temp_tarball, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    hasher.update(chunk)
+            info = {'id': artifact_id,
+                    'sha256': format_digest(hasher),
+                    'size': os.path.getsize(temp_tarball),
+                    'artifact_root': build_store.artifact_root}
+            # readable by everybody sharing the cache, like the JSON document
+            os.chmod(temp_tarball, 0o644)
+            os.rename(temp_tarball, tarball)
+        finally:
+            silent_unlink(temp_tarball)
+        # the JSON document makes the artifact visible, so it goes last
+        fd, temp_json = tempfile.mkstemp(prefix='.tmp-', dir=d)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(info, f, **json_formatting_options)
+            os.chmod(temp_json, 0o644)
+            os.rename(temp_json, pjoin(self.location, self._get_path(artifact_id, 'json')))
+        finally:
+            silent_unlink(temp_json)
+        self.logger.info('Pushed %s to %s' % (artifact_id, self.location))
+        return True
+
+    def install(self, build_store, artifact_id):
+        """
+        Installs the artifact `artifact_id` from the cache into `build_store`.
+
+        Returns the artifact directory, or `None` if the artifact is not in
+        the cache or could not be used (which is logged).
+        """
+        info = self.get_info(artifact_id)
+        if info is None:
+            return None
+        stream = self._open(self._get_path(artifact_id, 'tar.gz'))
+        if stream is None:
+            return None
+        name, digest = artifact_id.split('/')
+        artifact_dir = build_store._get_artifact_path(name, digest)
+        parent = os.path.dirname(artifact_dir)
+        silent_makedirs(parent)
+        temp_dir = tempfile.mkdtemp(prefix='.pulling-', dir=parent)
+        try:
+            self.logger.info('Fetching %s from %s' % (artifact_id, self.location))
+            hasher = hashlib.sha256()
+            with closing(stream):
+                self._unpack(HashingReadStream(hasher, stream), temp_dir)
+            if format_digest(hasher) != info['sha256']:
+                raise CorruptArtifactPackError('%s in %s is corrupt' % (
+                    self._get_path(artifact_id, 'tar.gz'), self.location))
+            self._check_build_spec(temp_dir, artifact_id)
+            if (info.get('artifact_root') != build_store.artifact_root and
+                    self._refers_to(temp_dir, info['artifact_root'])):
+                self.logger.warning('%s refers to %s where it was built and can not be '
+                                    'relocated; building it instead' %
+                                    (artifact_id, info['artifact_root']))
+                return None
+            # the 'id' file marks the artifact as complete
+            with allow_writes(temp_dir):
+                with open(pjoin(temp_dir, 'id'), 'w') as f:
+                    f.write('%s\n' % artifact_id)
+            try:
+                os.rename(temp_dir, artifact_dir)
+            except OSError, e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                # built or fetched by somebody else meanwhile
+                self.logger.debug('%s appeared while fetching it' % artifact_id)
+        finally:
+            if os.path.exists(temp_dir):
+                rmtree_write_protected(temp_dir)
+        return build_store.resolve(artifact_id)
+
+    def _unpack(self, stream, target_dir):
+        try:
+            with tarfile.open(fileobj=stream, mode='r|gz') as archive:
+                archive.extractall(target_dir, members=self._checked_members(archive, target_dir))
+        except (tarfile.TarError, zlib.error, EOFError), e:
+            raise CorruptArtifactPackError('Artifact pack is not a valid tarball: %s' % e)
+        # the end of the gzip stream may not have been read by tarfile,
+        # but it needs to be hashed
+        while stream.read(1024 * 1024):
+            pass
+
+    def _checked_members(self, archive, target_dir):
+        # the 'id' file is written separately, once the rest is verified
+        for member in checked_tar_members(archive, target_dir, CorruptArtifactPackError):
+            if os.path.normpath(member.name) != 'id':
+                yield member
+
+    def _check_build_spec(self, artifact_dir, artifact_id):
+        from .build_store import BuildSpec
+        try:
+            with open(pjoin(artifact_dir, 'build.json')) as f:
+                doc = json.load(f)
+        except (IOError, ValueError), e:
+            raise CorruptArtifactPackError('No valid build.json in pack of %s: %s' % (artifact_id, e))
+        if BuildSpec(doc).artifact_id != artifact_id:
+            raise CorruptArtifactPackError('The build.json in the pack of %s does not match '
+                                          'its artifact ID' % artifact_id)
+
+    def _refers_to(self, artifact_dir, path, chunk_size=1024 * 1024):
+        # Whether any file or symlink in artifact_dir contains `path`
+        needle = path.encode('utf-8') if isinstance(path, unicode) else path
+        for dirpath, dirnames, filenames in os.walk(artifact_dir):
+            for name in filenames + dirnames:
+                filename = pjoin(dirpath, name)
+                if os.path.islink(filename):
+                    if needle in os.readlink(filename):
+                        return True
+                elif os.path.isfile(filename):
+                    tail = ''
+                    with open(filename, 'rb') as f:
+                        for chunk in iter(lambda: f.read(chunk_size), ''):
+                            if needle in tail + chunk:
+                                return True
+                            tail = chunk[-len(needle):]
+        return False
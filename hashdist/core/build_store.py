@@ -141,17 +141,32 @@ import errno
 import json
 from logging import DEBUG, ERROR
 import base64
+import urllib2
+import tempfile
+import time
+import stat
+import hashlib
+import sqlite3
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from .source_cache import SourceCache
-from .hasher import hash_document, prune_nohash
+from .binary_cache import BinaryCache, BinaryCacheError
+from .artifact_index import ArtifactIndex, INDEX_FILENAME, get_tree_size
+from .hasher import hash_document, prune_nohash, format_digest
 from .common import (InvalidBuildSpecError, BuildFailedError,
                      IllegalBuildStoreError,
                      json_formatting_options, SHORT_ARTIFACT_ID_LEN,
                      working_directory)
 from .fileutils import silent_unlink, robust_rmtree, rmtree_up_to, silent_makedirs, gzip_compress, write_protect
 from .fileutils import rmtree_write_protected, atomic_symlink, realpath_to_symlink, allow_writes
+from .fileutils import FileLock
 from . import run_job
 
+GC_LOCK_FILENAME = '.gc.lock'
+TRASH_DIRNAME = '.trash'
+LINKS_DIRNAME = '.links'
+
 
 class BuildSpec(object):
     """Wraps the document corresponding to a build.json
@@ -253,14 +268,29 @@ class BuildStore(object):
         through these will not be collected in garbage collection.
 
     logger : Logger
+
+    binary_caches : list of :class:`~hashdist.core.binary_cache.BinaryCache`
+        Where to look for built artifacts before building them.
+
+    optimise_after_build : bool
+        Whether to deduplicate the files of each new artifact against
+        the rest of the store (see :meth:`optimise`).
+
+    Complete artifacts are recorded in an
+    :class:`~hashdist.core.artifact_index.ArtifactIndex`, available as
+    the `index` attribute.
     """
 
 
-    def __init__(self, temp_build_dir, artifact_root, gc_roots_dir, logger, create_dirs=False):
+    def __init__(self, temp_build_dir, artifact_root, gc_roots_dir, logger, create_dirs=False,
+                 binary_caches=(), optimise_after_build=False):
         self.temp_build_dir = os.path.realpath(temp_build_dir)
         self.artifact_root = os.path.realpath(artifact_root)
         self.gc_roots_dir = gc_roots_dir
         self.logger = logger
+        self.binary_caches = list(binary_caches)
+        self.optimise_after_build = optimise_after_build
+        self.index = ArtifactIndex(self.artifact_root, logger)
         if create_dirs:
             for d in [self.temp_build_dir, self.artifact_root]:
                 silent_makedirs(d)
@@ -285,6 +315,8 @@ class BuildStore(object):
             logger.error("Only a single build store currently supported")
             raise NotImplementedError()
 
+        kw.setdefault('binary_caches', BinaryCache.create_from_config(config, logger))
+        kw.setdefault('optimise_after_build', config['build_stores'][0].get('optimise', False))
         return BuildStore(config['build_temp'],
                           config['build_stores'][0]['dir'],
                           config['gc_roots'],
@@ -298,8 +330,10 @@ class BuildStore(object):
         return os.path.realpath(d).startswith(self.artifact_root)
 
     def delete_all(self):
+        self.index.clear()
         for x in os.listdir(self.artifact_root):
-            rmtree_write_protected(pjoin(self.artifact_root, x))
+            if x not in (INDEX_FILENAME, GC_LOCK_FILENAME):
+                rmtree_write_protected(pjoin(self.artifact_root, x))
 
     def delete(self, artifact_id):
         """Deletes an artifact ID from the store. This is simply an
@@ -313,6 +347,7 @@ class BuildStore(object):
         """
         name, digest = artifact_id.split('/')
         path = self._get_artifact_path(name, digest)
+        self.index.remove(artifact_id)
         if os.path.exists(path):
             rmtree_write_protected(path)
             return path
@@ -325,7 +360,23 @@ class BuildStore(object):
     def resolve(self, artifact_id):
         """Given an artifact_id, resolve the short path for it, or return
         None if the artifact isn't built.
+
+        Artifacts in the index are not looked for on disk; others are, and
+        are added to the index if they are found (and the index can be
+        written to).
         """
+        path = self.index.lookup(artifact_id)
+        if path is not None:
+            return pjoin(self.artifact_root, path)
+        path = self._resolve_on_disk(artifact_id)
+        if path is not None:
+            try:
+                self.index.add(artifact_id, path)
+            except sqlite3.OperationalError, e:
+                self.logger.debug('Could not add %s to the index: %s' % (artifact_id, e))
+        return path
+
+    def _resolve_on_disk(self, artifact_id):
         name, digest = artifact_id.split('/')
         path = self._get_artifact_path(name, digest)
         if not os.path.exists(path):
@@ -372,13 +423,64 @@ class BuildStore(object):
         build_spec = as_build_spec(build_spec)
         artifact_dir = self.resolve(build_spec.artifact_id)
 
-
-        if artifact_dir is None:
-            builder = ArtifactBuilder(self, build_spec, extra_env, virtuals, debug=debug)
-            artifact_dir = builder.build(config, keep_build)
+        if artifact_dir is not None:
+            self.index.touch(build_spec.artifact_id)
+        else:
+            artifact_dir = self.pull(build_spec.artifact_id)
+            if artifact_dir is None:
+                builder = ArtifactBuilder(self, build_spec, extra_env, virtuals, debug=debug)
+                artifact_dir = builder.build(config, keep_build)
+                self.index.add(build_spec.artifact_id, artifact_dir)
+            if self.optimise_after_build:
+                # not worth waiting for if a garbage collection is running
+                self.optimise([build_spec.artifact_id], jobs=1, wait=False)
 
         return build_spec.artifact_id, artifact_dir
 
+    def pull(self, artifact_id):
+        """
+        Installs an artifact from the first of the binary caches that has
+        it. Problems with a cache are logged and the next one is tried.
+
+        Returns the artifact directory, or `None` if no cache had it.
+        """
+        for binary_cache in self.binary_caches:
+            try:
+                artifact_dir = binary_cache.install(self, artifact_id)
+            except (BinaryCacheError, IOError, OSError, urllib2.URLError), e:
+                self.logger.warning('Could not fetch %s from %s: %s' %
+                                    (artifact_id, binary_cache.location, e))
+                continue
+            if artifact_dir is not None:
+                return artifact_dir
+        return None
+
+    def get_dependencies(self, artifact_id):
+        """Returns the complete dependencies of an artifact, as listed in its
+        ``artifact.json``, or `None` if it is not present.
+        """
+        deps = self.index.get_dependencies(artifact_id)
+        if deps is None and self.resolve(artifact_id) is not None:
+            deps = self.index.get_dependencies(artifact_id)
+        return deps
+
+    def reindex(self):
+        """Rebuilds the index of the store from the artifacts on disk (this is
+        the backend of ``hit reindex``). Returns the number of artifacts.
+        """
+        return self.index.rebuild()
+
+    def push(self, artifact_id, binary_cache=None):
+        """
+        Adds an artifact to `binary_cache`, by default the first of the
+        binary caches. Returns whether it was added (rather than present).
+        """
+        if binary_cache is None:
+            if not self.binary_caches:
+                raise ValueError('No binary caches configured')
+            binary_cache = self.binary_caches[0]
+        return binary_cache.push(self, artifact_id)
+
     def make_artifact_dir(self, build_spec):
         """
         Makes a directory to put the result of the artifact build in.
@@ -455,6 +557,7 @@ class BuildStore(object):
         symlink_target = realpath_to_symlink(symlink_target)
         artifact_dir = self.resolve(artifact_id)
         atomic_symlink(artifact_dir, symlink_target)
+        self.index.touch(artifact_id)
         root_name = self._encode_symlink(symlink_target)
         atomic_symlink(symlink_target, pjoin(self.gc_roots_dir, root_name))
 
@@ -464,14 +567,8 @@ class BuildStore(object):
         silent_unlink(pjoin(self.gc_roots_dir, root_name))
         silent_unlink(symlink_target)
 
-    def gc(self):
-        """Run garbage collection, removing any unneeded artifacts.
-
-        For now, this doesn't care about virtual dependencies. They're not
-        used at the moment of writing this; it would have to be revisited
-        in the future.
-        """
-        # mark phase
+    def _mark_gc_roots(self):
+        """Returns the set of artifact IDs reachable from the GC roots"""
         marked = set()
         for gc_root in os.listdir(self.gc_roots_dir):
             try:
@@ -487,24 +584,409 @@ class BuildStore(object):
                     doc = json.load(f)
                 marked.add(doc['id'])
                 marked.update(doc['dependencies'])
-        # Less confusing output if we first output all keep, then the removals
-        for artifact_id in marked:
-            if not artifact_id.startswith('virtual:'):
-                self.logger.info('Keeping %s' % shorten_artifact_id(artifact_id))
-        # sweep phase
-        for artifact_name in os.listdir(self.artifact_root):
-            for short_digest in os.listdir(pjoin(self.artifact_root, artifact_name)):
-                artifact_dir = pjoin(self.artifact_root, artifact_name, short_digest)
-                artifact_id_file = pjoin(artifact_dir, 'id')
-                with open(artifact_id_file) as f:
-                    artifact_id = f.read().strip()
-                if artifact_id not in marked:
-                    # make sure 'id' is removed first, to de-mark the artifact as valid
-                    # before we go ahead and remove it
-                    self.logger.info('Removing %s' % shorten_artifact_id(artifact_id))
-                    os.chmod(artifact_dir, 0o777)
-                    os.unlink(artifact_id_file)
-                    rmtree_write_protected(artifact_dir)
+        return marked
+
+    def get_gc_rooted_source_keys(self):
+        """Returns the set of source keys used by the artifacts reachable
+        from the GC roots, as listed in their ``build.json``.
+        """
+        keys = set()
+        for artifact_id in self._mark_gc_roots():
+            if artifact_id.startswith('virtual:'):
+                continue
+            path = self.resolve(artifact_id)
+            if path is None:
+                continue
+            try:
+                f = open(pjoin(path, 'build.json'))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            with f:
+                doc = json.load(f)
+            keys.update(item['key'] for item in doc.get('sources', []))
+        return keys
+
+    def gc(self, dry_run=False, jobs=None, grace_seconds=3600):
+        """Run garbage collection, removing any unneeded artifacts.
+
+        Artifacts not reachable from the GC roots are removed, unless they
+        were built or used in the last `grace_seconds` (so that builds
+        running meanwhile keep what they are about to link). Incomplete
+        artifact directories are removed once they are that old, unless a
+        build still holds the lock on them. Victims are first moved to
+        ``.trash`` in the artifact root, and then deleted by `jobs`
+        threads (default: one per CPU).
+
+        For now, this doesn't care about virtual dependencies. They're not
+        used at the moment of writing this; it would have to be revisited
+        in the future.
+
+        Returns
+        -------
+
+        List of ``(nbytes, name)`` for the removed artifacts, where `name`
+        is the artifact ID, or the path of an incomplete artifact. If
+        `dry_run` is set, nothing is actually removed.
+        """
+        return BuildStoreGC(self, jobs, grace_seconds).run(dry_run)
+
+    def optimise(self, artifact_ids=None, jobs=None, wait=True):
+        """Deduplicates the files of the artifacts in the store.
+
+        Identical write-protected files of artifacts (`artifact_ids`, by
+        default all) with the same mode, owner and mtime are replaced by
+        hard links to a single copy in ``.links`` in the artifact root,
+        hashing with `jobs` threads (default: one per CPU). Artifacts that
+        were deduplicated before are skipped. Files already linked into
+        ``.links`` are not hashed again, unless their inode changed since,
+        which includes other links to it being removed by :meth:`gc`.
+        This is the backend of ``hit optimise-store``.
+
+        Returns the number of bytes saved, or `None` if `wait` is not set
+        and garbage collection or another run holds the store.
+        """
+        return BuildStoreOptimiser(self, jobs).run(artifact_ids, wait)
+
+    def _get_build_lock_path(self, artifact_dir):
+        """The lock held while building into `artifact_dir`"""
+        return pjoin(os.path.dirname(artifact_dir), '.%s.lock' % os.path.basename(artifact_dir))
+
+
+class BuildStoreGC(object):
+    # Group together methods for garbage collecting the build store (see
+    # BuildStore.gc). The artifacts are taken from the index; the disk is
+    # only listed to find directories the index does not know about.
+
+    def __init__(self, build_store, jobs=None, grace_seconds=3600):
+        self.build_store = build_store
+        self.artifact_root = build_store.artifact_root
+        self.index = build_store.index
+        self.logger = build_store.logger
+        self.jobs = jobs if jobs is not None else multiprocessing.cpu_count()
+        self.grace_seconds = grace_seconds
+        self.trash_dir = pjoin(self.artifact_root, TRASH_DIRNAME)
+
+    def _listdir(self, path):
+        try:
+            return os.listdir(path)
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return []
+
+    def _is_old(self, path, now):
+        try:
+            return now - os.lstat(path).st_mtime >= self.grace_seconds
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def _is_being_built(self, artifact_dir):
+        lock = FileLock(self.build_store._get_build_lock_path(artifact_dir), self.logger)
+        if lock.acquire(timeout=0):
+            lock.release()
+            return False
+        return True
+
+    def find_incomplete(self, now, dry_run=False):
+        """Indexes complete artifacts that are not in the index (unless
+        `dry_run`), and returns ``(incomplete, kept)``, the paths of
+        incomplete artifacts that may be removed and of those that are (or
+        may still be) being built"""
+        indexed = set(row[1] for row in self.index.list_artifacts())
+        incomplete = []
+        kept = []
+        for name in sorted(self._listdir(self.artifact_root)):
+            if name.startswith('.'):
+                continue
+            for entry in sorted(self._listdir(pjoin(self.artifact_root, name))):
+                path = pjoin(self.artifact_root, name, entry)
+                if pjoin(name, entry) in indexed or entry.endswith('.lock'):
+                    continue
+                if entry.startswith('.'):
+                    # e.g., left behind by an interrupted 'hit pull'
+                    if self._is_old(path, now):
+                        incomplete.append(path)
+                    continue
+                try:
+                    with open(pjoin(path, 'id')) as f:
+                        artifact_id = f.read().strip()
+                except IOError, e:
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        raise
+                    if not self._is_old(path, now):
+                        self.logger.debug('Keeping recent incomplete artifact %s' % path)
+                        kept.append(path)
+                    elif self._is_being_built(path):
+                        self.logger.info('Keeping %s, which is being built' % path)
+                        kept.append(path)
+                    else:
+                        incomplete.append(path)
+                else:
+                    if not dry_run:
+                        self.index.add(artifact_id, path)
+        return incomplete, kept
+
+    def remove_stale_locks(self):
+        """Removes the build locks left behind by builds that were killed;
+        locks are normally removed when released"""
+        for name in sorted(self._listdir(self.artifact_root)):
+            if name.startswith('.'):
+                continue
+            for entry in sorted(self._listdir(pjoin(self.artifact_root, name))):
+                if entry.startswith('.') and entry.endswith('.lock'):
+                    # taking a lock breaks it if stale, releasing removes it
+                    lock = FileLock(pjoin(self.artifact_root, name, entry), self.logger)
+                    if lock.acquire(timeout=0):
+                        lock.release()
+
+    def mark_in_progress(self, paths):
+        """Returns the dependencies of the incomplete artifacts at `paths`, as
+        listed in the ``artifact.json`` written when their build started"""
+        marked = set()
+        for path in paths:
+            try:
+                with open(pjoin(path, 'artifact.json')) as f:
+                    doc = json.load(f)
+            except IOError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+            except ValueError:
+                # still being written
+                continue
+            marked.update(doc.get('dependencies', []))
+        return marked
+
+    def _move_to_trash(self, path):
+        silent_makedirs(self.trash_dir)
+        container = tempfile.mkdtemp(prefix=os.path.basename(path) + '-', dir=self.trash_dir)
+        # moving a directory to another parent needs write access to it
+        os.chmod(path, 0o777)
+        os.rename(path, pjoin(container, 'artifact'))
+
+    def _remove_path(self, path):
+        try:
+            rmtree_write_protected(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def empty_trash(self):
+        paths = [pjoin(self.trash_dir, name) for name in self._listdir(self.trash_dir)]
+        if len(paths) > 1 and self.jobs > 1:
+            pool = ThreadPool(min(self.jobs, len(paths)))
+            try:
+                pool.map_async(self._remove_path, paths).get(2**31)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for path in paths:
+                self._remove_path(path)
+
+    def run(self, dry_run):
+        with FileLock(pjoin(self.artifact_root, GC_LOCK_FILENAME), self.logger):
+            now = time.time()
+            incomplete, kept = self.find_incomplete(now, dry_run)
+            marked = self.build_store._mark_gc_roots()
+            # builds in progress may run for longer than the grace period
+            marked.update(self.mark_in_progress(kept))
+            # Less confusing output if we first output all keep, then the removals
+            for artifact_id in marked:
+                if not artifact_id.startswith('virtual:'):
+                    self.logger.info('Keeping %s' % shorten_artifact_id(artifact_id))
+            victims = []
+            for artifact_id, path, nbytes, last_used in self.index.list_artifacts():
+                if artifact_id in marked:
+                    continue
+                if now - last_used < self.grace_seconds:
+                    self.logger.info('Keeping recently used %s' % shorten_artifact_id(artifact_id))
+                    continue
+                victims.append((nbytes, artifact_id, pjoin(self.artifact_root, path)))
+            for path in incomplete:
+                victims.append((get_tree_size(path), path, path))
+
+            removed = []
+            for nbytes, name, path in victims:
+                label = shorten_artifact_id(name) if name != path else path
+                if dry_run:
+                    self.logger.info('Would remove %s (%.1f MB)' % (label, nbytes / 1024.**2))
+                elif name == path:
+                    self.logger.info('Removing %s (%.1f MB)' % (label, nbytes / 1024.**2))
+                    self._move_to_trash(path)
+                else:
+                    # the artifact leaves the index and the store together,
+                    # unless a build started using it since it was listed
+                    with self.index.transaction() as conn:
+                        last_used = self.index.get_last_used_in(conn, name)
+                        if last_used is not None and time.time() - last_used < self.grace_seconds:
+                            self.logger.info('Keeping recently used %s' % label)
+                            continue
+                        self.logger.info('Removing %s (%.1f MB)' % (label, nbytes / 1024.**2))
+                        self.index.remove_in(conn, name)
+                        if os.path.exists(path):
+                            self._move_to_trash(path)
+                removed.append((nbytes, name))
+            if not dry_run:
+                # also whatever an interrupted run left behind
+                self.empty_trash()
+                self.remove_stale_locks()
+                BuildStoreOptimiser(self.build_store, self.jobs).prune_links()
+        return removed
+
+
+class BuildStoreOptimiser(object):
+    # Group together methods for deduplicating the files of the build
+    # store (see BuildStore.optimise). Every file is hard-linked to
+    # .links/<digest>-<mode>-<uid>-<gid>-<mtime> in the artifact root, so
+    # that only files that look the same to stat are merged, and a file
+    # there with a link count of 1 is not used by any artifact any more.
+    # Runs hold the same lock as the garbage collector. The index remembers
+    # the digests of the files in .links only, and forgets them when they
+    # are removed.
+
+    def __init__(self, build_store, jobs=None):
+        self.artifact_root = build_store.artifact_root
+        self.index = build_store.index
+        self.logger = build_store.logger
+        self.jobs = jobs if jobs is not None else multiprocessing.cpu_count()
+        self.links_dir = pjoin(self.artifact_root, LINKS_DIRNAME)
+
+    def _list_files(self, artifact_dir):
+        # only files that are write-protected can be shared
+        files = []
+        for dirpath, dirnames, filenames in os.walk(artifact_dir):
+            for name in filenames:
+                filename = pjoin(dirpath, name)
+                st = os.lstat(filename)
+                if stat.S_ISREG(st.st_mode) and st.st_size > 0 and not st.st_mode & 0o222:
+                    files.append((filename, st))
+        return files
+
+    def _hash_artifact(self, row):
+        artifact_id, path = row
+        files = []
+        for filename, st in self._list_files(pjoin(self.artifact_root, path)):
+            digest = self.index.get_file_digest(st)
+            if digest is None:
+                hasher = hashlib.sha256()
+                with open(filename, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                        hasher.update(chunk)
+                digest = format_digest(hasher)
+            files.append((filename, st, digest))
+        return artifact_id, files
+
+    def _get_link_path(self, st, digest):
+        return pjoin(self.links_dir, '%s-%o-%d-%d-%d' % (digest, stat.S_IMODE(st.st_mode),
+                                                        st.st_uid, st.st_gid, st.st_mtime))
+
+    def _get_link_digests(self, files):
+        # ``(stat result, digest)`` of the files in .links used by `files`,
+        # as they are after linking (which changes their ctime)
+        links = dict((self._get_link_path(st, digest), digest) for filename, st, digest in files)
+        result = []
+        for link, digest in sorted(links.items()):
+            try:
+                result.append((os.lstat(link), digest))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return result
+
+    def _link(self, filename, st, digest):
+        # Returns the number of bytes saved
+        link = self._get_link_path(st, digest)
+        try:
+            link_st = os.lstat(link)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            link_st = None
+        try:
+            if link_st is None:
+                os.link(filename, link)
+                return 0
+            if (link_st.st_dev, link_st.st_ino) == (st.st_dev, st.st_ino):
+                return 0
+            dirname = os.path.dirname(filename)
+            temp_filename = pjoin(dirname, '.%s.hit-link' % os.path.basename(filename))
+            with allow_writes(dirname):
+                os.link(link, temp_filename)
+                os.rename(temp_filename, filename)
+        except OSError, e:
+            if e.errno != errno.EMLINK:
+                raise
+            # the file system does not allow more links to the file
+            return 0
+        return st.st_size if st.st_nlink == 1 else 0
+
+    def run(self, artifact_ids=None, wait=True):
+        lock = FileLock(pjoin(self.artifact_root, GC_LOCK_FILENAME), self.logger)
+        if not lock.acquire(timeout=None if wait else 0):
+            self.logger.debug('Build store is being collected or optimised, not optimising')
+            return None
+        try:
+            rows = self.index.list_unoptimised()
+            if artifact_ids is not None:
+                artifact_ids = set(artifact_ids)
+                rows = [row for row in rows if row[0] in artifact_ids]
+            if not rows:
+                return 0
+            silent_makedirs(self.links_dir)
+            saved = 0
+            pool = ThreadPool(max(1, min(self.jobs, len(rows))))
+            try:
+                # hashing happens in the pool, linking here
+                for artifact_id, files in pool.imap_unordered(self._hash_artifact, rows):
+                    nbytes = 0
+                    removed = []
+                    for filename, st, digest in files:
+                        file_saved = self._link(filename, st, digest)
+                        if file_saved:
+                            # the inode of the file is free for reuse
+                            removed.append(st)
+                        nbytes += file_saved
+                    if nbytes:
+                        self.logger.info('Deduplicated %.1f MB of %s' % (
+                            nbytes / 1024.**2, shorten_artifact_id(artifact_id)))
+                    saved += nbytes
+                    self.index.put_file_digests(self._get_link_digests(files), removed)
+                    self.index.set_optimised([artifact_id])
+            finally:
+                pool.close()
+                pool.join()
+            return saved
+        finally:
+            lock.release()
+
+    def prune_links(self):
+        """Removes the files of the pool no artifact links to any more;
+        the caller holds the lock. Returns the number of bytes freed"""
+        freed = 0
+        try:
+            names = os.listdir(self.links_dir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        removed = []
+        for name in names:
+            filename = pjoin(self.links_dir, name)
+            st = os.lstat(filename)
+            if st.st_nlink == 1:
+                os.unlink(filename)
+                freed += st.st_size
+                removed.append(st)
+        if removed:
+            self.index.put_file_digests([], removed)
+        if freed:
+            self.logger.info('Removed %.1f MB of files no longer shared' % (freed / 1024.**2))
+        return freed
 
 
 class ArtifactBuilder(object):
@@ -523,7 +1005,8 @@ class ArtifactBuilder(object):
         The purpose of this list is for garbage collection (currently we
         just include everything, we could be more nuanced in the future).
 
-        We simply iterate through all the build imports, load their artifact.json,
+        We simply iterate through all the build imports, look up their dependencies
+        (as listed in their artifact.json) in the index of the build store,
         and return the combined result. This will in turn be stored in artifact.json
         for this build artifact.
 
@@ -535,25 +1018,31 @@ class ArtifactBuilder(object):
         for artifact_id in build_imports:
             deps.add(artifact_id)
             if not artifact_id.startswith('virtual:'):
-                artifact_dir = self.build_store.resolve(artifact_id)
-                if artifact_dir is None:
+                artifact_deps = self.build_store.get_dependencies(artifact_id)
+                if artifact_deps is None:
                     msg = 'Required artifact not already present: %s' % artifact_id
                     self.logger.error(msg)
                     raise BuildFailedError(msg, None, None)
-                with open(pjoin(artifact_dir, 'artifact.json')) as f:
-                    doc = json.load(f)
-                deps.update(doc.get('dependencies', []))
+                deps.update(artifact_deps)
         return deps
 
     def build(self, config, keep_build):
         assert isinstance(config, dict), "caller not refactored"
-        artifact_dir = self.build_store.make_artifact_dir(self.build_spec)
-        try:
-            self.make_artifact_json(artifact_dir)
-            self.build_to(artifact_dir, config, keep_build)
-        except:
-            rmtree_write_protected(artifact_dir)
-            raise
+        # the lock tells 'hit gc' that the incomplete artifact is in progress
+        artifact_path = pjoin(self.build_store.artifact_root, self.build_spec.short_artifact_id)
+        with FileLock(self.build_store._get_build_lock_path(artifact_path), self.logger):
+            artifact_dir = self.build_store.make_artifact_dir(self.build_spec)
+            try:
+                # 'hit gc' keeps what artifact.json lists while the lock is
+                # held; touching covers a run that looked before it existed
+                deps = self.make_artifact_json(artifact_dir)
+                for artifact_id in deps:
+                    if not artifact_id.startswith('virtual:'):
+                        self.build_store.index.touch(artifact_id)
+                self.build_to(artifact_dir, config, keep_build)
+            except:
+                rmtree_write_protected(artifact_dir)
+                raise
         return artifact_dir
 
     def build_to(self, artifact_dir, config, keep_build):
@@ -611,6 +1100,7 @@ class ArtifactBuilder(object):
             artifact_doc['version'] = doc['version']
         with open(fname, 'w') as f:
             json.dump(artifact_doc, f, **json_formatting_options)
+        return deps
 
     def run_build_commands(self, build_dir, artifact_dir, env, config):
         job_tmp_dir = pjoin(build_dir, 'job')
@@ -50,7 +50,7 @@ class DiskCache(object):
     def create_from_config(config, logger):
         """Creates a DiskCache from the settings in the configuration
         """
-        return DiskCache(config['global/cache'])
+        return DiskCache(config['cache'])
 
     def _as_domain(self, domain):
         if not isinstance(domain, str):
@@ -75,6 +75,13 @@ class DiskCache(object):
         shutil.rmtree(pjoin(self.cache_path, domain), ignore_errors=True)
             
 
+    def forget(self, domain, key):
+        """Drops the value from the memory cache only, so that the next
+        :meth:`get` reads what is on disk (possibly put by another process)
+        """
+        domain = self._as_domain(domain)
+        self._get_memory_cache(domain).pop(self._get_obj_filename(domain, key), None)
+
     def put(self, domain, key, value, on_disk=True):
         """Puts a value to the store
 
@@ -181,6 +188,9 @@ class NullCache(object):
     def invalidate(self, domain):
         pass
 
+    def forget(self, domain, key):
+        pass
+
 null_cache = NullCache()
 
 def cached_method(domain):
@@ -1,9 +1,12 @@
 import os
+import sys
 import errno
+import stat
 import filecmp
 import shutil
 import time
 import gzip
+import threading
 from os.path import join as pjoin
 from contextlib import closing, contextmanager
 
@@ -166,19 +169,18 @@ def rmtree_write_protected(rootpath):
     """
     Like shutil.rmtree, but removes files/directories that are write-protected.
     """
+    # Removing an entry only needs write access to its directory, so the
+    # files themselves are left alone; subdirectories have been made
+    # writable by the time they are removed, as the walk is bottom-up
     for dirpath, dirnames, filenames in os.walk(rootpath, followlinks=False, topdown=False):
         os.chmod(dirpath, 0o777)
         for fname in filenames:
-            qname = pjoin(dirpath, fname)
-            if not os.path.islink(qname):
-                os.chmod(qname, 0o777)
-            os.unlink(qname)
+            os.unlink(pjoin(dirpath, fname))
         for fname in dirnames:
             qname = pjoin(dirpath, fname)
             if os.path.islink(qname):
                 os.unlink(qname)
             else:
-                os.chmod(qname, 0o777)
                 os.rmdir(qname)
     os.rmdir(rootpath)
 
@@ -198,3 +200,395 @@ def realpath_to_symlink(filename):
     parent_dir, basename = os.path.split(filename)
     result = pjoin(os.path.realpath(parent_dir), basename)
     return result
+
+def checked_tar_members(members, target_dir, error_class, deferred_symlinks=None):
+    """Yields the tar `members` that can safely be extracted to `target_dir`
+
+    Raises `error_class` for members that would be written outside of
+    `target_dir`, directly, through a symlink extracted earlier, or as a
+    hard link to a file outside of it. If `deferred_symlinks` is a list,
+    symlinks that are absolute or lead outside of `target_dir` are not
+    yielded but appended to it, to be created with :func:`create_symlinks`
+    once the archive is known to be trustworthy.
+    """
+    target_dir = os.path.abspath(target_dir)
+
+    def is_inside(path):
+        return path == target_dir or path.startswith(target_dir + os.path.sep)
+
+    symlinks = []
+    for member in members:
+        path = os.path.abspath(pjoin(target_dir, member.name))
+        if (not is_inside(path) or
+                any(path.startswith(link + os.path.sep) for link in symlinks) or
+                (member.islnk() and not is_inside(os.path.abspath(pjoin(target_dir,
+                                                                        member.linkname))))):
+            raise error_class('Archive attempted to break out of target dir '
+                              'with filename: %s' % member.name)
+        if member.issym():
+            symlinks.append(path)
+            if deferred_symlinks is not None and (
+                    os.path.isabs(member.linkname) or
+                    not is_inside(os.path.abspath(pjoin(os.path.dirname(path),
+                                                        member.linkname)))):
+                deferred_symlinks.append(member)
+                continue
+        yield member
+
+def create_symlinks(members, target_dir):
+    """Creates the symlinks among tar `members` in `target_dir`"""
+    for member in members:
+        path = pjoin(target_dir, member.name)
+        silent_makedirs(os.path.dirname(path))
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.symlink(member.linkname, path)
+
+#
+# Copying file contents cheaply
+#
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+def _reflink(src_fd, dst_fd):
+    import fcntl
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_file_range(src_fd, dst_fd):
+    import ctypes
+    libc = _get_libc()
+    try:
+        copy_file_range = libc.copy_file_range
+    except AttributeError:
+        raise OSError(errno.ENOSYS, 'copy_file_range not available in libc')
+    copy_file_range.restype = ctypes.c_ssize_t
+    copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                ctypes.c_size_t, ctypes.c_uint]
+    while True:
+        n = copy_file_range(src_fd, None, dst_fd, None, 1 << 30, 0)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        elif n == 0:
+            break
+
+def _copy_with_read_write(src_fd, dst_fd):
+    chunk_size = 64 * 1024
+    while True:
+        chunk = os.read(src_fd, chunk_size)
+        if not chunk:
+            break
+        while chunk:
+            n = os.write(dst_fd, chunk)
+            chunk = chunk[n:]
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Writes `count` bytes of file `in_fd` from `offset` to `out_fd` (e.g. a
+    socket), with ``sendfile(2)`` if available so that the data is not
+    copied through user space, and with a read/write loop otherwise.
+    """
+    import ctypes
+    libc = _get_libc()
+    func = getattr(libc, 'sendfile64', None) or getattr(libc, 'sendfile', None)
+    if func is not None and sys.platform.startswith('linux'):
+        func.restype = ctypes.c_ssize_t
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                         ctypes.c_size_t]
+        pos = ctypes.c_int64(offset)
+        end = offset + count
+        while pos.value < end:
+            n = func(out_fd, in_fd, ctypes.byref(pos), min(end - pos.value, 1 << 30))
+            if n < 0:
+                e = ctypes.get_errno()
+                if e == errno.EINTR:
+                    continue
+                if e in (errno.EINVAL, errno.ENOSYS) and pos.value == offset:
+                    break # not supported for these files, fall back
+                raise OSError(e, os.strerror(e))
+            elif n == 0:
+                raise IOError('File shrunk while being sent')
+        else:
+            return
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    chunk_size = 64 * 1024
+    while count > 0:
+        chunk = os.read(in_fd, min(chunk_size, count))
+        if not chunk:
+            raise IOError('File shrunk while being sent')
+        count -= len(chunk)
+        while chunk:
+            n = os.write(out_fd, chunk)
+            chunk = chunk[n:]
+
+_COPY_METHODS = [('reflink', _reflink),
+                 ('copy_file_range', _copy_file_range),
+                 ('copy', _copy_with_read_write)]
+
+def copy_file_contents(src, dst, mode=0o644, methods=None):
+    """Copies the contents of file `src` to a new file `dst`, using the cheapest
+    mechanism the file system supports.
+
+    In order of preference: a reflink (copy-on-write clone on e.g. btrfs
+    and XFS), an in-kernel ``copy_file_range(2)``, or a plain read/write loop.
+
+    Parameters
+    ----------
+
+    mode : int
+        Permission bits `dst` is created with (it must not exist).
+
+    methods : list of str (optional)
+        Names of the mechanisms to try. Mechanisms that fail with an error
+        indicating lack of support are *removed* from the list, so that
+        callers copying many files can pass the same list every time and
+        stop trying what does not work.
+
+    Returns
+    -------
+
+    The name of the mechanism that was used.
+    """
+    if methods is None:
+        methods = [name for name, func in _COPY_METHODS]
+    unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP,
+                   errno.EBADF, errno.EPERM)
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        try:
+            for name, func in _COPY_METHODS:
+                if name not in methods and name != 'copy':
+                    continue
+                try:
+                    func(src_fd, dst_fd)
+                except (OSError, IOError), e:
+                    if name == 'copy' or e.errno not in unsupported:
+                        raise
+                    if name in methods:
+                        methods.remove(name)
+                    # nothing should have been written, but make sure
+                    os.ftruncate(dst_fd, 0)
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                else:
+                    return name
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+#
+# Advisory locking between processes
+#
+
+# lockf locks belong to the process, so threads of one process are kept
+# apart by a thread lock per lock file, taken before the lockf lock
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+def _get_thread_lock(path):
+    path = os.path.abspath(path)
+    with _thread_locks_guard:
+        lock = _thread_locks.get(path)
+        if lock is None:
+            lock = _thread_locks[path] = threading.Lock()
+        return lock
+
+class FileLock(object):
+    """Exclusive advisory lock on the file `path`, shared between processes
+    and (with a working ``lockd``) between hosts on a network filesystem.
+
+    The lock is taken with ``lockf`` on `path`, which is created if needed
+    and removed again on release; threads of the same process are
+    excluded from each other by a thread lock per `path`. While the lock is held the file holds
+    the host name and pid of the holder and has its mtime refreshed
+    regularly; a lock whose holder is a dead process on this host, or
+    which has not been refreshed for `stale_seconds`, is considered stale
+    and broken. On filesystems without support for locks the lock is a no-op.
+
+    Use as a context manager, or call :meth:`acquire` and :meth:`release`.
+    """
+    poll_interval = 0.2
+
+    def __init__(self, path, logger=None, stale_seconds=300):
+        self.path = path
+        self.logger = logger
+        self.stale_seconds = stale_seconds
+        self._fd = None
+        self._thread_lock = None
+        self._heartbeat = None
+        self._stop = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.release()
+
+    def acquire(self, timeout=None):
+        """Waits for the lock; returns `False` if `timeout` (in seconds) passed first"""
+        t0 = time.time()
+        thread_lock = _get_thread_lock(self.path)
+        waiting = False
+        while not thread_lock.acquire(False):
+            if timeout is not None and time.time() - t0 > timeout:
+                return False
+            if not waiting and self.logger:
+                self.logger.info('Waiting for another thread holding %s' % self.path)
+            waiting = True
+            time.sleep(self.poll_interval)
+        self._thread_lock = thread_lock
+        try:
+            got_it = self._acquire_file(t0, timeout)
+        except:
+            self._release_thread_lock()
+            raise
+        if not got_it:
+            self._release_thread_lock()
+        return got_it
+
+    def _acquire_file(self, t0, timeout):
+        import fcntl
+        import socket
+        silent_makedirs(os.path.dirname(self.path))
+        waiting = False
+        while True:
+            fd = self._open_file()
+            if fd is None:
+                continue
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError), e:
+                os.close(fd)
+                if e.errno in (errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS):
+                    if self.logger:
+                        self.logger.debug('Locking not supported for %s' % self.path)
+                    return True
+                elif e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                if self._break_if_stale():
+                    continue
+                if timeout is not None and time.time() - t0 > timeout:
+                    return False
+                if not waiting and self.logger:
+                    self.logger.info('Waiting for another process holding %s' % self.path)
+                waiting = True
+                time.sleep(self.poll_interval)
+                continue
+            # The file may have been removed by the previous holder (or a
+            # breaker) before we got the lock on it; then start over
+            try:
+                st = os.stat(self.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                st = None
+            fst = os.fstat(fd)
+            if st is None or (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino):
+                os.close(fd)
+                continue
+            os.ftruncate(fd, 0)
+            os.write(fd, '%s %d\n' % (socket.gethostname(), os.getpid()))
+            self._fd = fd
+            self._start_heartbeat()
+            return True
+
+    def _open_file(self):
+        # Returns a descriptor of the lock file opened for writing (which
+        # lockf needs), or None if it was removed before it could be opened
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            # not subject to the umask: everybody who may create the lock
+            # file in the directory may also open it after us
+            dir_mode = stat.S_IMODE(os.stat(os.path.dirname(self.path)).st_mode)
+            os.fchmod(fd, 0o644 | (dir_mode & 0o022))
+            return fd
+        try:
+            return os.open(self.path, os.O_RDWR)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            elif e.errno == errno.EACCES:
+                raise OSError(e.errno, 'No write access to lock file held or left behind by '
+                              'another user (ask them to remove it)', self.path)
+            raise
+
+    def release(self):
+        if self._fd is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            # unlink while still holding the lock, waiters notice and start over
+            try:
+                os.unlink(self.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            os.close(self._fd)
+            self._fd = None
+        self._release_thread_lock()
+
+    def _release_thread_lock(self):
+        if self._thread_lock is not None:
+            self._thread_lock.release()
+            self._thread_lock = None
+
+    def _start_heartbeat(self):
+        self._stop = stop = threading.Event()
+        path = self.path
+        interval = self.stale_seconds / 4.
+
+        def refresh():
+            while not stop.wait(interval):
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+        self._heartbeat = threading.Thread(target=refresh)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _break_if_stale(self):
+        import socket
+        try:
+            with open(self.path) as f:
+                info = f.read().split()
+            st = os.stat(self.path)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        stale = False
+        if len(info) == 2 and info[0] == socket.gethostname():
+            try:
+                os.kill(int(info[1]), 0)
+            except OSError, e:
+                stale = (e.errno == errno.ESRCH)
+            except ValueError:
+                pass
+        if not stale:
+            stale = time.time() - st.st_mtime > self.stale_seconds
+        if stale:
+            if self.logger:
+                self.logger.warning('Breaking stale lock %s (held by %s)' % (self.path, ' '.join(info)))
+            try:
+                os.unlink(self.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return stale
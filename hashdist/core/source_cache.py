@@ -40,7 +40,9 @@ Features
    upper layers, who can simply pass along two strings regardless of method.
 
  * Safety: Hashes are re-checked on the fly while unpacking, to protect
-   against corruption or tainting of the source cache.
+   against corruption or tainting of the source cache. (Re-hashing is
+   skipped for archives whose inode, size, mtime and ctime are unchanged
+   since they were last verified.)
 
  * Should be safe for multiple users to share a source cache directory
    on a shared file-system as long as all have write access, though this
@@ -79,6 +81,26 @@ Individual files or directories ("hit-pack"):
     This stream is then encoded like archives (SHA-256 in base-64),
     and prefixed with ``files:`` to get the key.
 
+    Packs are stored on disk in the version 2 format, which holds the
+    same information laid out for random access: the 8-byte magic
+    string "HDSTPCK2", the contents of each file (in the same order),
+    and then an index, consisting of a little-endian ``uint32_t``
+    number of files followed for each file by
+
+    ==========================  ==============================
+    little-endian ``uint64_t``  offset of contents in the pack
+    little-endian ``uint64_t``  length of contents
+    little-endian ``uint32_t``  length of filename
+    ---                         filename (no terminating null)
+    ==========================  ==============================
+
+    The pack ends with a little-endian ``uint64_t`` offset of the
+    index and the 8-byte magic string "HDSTIDX2". The key is still
+    computed from the stream above, so it does not depend on the
+    version of the pack, and single files can be read from a pack
+    through ``mmap`` without loading the rest of it. Packs in the
+    version 1 format (which *is* the stream above) can still be read.
+
 Module reference
 ----------------
 
@@ -89,22 +111,34 @@ import re
 import sys
 import subprocess
 import tempfile
+import urllib
 import urllib2
+import httplib
+import socket
+import time
 import json
 import shutil
 import hashlib
 import struct
+import zlib
 import errno
 import stat
 from timeit import default_timer as clock
 import contextlib
 import urlparse
+import copy
+import mmap
+import threading
 from contextlib import closing
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from .common import working_directory
 from .hasher import hash_document, format_digest, HashingReadStream, HashingWriteStream
-from .fileutils import silent_makedirs
+from .fileutils import (silent_makedirs, allow_writes, rmtree_write_protected, copy_file_contents,
+                        FileLock, checked_tar_members, create_symlinks)
 from .decorators import retry
+from .cache import DiskCache, null_cache
 
 pjoin = os.path.join
 
@@ -113,6 +147,16 @@ TAG_RE = re.compile(TAG_RE_S)
 
 PACKS_DIRNAME = 'packs'
 GIT_DIRNAME = 'git'
+VERIFIED_DIRNAME = 'verified'
+EXTRACTED_DIRNAME = 'extracted'
+ACCESS_DIRNAME = 'access'
+LOCKS_DIRNAME = 'locks'
+QUARANTINE_DIRNAME = 'quarantine'
+GIT_INDEX_DIRNAME = 'git-index'
+# bare repository under GIT_DIRNAME holding the objects shared by all the others
+GIT_POOL_NAME = '.pool'
+
+COMMIT_RE = re.compile(r'^[0-9a-f]{40}$')
 
 class RemoteFetchError(Exception):
     pass
@@ -132,6 +176,41 @@ class CorruptSourceCacheError(SourceCacheError):
 class SecurityError(SourceCacheError):
     pass
 
+class FetchResult(object):
+    """Outcome of fetching a single source item in :meth:`SourceCache.fetch_many`
+
+    Attributes
+    ----------
+
+    url, key, repo_name : str
+        As passed in to :meth:`SourceCache.fetch`.
+
+    was_present : bool
+        Whether the source item was already in the cache (nothing was downloaded).
+
+    nbytes : int or None
+        Size of the downloaded pack; `None` for git sources and items that were
+        already present.
+
+    seconds : float
+        Wall time spent on the item.
+
+    error : Exception or None
+        The exception raised by the fetch, if it failed.
+    """
+    def __init__(self, url, key, repo_name):
+        self.url = url
+        self.key = key
+        self.repo_name = repo_name
+        self.was_present = False
+        self.nbytes = None
+        self.seconds = 0.
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
 class ProgressBar(object):
 
     def __init__(self, total_size, bar_length=25):
@@ -150,7 +229,7 @@ class ProgressBar(object):
         f1 = self._bar_length * current_size / self._total_size
         f2 = self._bar_length - f1
         percent = 100. * current_size / self._total_size
-        if time_delta == 0:
+        if time_delta == 0 or current_size == 0:
             rate_eta_str = ""
         else:
             rate = 1. * current_size / time_delta # in bytes / second
@@ -195,9 +274,77 @@ def mkdir_if_not_exists(path):
 
 class SourceCache(object):
     """
+    Parameters
+    ----------
+
+    cache_path : str
+        Local directory of the cache.
+
+    logger : Logger
+
+    mirrors : list of str
+        URLs of remote mirrors laid out as ``<url>/packs/<type>/<hash>``.
+
+    create_dirs : bool
+        Whether to create `cache_path` if it does not exist.
+
+    extracted_max_bytes : int
+        If non-zero, keep extracted trees of archives and git checkouts
+        under ``extracted/`` in the cache, up to this total size, and
+        unpack by copying from those (using reflinks or in-kernel copies
+        when the file system supports it) rather than decompressing
+        again. Extracted trees are write-protected but, unlike the
+        archives, not re-verified against their key on every unpack.
+
+    hardlink_extracted : bool
+        Hard-link files from extracted trees instead of copying them. This
+        is the cheapest option, but the unpacked files are then shared with
+        the cache and are read-only; only use it if builds do not modify
+        their sources in place.
+
+    cache : :class:`~hashdist.core.cache.DiskCache` (optional)
+        Where to keep statistics about mirrors.
+    git_unpack : str
+        How git sources are unpacked. ``'checkout'`` (the default) makes
+        the target a git repository with the commit checked out.
+        ``'archive'`` streams the tree of the commit, and recursively
+        those of its submodules, from the bare repositories in the cache
+        with ``git archive`` straight into the target, which is much
+        cheaper but leaves no ``.git`` behind.
+
+    download_connections : int
+        Number of connections to download large archives over, from
+        servers that support byte ranges (see :class:`SegmentedDownload`).
+
+    git_maintain_after : int
+        If set, a git repository in the cache is maintained (see
+        :meth:`maintain`) after every this many fetches into it.
+
+    tiers : list of :class:`SourceCache`
+        Further source cache directories (e.g., a large cache shared over
+        NFS) in which sources are looked up, in order, when they are not
+        present in this one. Nothing is ever written to them; sources are
+        fetched into this cache. Their `promote` setting determines whether
+        archives found in them are first copied into this cache, or
+        unpacked from where they are. Git commits found in them are always
+        fetched into the repositories of this cache (which is a cheap local
+        fetch), since checkouts need to mark them as in use.
+
+    read_only : bool
+        Set for caches used as `tiers` of another; nothing is written to
+        the cache, not even access times.
+
+    promote : bool
+        For caches used as `tiers` of another; whether archives found in
+        this cache are copied into the other one before use.
     """
 
-    def __init__(self, cache_path, logger, mirrors=(), create_dirs=False):
+    def __init__(self, cache_path, logger, mirrors=(), create_dirs=False,
+                 extracted_max_bytes=0, hardlink_extracted=False, cache=null_cache,
+                 git_unpack='checkout', download_connections=4, git_maintain_after=0,
+                 tiers=(), read_only=False, promote=False):
+        if git_unpack not in ('checkout', 'archive'):
+            raise ValueError('git_unpack must be "checkout" or "archive", not "%s"' % git_unpack)
         if not os.path.isdir(cache_path):
             if create_dirs:
                 silent_makedirs(cache_path)
@@ -206,6 +353,16 @@ class SourceCache(object):
         self.cache_path = os.path.realpath(cache_path)
         self.logger = logger
         self.mirrors = mirrors
+        self.show_progress = True
+        self.extracted_max_bytes = extracted_max_bytes
+        self.hardlink_extracted = hardlink_extracted
+        self.cache = cache
+        self.git_unpack = git_unpack
+        self.download_connections = download_connections
+        self.git_maintain_after = git_maintain_after
+        self.tiers = list(tiers)
+        self.read_only = read_only
+        self.promote = promote
 
     def _ensure_subdir(self, name):
         path = pjoin(self.cache_path, name)
@@ -213,23 +370,48 @@ class SourceCache(object):
         return path
 
     def delete_all(self):
-        shutil.rmtree(self.cache_path)
+        rmtree_write_protected(self.cache_path)
         os.mkdir(self.cache_path)
 
+    @staticmethod
+    def get_local_config(config, logger=None):
+        """Returns the entry of ``source_caches`` in the configuration for
+        the cache that is written to, i.e., the first directory that is not
+        marked ``read_only``.
+        """
+        for entry in config['source_caches']:
+            if 'dir' in entry and not entry.get('read_only', False):
+                return entry
+        if logger is not None:
+            logger.error('At least one source cache needs to be a writable local directory')
+        raise NotImplementedError()
+
     @staticmethod
     def create_from_config(config, logger, create_dirs=False):
         """Creates a SourceCache from the settings in the configuration
+
+        The first directory in ``source_caches`` not marked ``read_only`` is
+        the one written to; the other directories are looked up in order as
+        its `tiers`, and URLs are used as `mirrors`.
         """
-        if 'dir' not in config['source_caches'][0]:
-            logger.error('First source cache need to be a local directory')
-            raise NotImplementedError()
+        local = SourceCache.get_local_config(config, logger)
         mirrors = []
-        for entry in config['source_caches'][1:]:
-            if 'url' not in entry:
-                logger.error('All but first source cache currently needs to be remote')
-                raise NotImplementedError()
-            mirrors.append(entry['url'])
-        return SourceCache(config['source_caches'][0]['dir'], logger, mirrors, create_dirs)
+        tiers = []
+        for entry in config['source_caches']:
+            if 'url' in entry:
+                mirrors.append(entry['url'])
+            elif entry is not local:
+                tiers.append(SourceCache(entry['dir'], logger, read_only=True,
+                                         promote=entry.get('promote', False)))
+        cache = DiskCache.create_from_config(config, logger) if 'cache' in config else null_cache
+        return SourceCache(local['dir'], logger, mirrors, create_dirs,
+                           extracted_max_bytes=local.get('extracted_max_mb', 0) * 1024**2,
+                           hardlink_extracted=local.get('extracted_hardlink', False),
+                           cache=cache,
+                           git_unpack=local.get('git_unpack', 'checkout'),
+                           download_connections=local.get('download_connections', 4),
+                           git_maintain_after=local.get('git_maintain_after', 0),
+                           tiers=tiers)
 
     def fetch_git(self, repository, rev, repo_name):
         """Fetches source code from git repository
@@ -263,7 +445,9 @@ class SourceCache(object):
             prepended by ``git:``.
 
         """
-        return GitSourceCache(self).fetch_git(repository, rev, repo_name)
+        key = GitSourceCache(self).fetch_git(repository, rev, repo_name)
+        self.record_access('git', repo_name)
+        return key
 
     def fetch_archive(self, url, type=None):
         """Fetches  a tarball without knowing the key up-front.
@@ -282,11 +466,13 @@ class SourceCache(object):
             when this cannot be determined from the suffix of the url.
 
         """
-        return ArchiveSourceCache(self).fetch_archive(url, type, None)
+        key = ArchiveSourceCache(self).fetch_archive(url, type, None)
+        self.record_access(*key.split(':'))
+        return key
 
 
-    def put(self, files):
-        """Put in-memory contents into the source cache.
+    def put(self, files, paths=()):
+        """Put in-memory contents and/or files into the source cache.
 
         Parameters
         ----------
@@ -295,6 +481,11 @@ class SourceCache(object):
             slashes ``/`` as path separators. `contents` is a pure bytes
             objects which will be dumped directly to `stream`.
 
+        paths : dict or list of (filename, path) (optional)
+            Further contents of the archive, read from the files at `path`
+            in the filesystem. These are streamed into the pack and never
+            held in memory as a whole.
+
         Returns
         -------
 
@@ -302,7 +493,9 @@ class SourceCache(object):
             The resulting key, it has the ``files:`` prefix.
 
         """
-        return ArchiveSourceCache(self).put(files)
+        key = ArchiveSourceCache(self).put(files, paths)
+        self.record_access(*key.split(':'))
+        return key
 
     def _get_handler(self, type):
         if type == 'git':
@@ -343,6 +536,90 @@ class SourceCache(object):
         type, hash = key.split(':')
         handler = self._get_handler(type)
         handler.fetch(url, type, hash, repo_name)
+        self.record_access(type, repo_name if type == 'git' else hash)
+
+    def fetch_many(self, items, worker_count=8):
+        """Fetch many sources whose keys are known, concurrently.
+
+        Items already present in the cache are skipped. Archives are
+        downloaded by a pool of `worker_count` threads. Git sources are
+        grouped by `repo_name` and each group is fetched serially, since
+        the fetches for a group all go to the same bare repository.
+
+        Failures do not abort the other downloads; they are recorded in the
+        returned results instead.
+
+        Parameters
+        ----------
+
+        items : list of (url, key, repo_name)
+            Arguments to :meth:`fetch`. Duplicate keys are only fetched once.
+
+        worker_count : int
+            Maximum number of concurrent downloads.
+
+        Returns
+        -------
+
+        List of :class:`FetchResult`, in the order of (de-duplicated) `items`.
+        """
+        # Progress bars from concurrent downloads would garble each other
+        quiet = copy.copy(self)
+        quiet.show_progress = False
+
+        results = []
+        seen = set()
+        tasks = []
+        git_tasks = {}
+        for url, key, repo_name in items:
+            if key in seen:
+                continue
+            seen.add(key)
+            result = FetchResult(url, key, repo_name)
+            results.append(result)
+            if key.split(':')[0] == 'git':
+                if repo_name not in git_tasks:
+                    git_tasks[repo_name] = []
+                    tasks.append(git_tasks[repo_name])
+                git_tasks[repo_name].append(result)
+            else:
+                tasks.append([result])
+
+        def run_task(task):
+            for result in task:
+                quiet._fetch_into_result(result)
+
+        if tasks:
+            pool = ThreadPool(max(1, min(worker_count, len(tasks))))
+            try:
+                # map_async(...).get() rather than map(), so that KeyboardInterrupt
+                # is delivered on Python 2
+                pool.map_async(run_task, tasks).get(2**31)
+            finally:
+                pool.terminate()
+                pool.join()
+        return results
+
+    def _fetch_into_result(self, result):
+        type, hash = result.key.split(':')
+        t0 = clock()
+        try:
+            handler = self._get_handler(type)
+            if type == 'git':
+                result.was_present = (result.repo_name is not None and
+                                      os.path.exists(handler.get_bare_repo_path(result.repo_name)) and
+                                      handler._has_commit(result.repo_name, hash))
+            else:
+                result.was_present = handler.contains(type, hash)
+            if not result.was_present:
+                self.fetch(result.url, result.key, result.repo_name)
+                if type != 'git':
+                    result.nbytes = os.path.getsize(handler.get_pack_filename(type, hash))
+            else:
+                self.record_access(type, result.repo_name if type == 'git' else hash)
+        except Exception as e:
+            result.error = e
+        result.seconds = clock() - t0
 
     def unpack(self, key, target_path):
         """
@@ -353,9 +630,10 @@ class SourceCache(object):
         will be raised in this case. In normal circumstances this should
         never happen.
 
-        The archive will be loaded into memory, checked against the
-        hash, and then extracted from the memory copy, so that attacks
-        through tampering with on-disk archives should not be possible.
+        Archives are hashed while being extracted in a single pass to a
+        staging directory, which is only moved into place once the hash
+        matches, so that attacks through tampering with on-disk archives
+        should not be possible.
 
         Parameters
         ----------
@@ -373,16 +651,117 @@ class SourceCache(object):
             raise ValueError("Key must be on form 'type:hash'")
         type, hash = key.split(':')
         handler = self._get_handler(type)
-        handler.unpack(type, hash, target_path)
+        if self.extracted_max_bytes > 0 and type != 'files':
+            ExtractedTreeCache(self).unpack(handler, type, hash, target_path)
+        else:
+            handler.unpack(type, hash, target_path)
+        if type != 'git':
+            # git records access per repository, in GitSourceCache.unpack
+            self.record_access(type, hash)
+
+    def lock(self, name):
+        """Returns a :class:`~hashdist.core.fileutils.FileLock` named `name`
+        in the cache, to keep processes sharing the cache from doing the same
+        work (such as downloading the same source) at the same time.
+        """
+        name = name.replace(os.path.sep, '_')
+        return FileLock(pjoin(self.cache_path, LOCKS_DIRNAME, name + '.lock'), self.logger)
+
+    def record_access(self, type, name):
+        """Records that a source item was just used, for :meth:`gc`
+
+        `name` is the hash of the key, or the repository name for git.
+        The time is kept as the mtime of ``access/<type>/<name>``, since
+        touching packs themselves would invalidate their verification.
+        """
+        if self.read_only:
+            return
+        filename = pjoin(self.cache_path, ACCESS_DIRNAME, type, name)
+        try:
+            try:
+                os.utime(filename, None)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                silent_makedirs(os.path.dirname(filename))
+                open(filename, 'a').close()
+        except (IOError, OSError), e:
+            # a read-only cache is still usable
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+
+    def gc(self, keep_keys=(), max_bytes=None, max_age=None, dry_run=False):
+        """Removes source items from the cache, least recently used first
+
+        Items referenced by `keep_keys` are never removed; for git keys
+        the whole repository holding the commit, including the
+        repositories of its submodules, is kept. Of the other items, those
+        not used for `max_age` seconds are removed, and then more are
+        removed until the cache takes at most `max_bytes`. The trees
+        extracted from an item count towards its size and are removed
+        with it. The shared object pool of the git repositories counts
+        towards `max_bytes`; the objects of removed repositories are
+        pruned from it an hour after their removal (see
+        :meth:`GitSourceCache.prune_pool`).
+
+        Returns
+        -------
+
+        List of ``(last_access, nbytes, type, name)`` for the removed
+        items, where `name` is the hash, or the repository name for git.
+        If `dry_run` is set, nothing is actually removed.
+        """
+        return SourceCacheGC(self).run(keep_keys, max_bytes, max_age, dry_run)
+
+    def verify(self, jobs=None, quarantine=False):
+        """Re-verifies every source item in the cache
+
+        The digest of each archive and hit-pack is checked, using `jobs`
+        processes (default: one per CPU), and each git repository is
+        checked with ``git fsck --connectivity-only``. Bookkeeping files
+        left behind by items that are gone are reported as orphaned.
+
+        If `quarantine` is set, corrupt items are moved to
+        ``quarantine/<type>/`` in the cache (so that they are fetched
+        again when next needed), and orphaned bookkeeping is removed.
+
+        Returns
+        -------
+
+        List of ``(problem, type, name, message)``, where `problem` is
+        ``'corrupt'`` or ``'orphaned'``, and `name` is the hash, or the
+        repository name for git.
+        """
+        return SourceCacheVerifier(self, jobs).run(quarantine)
+
+    def maintain(self, jobs=None, prune_pool=False):
+        """Packs the refs and objects of the git repositories in the cache
+
+        Every ``fetch`` of a git commit leaves an ``inuse/*`` branch and
+        a few loose objects behind, which slows git down over time.
+        Each repository gets its refs packed, its objects repacked and a
+        commit-graph written, using `jobs` threads (default: one per
+        CPU). If `prune_pool` is set, objects of the shared object pool
+        that no repository has used for an hour are removed, as done by
+        :meth:`gc`.
+        """
+        GitSourceCache(self).maintain(jobs, prune_pool)
 
 
 class GitSourceCache(object):
     # Group together methods for working with the part of the source
     # cache stored with git.
 
+    # how long objects stay in the pool after the last repository using
+    # them was removed (a git date)
+    pool_prune_expire = '1.hour.ago'
+
     def __init__(self, source_cache):
         self.repo_path = pjoin(source_cache.cache_path, GIT_DIRNAME)
+        self.index_path = pjoin(source_cache.cache_path, GIT_INDEX_DIRNAME)
+        self.source_cache = source_cache
         self.logger = source_cache.logger
+        self.unpack_mode = source_cache.git_unpack
 
     def git(self, repo_name, *args):
         # Inherit stdin/stdout in order to interact with user about any passwords
@@ -418,12 +797,35 @@ class GitSourceCache(object):
         if repo_name:
             repo_path = self.get_bare_repo_path(repo_name)
             if not os.path.exists(repo_path):
-                # TODO: This is not race-safe
-                os.makedirs(repo_path)
-                self.checked_git(repo_name, 'init', '--bare', '-q', repo_path)
+                self._create_bare_repo(repo_name)
             env['GIT_DIR'] = repo_path
         return env
 
+    def _create_bare_repo(self, repo_name):
+        # Initialize in a temporary directory and rename it into place, under
+        # a lock so that concurrent processes don't initialize it twice
+        repo_path = self.get_bare_repo_path(repo_name)
+        with self.source_cache.lock('git-init-%s' % repo_name):
+            if os.path.exists(repo_path):
+                return
+            silent_makedirs(self.repo_path)
+            temp_path = tempfile.mkdtemp(prefix='.init-', dir=self.repo_path)
+            try:
+                self.checked_git(repo_name, 'init', '--bare', '-q', temp_path)
+                if repo_name == GIT_POOL_NAME:
+                    # objects are only ever removed from the pool explicitly,
+                    # and arrive packed so that the repositories they came
+                    # from can drop them (see the comment on Object pool)
+                    for key, value in [('gc.auto', '0'), ('fetch.unpackLimit', '1')]:
+                        self.checked_git(None, '--git-dir=%s' % temp_path,
+                                         'config', key, value)
+                else:
+                    self._write_alternates(temp_path)
+                os.rename(temp_path, repo_path)
+            except:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                raise
+
     @contextlib.contextmanager
     def _marked_commit(self, repo_name, commit):
         """Create temporary branch reference to commit"""
@@ -436,6 +838,8 @@ class GitSourceCache(object):
             self.checked_git(repo_name, 'branch', '-D', mark)
 
     def _ensure_branch(self, repo_name, branch, commit):
+        if self._does_branch_exist(repo_name, branch):
+            return
         retcode, out, err = self.git(repo_name, 'branch', branch, commit)
         if retcode != 0:
             # Did it already exist? If so we're good (except if hashdist gc runs
@@ -463,13 +867,138 @@ class GitSourceCache(object):
             raise SourceNotFoundError(msg)
         return commit
 
+    def _read_packed_refs(self, repo_name):
+        # Returns the names of the refs in packed-refs
+        refs = set()
+        try:
+            with open(pjoin(self.get_bare_repo_path(repo_name), 'packed-refs')) as f:
+                for line in f:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    fields = line.split()
+                    if len(fields) == 2:
+                        refs.add(fields[1])
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        return refs
+
+    def _does_ref_exist(self, repo_name, ref):
+        # Looked up on disk (loose ref, then packed-refs), as this is
+        # done for every fetch and unpack
+        if os.path.isfile(pjoin(self.get_bare_repo_path(repo_name), ref)):
+            return True
+        return ref in self._read_packed_refs(repo_name)
+
     def _does_branch_exist(self, repo_name, branch):
-        retcode, out, err = self.git(repo_name,
-                                     'show-ref', '--verify', '--quiet', 'refs/heads/%s' % branch)
-        return retcode == 0
+        return self._does_ref_exist(repo_name, 'refs/heads/%s' % branch)
 
     def _mark_commit_as_in_use(self, repo_name, commit):
         self._ensure_branch(repo_name, 'inuse/%s' % commit, commit)
+        self._ensure_pool_ref(repo_name, commit)
+        self._index_commit(repo_name, commit)
+
+    #
+    # Commit index
+    #
+    # Maps each commit to the repo_name it was fetched into, so that
+    # unpack doesn't need to ask every bare repo in turn. There is one
+    # small file per commit, named by the commit hash and containing
+    # the repo name; it is only a hint and is always verified against
+    # the repository before use. The inuse/* branches are the
+    # authoritative record and the index can be rebuilt from them.
+
+    def _get_index_filename(self, commit):
+        return pjoin(self.index_path, commit[:2], commit[2:])
+
+    def _index_commit(self, repo_name, commit):
+        if not COMMIT_RE.match(commit) or self.source_cache.read_only:
+            return
+        filename = self._get_index_filename(commit)
+        d = os.path.dirname(filename)
+        silent_makedirs(d)
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp-', dir=d)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(repo_name)
+            os.rename(temp_path, filename)
+        except:
+            silent_unlink(temp_path)
+            raise
+
+    def _lookup_commit(self, commit):
+        if not COMMIT_RE.match(commit):
+            return None
+        try:
+            with open(self._get_index_filename(commit)) as f:
+                return f.read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _list_repo_names(self):
+        try:
+            names = os.listdir(self.repo_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        # skip repositories being created or removed
+        return sorted(name for name in names if not name.startswith('.'))
+
+    def _list_inuse_commits(self, repo_name):
+        # Read the inuse/* refs straight from disk (loose refs and
+        # packed-refs) rather than spawning git for every repository
+        repo_path = self.get_bare_repo_path(repo_name)
+        commits = set()
+        try:
+            commits.update(os.listdir(pjoin(repo_path, 'refs', 'heads', 'inuse')))
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+        for ref in self._read_packed_refs(repo_name):
+            if ref.startswith('refs/heads/inuse/'):
+                commits.add(ref[len('refs/heads/inuse/'):])
+        return sorted(c for c in commits if COMMIT_RE.match(c))
+
+    def rebuild_index(self):
+        """
+        Recreate the commit index from the inuse/* branches of all
+        bare repositories in the cache. Stale entries are replaced;
+        entries for commits no longer in use are left alone as they
+        are verified on lookup anyway.
+        """
+        for repo_name in self._list_repo_names():
+            for commit in self._list_inuse_commits(repo_name):
+                if self._lookup_commit(commit) != repo_name:
+                    self._index_commit(repo_name, commit)
+
+    def _find_repo_name(self, commit):
+        def is_in(repo_name):
+            return (repo_name is not None and
+                    os.path.isdir(self.get_bare_repo_path(repo_name)) and
+                    self._has_commit(repo_name, commit))
+
+        repo_name = self._lookup_commit(commit)
+        if is_in(repo_name):
+            return repo_name
+        tried = set([repo_name])
+
+        # Index missing or out of date; rebuild it from the inuse/* branches
+        self.rebuild_index()
+        repo_name = self._lookup_commit(commit)
+        if repo_name not in tried and is_in(repo_name):
+            return repo_name
+        tried.add(repo_name)
+
+        # Last resort, the commit may be reachable without being marked
+        # in use (e.g., fetched as part of another branch's history)
+        for repo_name in self._list_repo_names():
+            if repo_name not in tried and is_in(repo_name):
+                self._index_commit(repo_name, commit)
+                return repo_name
+        raise KeyNotFoundError('Source item not present: git:%s' % commit)
 
     def fetch(self, url, type, commit, repo_name):
         assert type == 'git'
@@ -479,7 +1008,9 @@ class GitSourceCache(object):
         if retcode == 0:
             self._mark_commit_as_in_use(repo_name, commit)
         elif url is None:
-            raise SourceNotFoundError('git:%s not present and repo url not provided' % commit)
+            if self._find_tier(repo_name, commit) is None:
+                raise SourceNotFoundError('git:%s not present and repo url not provided' % commit)
+            self.fetch_git(None, None, repo_name, commit)
         else:
             terms = url.split(' ')
             if len(terms) == 1:
@@ -499,6 +1030,19 @@ class GitSourceCache(object):
     def fetch_git(self, repo_url, rev, repo_name, commit=None):
         if commit is None and rev is None:
             raise ValueError('Either a commit or a branch/rev must be specified')
+        # Only one process fetches into a given repository at a time, so
+        # that others waiting for the same commit find it present
+        with self.source_cache.lock('git-%s' % repo_name):
+            return self._fetch_git_locked(repo_url, rev, repo_name, commit)
+
+    def _fetch_git_locked(self, repo_url, rev, repo_name, commit):
+        if commit is not None and rev is None and self._has_commit(repo_name, commit):
+            # fetched by another process while we waited
+            self._mark_commit_as_in_use(repo_name, commit)
+            if self._count_fetch(repo_name):
+                self._maintain_locked(repo_name)
+            self._fetch_submodules(repo_name, repo_url, commit)
+            return 'git:%s' % commit
         elif commit is None:
             # It is important to resolve the rev remotely, we can't trust local
             # branch-names at all since we merge all projects encountered into the
@@ -508,6 +1052,18 @@ class GitSourceCache(object):
         if rev is not None:
             self.checked_git(repo_name, 'fetch', repo_url, rev)
 
+        elif self._fetch_from_sibling(repo_name, commit):
+            pass
+
+        elif self._fetch_from_tiers(repo_name, commit):
+            pass
+
+        elif repo_url is None:
+            raise SourceNotFoundError('git:%s not present and repo url not provided' % commit)
+
+        elif self._fetch_shallow(repo_name, repo_url, commit):
+            pass
+
         else:
             # when rev is None, fetch all the remote heads; seems like one must
             # do a separate ls-remote...
@@ -523,36 +1079,342 @@ class GitSourceCache(object):
 
 
         self._mark_commit_as_in_use(repo_name, commit)  # Create a branch so that 'git gc' doesn't collect it
+        self._after_fetch(repo_name)
         self._fetch_submodules(repo_name, repo_url, commit)
 
         return 'git:%s' % commit
 
-    def unpack(self, type, hash, target_path):
-        assert type == 'git'
+    #
+    # Tiers
+    #
+    # Commits found in the bare repositories of one of source_cache.tiers
+    # are fetched from there into the repository of the same name in this
+    # cache, rather than checked out from the tier directly, as checkouts
+    # need the commit marked as in use. Submodules follow through
+    # fetch_git, which looks in the tiers for their repositories too.
+    #
+
+    def _find_tier(self, repo_name, commit):
+        for tier in self.source_cache.tiers:
+            tier_git = GitSourceCache(tier)
+            if (os.path.isdir(tier_git.get_bare_repo_path(repo_name)) and
+                    tier_git._has_commit(repo_name, commit)):
+                return tier
+        return None
+
+    def _fetch_from_tiers(self, repo_name, commit):
+        tier = self._find_tier(repo_name, commit)
+        if tier is None:
+            return False
+        self.logger.info('Fetching git:%s from %s' % (commit, tier.cache_path))
+        self._fetch_local(repo_name, GitSourceCache(tier), repo_name, commit)
+        return True
+
+    def _fetch_local(self, repo_name, source_git, source_name, commit):
+        # Fetches commit from the bare repository source_name of source_git
+        # (of this cache, or of a tier) into repo_name
+        #
+        # fetch the branch marking it in use if there is one, as servers
+        # (here, git upload-pack) may refuse requests for bare commits
+        if commit in source_git._list_inuse_commits(source_name):
+            ref = 'inuse/%s' % commit
+        else:
+            ref = commit
+        # the source repository may have been fetched shallowly; keep
+        # the record of where to deepen from (see deepen)
+        self.checked_git(repo_name, 'fetch', '--update-shallow',
+                         source_git.get_bare_repo_path(source_name), ref)
+        shallow = source_git.get_shallow_commits(source_name)
+        if shallow:
+            known = self.get_shallow_commits(repo_name)
+            with open(self._get_shallow_record_filename(repo_name), 'a') as f:
+                for shallow_commit, url in sorted(shallow.items()):
+                    if shallow_commit not in known:
+                        f.write('%s %s\n' % (shallow_commit, url))
+
+    def _find_repo_name_in_tiers(self, commit):
+        for tier in self.source_cache.tiers:
+            try:
+                return GitSourceCache(tier)._find_repo_name(commit)
+            except KeyNotFoundError:
+                pass
+        raise KeyNotFoundError('Source item not present: git:%s' % commit)
 
-        # We don't want to require supplying a repo name, so for now
-        # we simply iterate through all git repos
+    #
+    # Shallow fetches
+    #
+    # A pinned commit is fetched on its own at depth 1 if the remote
+    # allows requesting it by hash (allow*SHA1InWant, or protocol v2),
+    # rather than fetching the full history of every remote head. git
+    # itself records the cut-off commits in the 'shallow' file of the
+    # bare repo; we additionally record where each of them came from in
+    # 'hashdist-shallow' so that the history can be fetched later on
+    # with deepen().
+
+    def _get_shallow_record_filename(self, repo_name):
+        return pjoin(self.get_bare_repo_path(repo_name), 'hashdist-shallow')
+
+    def get_shallow_commits(self, repo_name):
+        """
+        Returns a dict mapping each commit fetched shallowly into
+        `repo_name` to the URL it was fetched from.
+        """
+        result = {}
         try:
-            repo_names = os.listdir(self.repo_path)
-        except OSError, e:
+            with open(self._get_shallow_record_filename(repo_name)) as f:
+                for line in f:
+                    fields = line.split(None, 1)
+                    if len(fields) == 2:
+                        result[fields[0]] = fields[1].rstrip('\n')
+        except IOError, e:
             if e.errno != errno.ENOENT:
                 raise
-            repo_names = []
-        for repo_name in repo_names:
-            retcode, out, err = self.git(repo_name, 'rev-list', '-n1', '--quiet', hash)
-            if retcode == 0:
-                break
-        else:
-            raise KeyNotFoundError('Source item not present: git:%s' % hash)
+        return result
+
+    def _fetch_shallow(self, repo_name, repo_url, commit):
+        retcode, out, err = self.git(repo_name, 'fetch', '--depth=1', repo_url, commit)
+        if retcode != 0:
+            self.logger.debug('Shallow fetch of %s from %s refused, fetching all heads:\n%s' %
+                              (commit, repo_url, err))
+            return False
+        if commit not in self.get_shallow_commits(repo_name):
+            with open(self._get_shallow_record_filename(repo_name), 'a') as f:
+                f.write('%s %s\n' % (commit, repo_url))
+        return True
+
+    def deepen(self, repo_name):
+        """
+        Fetches the full history of the commits that were fetched shallowly
+        into `repo_name`, from the repositories they were fetched from.
+        """
+        shallow = self.get_shallow_commits(repo_name)
+        if not shallow:
+            return
+        is_shallow = os.path.exists(pjoin(self.get_bare_repo_path(repo_name), 'shallow'))
+        for commit, url in sorted(shallow.items()):
+            args = ['fetch', '--unshallow'] if is_shallow else ['fetch']
+            retcode, out, err = self.git(repo_name, *(args + [url, commit]))
+            if retcode != 0:
+                # the server may refuse the hash; fall back to all heads
+                out = self.checked_git(repo_name, 'ls-remote', url)
+                heads = [line.split()[1] for line in out.splitlines() if line.strip()]
+                heads = [x for x in heads if not x.endswith("^{}")]
+                self.checked_git(repo_name, *(args + [url] + heads))
+            is_shallow = os.path.exists(pjoin(self.get_bare_repo_path(repo_name), 'shallow'))
+        os.unlink(self._get_shallow_record_filename(repo_name))
+        self._share_objects(repo_name)
+
+    #
+    # Object pool
+    #
+    # Every bare repository borrows objects from the pool repository
+    # GIT_POOL_NAME through objects/info/alternates, so that a commit
+    # fetched under one repo_name (a fork, a submodule, another name for
+    # the same upstream) is present under all of them, and fetches only
+    # transfer the objects missing from the pool (git offers the refs of
+    # alternates as common commits when negotiating). After each fetch
+    # the inuse/* branches of the repository are fetched into the pool
+    # as refs/names/<repo_name>/inuse/*, and the repository is repacked
+    # without the objects now found in the pool. The refs keep the
+    # objects alive in the pool for as long as the repository marks
+    # them in use; removing the repository removes its refs, and the
+    # objects only referenced by them are left for 'hit gc-sources' to
+    # prune once they have been unreachable for pool_prune_expire, since
+    # other processes may be negotiating against them.
+    #
+    # Shallow repositories are not shared, as the pool would then claim
+    # commits whose parents it lacks to everybody fetching against it.
+    #
+
+    def _fetch_from_sibling(self, repo_name, commit):
+        # A commit that is not in the pool, as it was fetched shallowly
+        # under another repo_name, is at least not downloaded again
+        sibling = self._lookup_commit(commit)
+        if (sibling is None or sibling == repo_name or
+                not os.path.isdir(self.get_bare_repo_path(sibling)) or
+                not self._has_commit(sibling, commit)):
+            return False
+        self.logger.info('Fetching git:%s from %s' % (commit, sibling))
+        self._fetch_local(repo_name, self, sibling, commit)
+        return True
+
+    def _write_alternates(self, repo_path):
+        if not os.path.exists(self.get_bare_repo_path(GIT_POOL_NAME)):
+            self._create_bare_repo(GIT_POOL_NAME)
+        # relative to the objects directory, so that the cache can be moved
+        filename = pjoin(repo_path, 'objects', 'info', 'alternates')
+        silent_makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(pjoin('..', '..', GIT_POOL_NAME, 'objects') + '\n')
+
+    def _is_shallow(self, repo_name):
+        return os.path.exists(pjoin(self.get_bare_repo_path(repo_name), 'shallow'))
+
+    def _get_pool_ref(self, repo_name, commit):
+        return 'refs/names/%s/inuse/%s' % (repo_name, commit)
+
+    def _ensure_pool_ref(self, repo_name, commit):
+        # The commit may be present only through the pool, under the refs
+        # of another repository; refer to it from this one too. Fails
+        # (harmlessly) if it is only present in the repository itself,
+        # in which case _share_objects takes care of it.
+        ref = self._get_pool_ref(repo_name, commit)
+        if (self.source_cache.read_only or self._is_shallow(repo_name) or
+                not os.path.isdir(self.get_bare_repo_path(GIT_POOL_NAME)) or
+                self._does_ref_exist(GIT_POOL_NAME, ref)):
+            return
+        self.git(GIT_POOL_NAME, 'update-ref', ref, commit)
 
-        # We clone the repo with 'git clone --shared' and check out the hash
+    def _share_objects(self, repo_name):
+        """
+        Moves the objects of the inuse/* branches of `repo_name` into the
+        pool; should be called with the lock of the repository held.
+        Returns whether the repository was shared (and repacked).
+        """
+        if self.source_cache.read_only or self._is_shallow(repo_name):
+            return False
         repo_path = self.get_bare_repo_path(repo_name)
+        if not os.path.exists(pjoin(repo_path, 'objects', 'info', 'alternates')):
+            # created before the pool was introduced
+            self._write_alternates(repo_path)
+        with self.source_cache.lock('git-%s' % GIT_POOL_NAME):
+            self.checked_git(GIT_POOL_NAME, 'fetch', '--quiet', '--no-tags', repo_path,
+                             '+refs/heads/inuse/*:%s' % self._get_pool_ref(repo_name, '*'))
+            if self._count_fetch(GIT_POOL_NAME):
+                self._maintain_locked(GIT_POOL_NAME)
+        # -l leaves out the objects found in the pool
+        self.checked_git(repo_name, 'repack', '-a', '-d', '-l', '-q')
+        return True
+
+    def _unshare_objects(self, repo_name):
+        """
+        Removes the refs the pool holds on behalf of `repo_name`
+        """
+        if not os.path.isdir(self.get_bare_repo_path(GIT_POOL_NAME)):
+            return
+        with self.source_cache.lock('git-%s' % GIT_POOL_NAME):
+            out = self.checked_git(GIT_POOL_NAME, 'for-each-ref', '--format=%(refname)',
+                                   'refs/names/%s/' % repo_name)
+            for ref in out.split():
+                self.checked_git(GIT_POOL_NAME, 'update-ref', '-d', ref)
+
+    #
+    # Maintenance
+    #
+    # Each fetch leaves an inuse/* branch and some loose objects (or a
+    # small pack) behind, and unpacking creates and deletes tempmark/*
+    # branches; over time every git call gets slower. Maintenance packs
+    # the refs and objects of a repository and writes its commit-graph.
+    # It runs under the lock of the repository (the pool's for the
+    # pool), either from 'hit maintain-sources' or automatically after
+    # every SourceCache.git_maintain_after fetches.
+    #
+
+    def _count_fetch(self, repo_name):
+        # Counts a fetch into repo_name, with its lock held; returns
+        # whether it is time to maintain it
+        n = self.source_cache.git_maintain_after
+        if not n or self.source_cache.read_only:
+            return False
+        filename = pjoin(self.get_bare_repo_path(repo_name), 'hashdist-fetch-count')
+        try:
+            with open(filename) as f:
+                count = int(f.read().strip() or 0)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            count = 0
+        except ValueError:
+            count = 0
+        count += 1
+        due = count >= n
+        with open(filename, 'w') as f:
+            f.write('%d\n' % (0 if due else count))
+        return due
+
+    def _after_fetch(self, repo_name):
+        if self._count_fetch(repo_name):
+            self._maintain_locked(repo_name)
+        else:
+            self._share_objects(repo_name)
+
+    def _maintain_locked(self, repo_name, prune=False):
+        self.logger.debug('Maintaining git repository %s' % repo_name)
+        self.checked_git(repo_name, 'pack-refs', '--all', '--prune')
+        if repo_name == GIT_POOL_NAME:
+            if prune:
+                # unreachable objects are dropped once they are old enough,
+                # and the newer ones kept loose until they are
+                expire = self.pool_prune_expire
+                self.checked_git(repo_name, 'repack', '-a', '-d', '-q',
+                                 '--unpack-unreachable=%s' % expire)
+                self.checked_git(repo_name, 'prune', '--expire=%s' % expire)
+            else:
+                # other processes may be negotiating against objects that
+                # were only referenced by a repository removed meanwhile
+                self.checked_git(repo_name, 'repack', '-a', '-d', '-q', '--keep-unreachable')
+        elif not self._share_objects(repo_name):
+            self.checked_git(repo_name, 'repack', '-a', '-d', '-l', '-q')
+        # not available in old git versions, and skipped for shallow repositories
+        retcode, out, err = self.git(repo_name, 'commit-graph', 'write', '--reachable')
+        if retcode != 0:
+            self.logger.debug('Not writing commit-graph of %s: %s' % (repo_name, err.strip()))
+
+    def maintain_repo(self, repo_name, prune=False):
+        """
+        Packs the refs and objects of the bare repository `repo_name`;
+        see :meth:`SourceCache.maintain`.
+        """
+        with self.source_cache.lock('git-%s' % repo_name):
+            self._maintain_locked(repo_name, prune)
+
+    def prune_pool(self):
+        """Removes the objects of the pool that no repository has used
+        for `pool_prune_expire`"""
+        if os.path.isdir(self.get_bare_repo_path(GIT_POOL_NAME)):
+            self.maintain_repo(GIT_POOL_NAME, prune=True)
+
+    def maintain(self, jobs=None, prune_pool=False):
+        repo_names = self._list_repo_names()
+        if repo_names:
+            jobs = jobs if jobs is not None else multiprocessing.cpu_count()
+            pool = ThreadPool(max(1, min(jobs, len(repo_names))))
+            try:
+                pool.map_async(self.maintain_repo, repo_names).get(2**31)
+            finally:
+                pool.close()
+                pool.join()
+        # last, as maintaining the repositories brings its refs up to date
+        if os.path.isdir(self.get_bare_repo_path(GIT_POOL_NAME)):
+            self.maintain_repo(GIT_POOL_NAME, prune_pool)
+
+    def unpack(self, type, hash, target_path):
+        assert type == 'git'
+
+        # We don't want to require supplying a repo name, so look the
+        # commit up in the index
+        try:
+            repo_name = self._find_repo_name(hash)
+        except KeyNotFoundError:
+            if not self.source_cache.tiers:
+                raise
+            repo_name = self._find_repo_name_in_tiers(hash)
+            self.fetch_git(None, None, repo_name, hash)
+        self.source_cache.record_access('git', repo_name)
 
-        with self._marked_commit(repo_name, hash) as branch:
-            with working_directory(target_path):
-                self.checked_git(None, 'init')
-                self.checked_git(None, 'fetch', repo_path, branch)
-                self.checked_git(None, 'checkout', hash)
+        if self.unpack_mode == 'archive':
+            self._archive_commit(repo_name, hash, target_path)
+            return
+
+        # Fetch the commit into a fresh repository in target_path through
+        # its inuse/* branch, and check it out
+        repo_path = self.get_bare_repo_path(repo_name)
+        if hash not in self._list_inuse_commits(repo_name):
+            self._mark_commit_as_in_use(repo_name, hash)
+        with working_directory(target_path):
+            self.checked_git(None, 'init')
+            self.checked_git(None, 'fetch', repo_path, 'inuse/%s' % hash)
+            self.checked_git(None, 'checkout', hash)
 
         # Check out any submodules:
         # a) Pare .gitmodules
@@ -565,6 +1427,46 @@ class GitSourceCache(object):
                     self.checked_git(None, 'config', 'submodule.%s.url' % key, self.get_bare_repo_path(submod['name']))
                 self.checked_git(None, 'submodule', 'update', '--init')
 
+    def _archive_commit(self, repo_name, commit, target_path):
+        # Stream 'git archive' of the commit straight from the bare repo
+        # into a staging directory, then move it into place.
+        # --worktree-attributes makes git ignore the .gitattributes in the
+        # tree (there is no worktree), so that export-ignore and
+        # export-subst do not alter the sources.
+        import tarfile
+        target_path = os.path.abspath(target_path)
+        silent_makedirs(target_path)
+        with staging_dir(target_path) as staging:
+            with tempfile.TemporaryFile() as err:
+                p = subprocess.Popen(['git', 'archive', '--format=tar', '--worktree-attributes',
+                                      commit],
+                                     env=self.get_repo_env(repo_name), stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=err)
+                p.stdin.close()
+                tar_error = None
+                try:
+                    with closing(tarfile.open(fileobj=p.stdout, mode='r|')) as archive:
+                        archive.extractall(staging)
+                except tarfile.TarError, e:
+                    # report the git failure instead, if any
+                    tar_error = e
+                finally:
+                    p.stdout.close()
+                    retcode = p.wait()
+                if tar_error is not None and retcode == 0:
+                    raise tar_error
+                elif retcode != 0:
+                    err.seek(0)
+                    msg = 'git archive of %s in %s failed with code %d:\n%s' % (
+                        commit, repo_name, retcode, err.read())
+                    self.logger.error(msg)
+                    raise RuntimeError(msg)
+            publish_tree(staging, target_path, replace=True)
+
+        for submod, submod_commit in self._get_submodules(repo_name, commit):
+            self._archive_commit(submod['name'], submod_commit,
+                                 pjoin(target_path, submod['path']))
+
     #
     # Submodule support
     #
@@ -601,12 +1503,15 @@ class GitSourceCache(object):
             submod['name'] = root_repo_name + '.' + submod['path'].replace('/', '.').replace('\\', '.')
         return submodules
 
-    def _fetch_submodules(self, repo_name, repo_url, commit):
+    def _get_submodules(self, repo_name, commit):
+        # Returns [(submod, commit_hash)] for the submodules of `commit`
+        # (see _parse_submodule_config for submod)
+
         # use 'git show' to extract .gitmodules from the right commit
         retcode, out, err = self.git(repo_name, 'show', '%s:.gitmodules' % commit)
         if retcode != 0:
             # No .gitmodules found
-            return
+            return []
         # the 'git config' tool needs to read the input from a file though...
         temp_dir = tempfile.mkdtemp()
         try:
@@ -617,111 +1522,1163 @@ class GitSourceCache(object):
         finally:
             shutil.rmtree(temp_dir)
 
-        # Recursively fetch the submodules. We need to look up the
-        # commit using 'git ls-tree', since 'git submodule status'
-        # doesn't work on bare repositories.
+        # We need to look up the commit using 'git ls-tree', since 'git
+        # submodule status' doesn't work on bare repositories.
+        result = []
         for submod in submodules.values():
             out = self.checked_git(repo_name, 'ls-tree', commit, submod['path'])
             mode, type, commit_hash, file = out.split()
             if type != 'commit':
-                msg = 'Expected a submodule, not a %s at %s' (type, submod['path'])
+                msg = 'Expected a submodule, not a %s at %s' % (type, submod['path'])
                 self.logger.error(msg)
                 raise RuntimeError(msg)
+            result.append((submod, commit_hash))
+        return result
+
+    def _fetch_submodules(self, repo_name, repo_url, commit):
+        # Recursively fetch the submodules
+        for submod, commit_hash in self._get_submodules(repo_name, commit):
             # safely turn relative URLs into absolute URLs (idempotent on absolute URLs)
-            absolute_submod_url = urlparse.urljoin(repo_url+'/', submod['url'])
+            if repo_url is None:
+                # fetched from a tier, where the submodules are expected too
+                absolute_submod_url = submod['url']
+            else:
+                absolute_submod_url = urlparse.urljoin(repo_url+'/', submod['url'])
             self.fetch_git(absolute_submod_url, rev=None, repo_name=submod['name'], commit=commit_hash)
 
 
-SIMPLE_FILE_URL_RE = re.compile(r'^file:/?[^/]+.*$')
+class ExtractedTreeCache(object):
+    # Group together methods for working with the cache of extracted
+    # source trees (see :class:`SourceCache`).
+    #
+    # The first unpack of a key extracts it (through the normal, verifying
+    # handler) to ``extracted/<type>/<hash>``, which is then write-protected;
+    # git trees differ between unpack modes, so their <type> is
+    # ``git-checkout`` or ``git-archive``.
+    # Unpacks populate the target from that tree, so archives are only
+    # decompressed once. A sidecar ``<hash>.json`` records the size of each
+    # tree, and its mtime records when the tree was last used; the least
+    # recently used trees are evicted when the total exceeds `max_bytes`.
 
-class ArchiveSourceCache(object):
-    # Group together methods for working with the part of the source
-    # cache stored as archives.
+    def __init__(self, source_cache):
+        self.extracted_path = pjoin(source_cache.cache_path, EXTRACTED_DIRNAME)
+        self.logger = source_cache.logger
+        self.max_bytes = source_cache.extracted_max_bytes
+        self.hardlink = source_cache.hardlink_extracted
+        self.copy_methods = ['reflink', 'copy_file_range']
+        self.git_unpack = source_cache.git_unpack
+
+    def get_tree_type(self, type):
+        """The <type> directory of the extracted trees of sources of `type`"""
+        return 'git-%s' % self.git_unpack if type == 'git' else type
+
+    def get_tree_path(self, type, hash):
+        return pjoin(self.extracted_path, type, hash)
+
+    def _get_info_filename(self, type, hash):
+        return pjoin(self.extracted_path, type, hash + '.json')
+
+    def unpack(self, handler, type, hash, target_path):
+        tree_type = self.get_tree_type(type)
+        tree = self.get_tree_path(tree_type, hash)
+        if not os.path.exists(tree):
+            self._materialize(handler, type, tree_type, hash)
+        try:
+            self._populate(tree, target_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT or os.path.exists(tree):
+                raise
+            # evicted by somebody else while we used it
+            self.logger.debug('Extracted tree %s:%s evicted during unpack' % (tree_type, hash))
+            handler.unpack(type, hash, target_path)
+        else:
+            try:
+                os.utime(self._get_info_filename(tree_type, hash), None)
+            except OSError:
+                pass
+
+    def _materialize(self, handler, type, tree_type, hash):
+        type_dir = pjoin(self.extracted_path, tree_type)
+        silent_makedirs(type_dir)
+        temp_tree = tempfile.mkdtemp(prefix='.extracting-', dir=type_dir)
+        try:
+            handler.unpack(type, hash, temp_tree)
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(temp_tree, topdown=False):
+                for name in filenames + dirnames:
+                    path = pjoin(dirpath, name)
+                    st = os.lstat(path)
+                    size += st.st_size
+                    if not stat.S_ISLNK(st.st_mode):
+                        os.chmod(path, stat.S_IMODE(st.st_mode) & ~0o222)
+            os.chmod(temp_tree, 0o555)
+            with open(self._get_info_filename(tree_type, hash), 'w') as f:
+                json.dump({'size': size}, f)
+            try:
+                os.rename(temp_tree, self.get_tree_path(tree_type, hash))
+            except OSError, e:
+                # somebody else materialized it at the same time
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if os.path.exists(temp_tree):
+                rmtree_write_protected(temp_tree)
+        self.evict(keep=[(tree_type, hash)])
+
+    def _populate(self, src, dst):
+        if not os.path.isdir(dst):
+            os.mkdir(dst)
+        for name in os.listdir(src):
+            s = pjoin(src, name)
+            d = pjoin(dst, name)
+            st = os.lstat(s)
+            if stat.S_ISDIR(st.st_mode):
+                if not os.path.isdir(d) or os.path.islink(d):
+                    if os.path.lexists(d):
+                        os.unlink(d)
+                    os.mkdir(d, 0o700)
+                self._populate(s, d)
+                os.chmod(d, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+                continue
+            if os.path.lexists(d):
+                os.unlink(d)
+            if stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(s), d)
+                continue
+            if self.hardlink:
+                try:
+                    os.link(s, d)
+                except OSError, e:
+                    if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                        raise
+                else:
+                    continue
+            copy_file_contents(s, d, stat.S_IMODE(st.st_mode) | stat.S_IWUSR, self.copy_methods)
+            # keep timestamps, so that build systems do not consider
+            # generated files in the sources out of date
+            os.utime(d, (st.st_atime, st.st_mtime))
+
+    def list_trees(self):
+        """Returns a list of ``(last_used, size, type, hash)`` for all trees"""
+        result = []
+        try:
+            types = os.listdir(self.extracted_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            types = []
+        for type in types:
+            for fname in os.listdir(pjoin(self.extracted_path, type)):
+                if not fname.endswith('.json'):
+                    continue
+                hash = fname[:-len('.json')]
+                info_filename = pjoin(self.extracted_path, type, fname)
+                try:
+                    with open(info_filename) as f:
+                        size = json.load(f)['size']
+                    last_used = os.stat(info_filename).st_mtime
+                except (IOError, OSError, ValueError, KeyError):
+                    continue
+                result.append((last_used, size, type, hash))
+        return result
+
+    def evict(self, keep=(), max_bytes=None):
+        """Removes least recently used trees until the total size is at most `max_bytes`
+
+        Returns the number of bytes freed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        trees = sorted(self.list_trees())
+        total = sum(size for last_used, size, type, hash in trees)
+        freed = 0
+        for last_used, size, type, hash in trees:
+            if total <= max_bytes:
+                break
+            if (type, hash) in keep:
+                continue
+            self.remove(type, hash)
+            total -= size
+            freed += size
+        return freed
+
+    def remove(self, type, hash):
+        tree = self.get_tree_path(type, hash)
+        self.logger.debug('Removing extracted tree %s:%s' % (type, hash))
+        silent_unlink(self._get_info_filename(type, hash))
+        # rename first, so that the tree disappears atomically for other processes
+        trash = tempfile.mkdtemp(prefix='.removing-', dir=os.path.dirname(tree))
+        try:
+            os.rename(tree, pjoin(trash, hash))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        rmtree_write_protected(trash)
 
-    chunk_size = 16 * 1024
 
+class SourceCacheGC(object):
+    # Group together methods for garbage collecting the source cache
+    # (see SourceCache.gc). Archives and hit-packs are collected per key,
+    # git sources per bare repository. Extracted trees count towards the
+    # size of the item they were extracted from and go with it; those of
+    # git commits no repository holds any more are removed by each run.
 
     def __init__(self, source_cache):
-        assert not isinstance(source_cache, str)
         self.source_cache = source_cache
-        self.files_path = source_cache.cache_path
-        self.packs_path = source_cache._ensure_subdir(PACKS_DIRNAME)
-        self.mirrors = source_cache.mirrors
-        self.logger = self.source_cache.logger
-
-    def get_pack_filename(self, type, hash):
-        d = self.files_path if type == 'files' else self.packs_path
-        type_dir = pjoin(d, type)
-        mkdir_if_not_exists(type_dir)
-        return pjoin(type_dir, hash)
-
-    def _download_and_hash(self, url, type):
-        """Downloads file at url to a temporary location and hashes it
-
-        Returns
-        -------
+        self.cache_path = source_cache.cache_path
+        self.logger = source_cache.logger
 
-        temp_file, digest
-        """
-        # Provide a special case for local files
-        use_urllib = not SIMPLE_FILE_URL_RE.match(url)
-        if not use_urllib:
-            try:
-                stream = open(url[len('file:'):])
-            except IOError as e:
-                raise SourceNotFoundError(str(e))
-        else:
-            # Make request.
-            sys.stderr.write('Downloading %s...\n' % url)
+    def _get_access_time(self, type, name, path):
+        for filename in [pjoin(self.cache_path, ACCESS_DIRNAME, type, name), path]:
             try:
-                stream = urllib2.urlopen(url)
-            except urllib2.HTTPError, e:
-                msg = "urllib failed to download (code: %d): %s" % (e.code, url)
-                self.logger.error(msg)
-                raise RemoteFetchError(msg)
-            except urllib2.URLError, e:
-                msg = "urllib failed to download (reason: %s): %s" % (e.reason, url)
-                self.logger.error(msg)
-                raise RemoteFetchError(msg)
+                return os.stat(filename).st_mtime
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return None
 
-        # Download file to a temporary file within self.packs_path, while hashing
-        # it.
-        self.logger.info("Downloading '%s'" % url)
-        temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.packs_path)
+    def _listdir(self, path):
+        try:
+            return os.listdir(path)
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return []
+
+    def list_items(self):
+        """Returns a list of ``(last_access, nbytes, type, name)`` for all items"""
+        candidates = []
+        packs_path = pjoin(self.cache_path, PACKS_DIRNAME)
+        for type in self._listdir(packs_path):
+            if type in archive_types:
+                for hash in self._listdir(pjoin(packs_path, type)):
+                    candidates.append((type, hash, pjoin(packs_path, type, hash)))
+        for hash in self._listdir(pjoin(self.cache_path, 'files')):
+            candidates.append(('files', hash, pjoin(self.cache_path, 'files', hash)))
+        git_path = pjoin(self.cache_path, GIT_DIRNAME)
+        for repo_name in self._listdir(git_path):
+            candidates.append(('git', repo_name, pjoin(git_path, repo_name)))
+
+        trees = self._list_trees_by_item()
+        result = []
+        for type, name, path in candidates:
+            if name.startswith('.'):
+                continue # temporary files
+            last_access = self._get_access_time(type, name, path)
+            if last_access is None:
+                continue # removed meanwhile
+            nbytes = get_disk_usage(path) + sum(size for _, _, size in trees.get((type, name), []))
+            result.append((last_access, nbytes, type, name))
+        return result
+
+    def _list_trees_by_item(self):
+        # Returns a dict mapping ``(type, name)`` of items to lists of
+        # ``(tree_type, hash, size)`` of the trees extracted from them; the
+        # trees of git commits that are in no repository are under `None`
+        git_cache = GitSourceCache(self.source_cache)
+        result = {}
+        for last_used, size, tree_type, hash in ExtractedTreeCache(self.source_cache).list_trees():
+            if tree_type.startswith('git-'):
+                try:
+                    item = ('git', git_cache._find_repo_name(hash))
+                except KeyNotFoundError:
+                    item = None
+            else:
+                item = (tree_type, hash)
+            result.setdefault(item, []).append((tree_type, hash, size))
+        return result
+
+    def remove_orphaned_trees(self):
+        """Removes the extracted trees of git commits no repository holds
+        any more (e.g., because it was removed)"""
+        extracted = ExtractedTreeCache(self.source_cache)
+        for tree_type, hash, size in self._list_trees_by_item().get(None, []):
+            self.logger.info('Removing extracted tree %s:%s (%d bytes)' % (tree_type, hash, size))
+            extracted.remove(tree_type, hash)
+
+    def get_pool_size(self):
+        """The disk usage of the git object pool, which is not an item
+        itself but shrinks when repositories are removed"""
+        return get_disk_usage(pjoin(self.cache_path, GIT_DIRNAME, GIT_POOL_NAME))
+
+    def _find_kept_repos(self, commits, repo_names):
+        git_cache = GitSourceCache(self.source_cache)
+        roots = set()
+        for commit in commits:
+            try:
+                roots.add(git_cache._find_repo_name(commit))
+            except KeyNotFoundError:
+                pass
+        return set(name for name in repo_names
+                   if name in roots or any(name.startswith(root + '.') for root in roots))
+
+    def run(self, keep_keys=(), max_bytes=None, max_age=None, dry_run=False):
+        items = self.list_items()
+        keep = set()
+        commits = []
+        for key in keep_keys:
+            type, hash = key.split(':')
+            if type == 'git':
+                commits.append(hash)
+            else:
+                keep.add((type, hash))
+        kept_repos = self._find_kept_repos(commits, [name for _, _, type, name in items
+                                                     if type == 'git'])
+        keep.update(('git', name) for name in kept_repos)
+
+        now = time.time()
+        victims = []
+        candidates = []
+        for item in sorted(items):
+            last_access, nbytes, type, name = item
+            if (type, name) in keep:
+                continue
+            if max_age is not None and now - last_access > max_age:
+                victims.append(item)
+            else:
+                candidates.append(item)
+        pool_size = self.get_pool_size()
+        total = (sum(item[1] for item in items) + pool_size -
+                 sum(item[1] for item in victims))
+        if max_bytes is not None:
+            for item in candidates:
+                if total <= max_bytes:
+                    break
+                victims.append(item)
+                total -= item[1]
+            if total > max_bytes:
+                self.logger.warning('Source cache is still %d bytes over quota; the remaining '
+                                    'sources are in use' % (total - max_bytes))
+
+        for last_access, nbytes, type, name in victims:
+            self.logger.info('%s %s:%s (%d bytes)' % ('Would remove' if dry_run else 'Removing',
+                                                      type, name, nbytes))
+            if not dry_run:
+                self.remove(type, name)
+        if not dry_run:
+            self.remove_orphaned_trees()
+        if not dry_run and pool_size:
+            GitSourceCache(self.source_cache).prune_pool()
+            freed = pool_size - self.get_pool_size()
+            if freed > 0:
+                self.logger.info('Pruned %d bytes from the git object pool' % freed)
+        return victims
+
+    def remove(self, type, name):
+        if type == 'git':
+            git_cache = GitSourceCache(self.source_cache)
+            git_cache._unshare_objects(name)
+            path = git_cache.get_bare_repo_path(name)
+        else:
+            path = ArchiveSourceCache(self.source_cache).get_pack_filename(type, name)
+            silent_unlink(pjoin(self.cache_path, VERIFIED_DIRNAME, type, name))
+            extracted = ExtractedTreeCache(self.source_cache)
+            if os.path.exists(extracted.get_tree_path(type, name)):
+                extracted.remove(type, name)
+        # rename first, so that the item disappears atomically for other processes
+        trash = tempfile.mkdtemp(prefix='.removing-', dir=os.path.dirname(path))
         try:
-            f = os.fdopen(temp_fd, 'wb')
-            tee = HashingWriteStream(hashlib.sha256(), f)
-            if use_urllib:
-                if 'Content-Length' in stream.headers:
-                    progress = ProgressBar(int(stream.headers["Content-Length"]))
+            os.rename(path, pjoin(trash, name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        rmtree_write_protected(trash)
+        silent_unlink(pjoin(self.cache_path, ACCESS_DIRNAME, type, name))
+
+
+def _verify_pack_file(args):
+    # Runs in the worker processes of SourceCacheVerifier; returns
+    # (type, hash, error message or None, stat of the file before reading)
+    type, hash, filename = args
+    try:
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if type == 'files':
+                with closing(HitPackReader(f)) as pack:
+                    pack.verify('files:%s' % hash)
+            else:
+                hasher = hashlib.sha256()
+                while True:
+                    buf = f.read(1024 * 1024)
+                    if not buf:
+                        break
+                    hasher.update(buf)
+                if format_digest(hasher) != hash:
+                    raise CorruptSourceCacheError('archive does not match key "%s:%s"'
+                                                  % (type, hash))
+    except (IOError, OSError, CorruptSourceCacheError), e:
+        return type, hash, str(e), None
+    return type, hash, None, st
+
+
+class SourceCacheVerifier(object):
+    # Group together methods for checking the integrity of the whole
+    # source cache (see SourceCache.verify). Packs are re-hashed in a
+    # process pool, bare git repositories are checked with
+    # ``git fsck --connectivity-only`` from a thread pool.
+
+    def __init__(self, source_cache, jobs=None):
+        self.source_cache = source_cache
+        self.cache_path = source_cache.cache_path
+        self.logger = source_cache.logger
+        self.jobs = jobs if jobs is not None else multiprocessing.cpu_count()
+
+    def _listdir(self, path):
+        return SourceCacheGC(self.source_cache)._listdir(path)
+
+    def list_packs(self):
+        """Returns a list of ``(type, hash, filename)`` for all packs"""
+        result = []
+        packs_path = pjoin(self.cache_path, PACKS_DIRNAME)
+        for type in sorted(self._listdir(packs_path)):
+            if type in archive_types:
+                for hash in sorted(self._listdir(pjoin(packs_path, type))):
+                    if not hash.startswith('.'):
+                        result.append((type, hash, pjoin(packs_path, type, hash)))
+        files_path = pjoin(self.cache_path, 'files')
+        for hash in sorted(self._listdir(files_path)):
+            if not hash.startswith('.'):
+                result.append(('files', hash, pjoin(files_path, hash)))
+        return result
+
+    def verify_packs(self, packs):
+        """Returns a list of ``(type, hash, message)`` for the corrupt packs
+
+        Packs that verify have their verification record updated, so
+        that the next unpack does not hash them again.
+        """
+        if not packs:
+            return []
+        if self.jobs > 1 and len(packs) > 1:
+            pool = multiprocessing.Pool(min(self.jobs, len(packs)))
+            try:
+                results = pool.map_async(_verify_pack_file, packs, chunksize=1).get(2**31)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = map(_verify_pack_file, packs)
+
+        archives = ArchiveSourceCache(self.source_cache)
+        corrupt = []
+        for type, hash, error, st in results:
+            if error is not None:
+                corrupt.append((type, hash, error))
+            elif type != 'files':
+                try:
+                    archives._record_verified(type, hash, st)
+                except (IOError, OSError), e:
+                    if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                        raise
+        return corrupt
+
+    def _fsck(self, repo_name):
+        git_cache = GitSourceCache(self.source_cache)
+        retcode, out, err = git_cache.git(repo_name, 'fsck', '--connectivity-only',
+                                          '--no-progress')
+        if retcode != 0:
+            return repo_name, (err or out).strip() or 'git fsck failed with code %d' % retcode
+        return repo_name, None
+
+    def verify_repos(self, repo_names):
+        """Returns a list of ``('git', repo_name, message)`` for the broken repositories"""
+        if not repo_names:
+            return []
+        pool = ThreadPool(max(1, min(self.jobs, len(repo_names))))
+        try:
+            results = pool.map_async(self._fsck, repo_names).get(2**31)
+        finally:
+            pool.close()
+            pool.join()
+        return [('git', repo_name, error) for repo_name, error in results if error is not None]
+
+    def find_orphans(self, packs, repo_names):
+        """Returns a list of ``(type, name, path)`` for bookkeeping files
+        (verification records, extracted trees and access times) whose
+        source item is no longer in the cache.
+        """
+        present = set((type, hash) for type, hash, filename in packs)
+        present.update(('git', name) for name in repo_names)
+        orphans = []
+        for dirname in [VERIFIED_DIRNAME, ACCESS_DIRNAME, EXTRACTED_DIRNAME]:
+            path = pjoin(self.cache_path, dirname)
+            for type in sorted(self._listdir(path)):
+                for name in sorted(self._listdir(pjoin(path, type))):
+                    if name.startswith('.'):
+                        continue # temporary files
+                    item = name[:-len('.json')] if name.endswith('.json') else name
+                    if (type, item) not in present:
+                        orphans.append((type, item, pjoin(path, type, name)))
+        return orphans
+
+    def run(self, quarantine=False):
+        packs = self.list_packs()
+        repo_names = GitSourceCache(self.source_cache)._list_repo_names()
+        self.logger.info('Verifying %d packs and %d git repositories' %
+                         (len(packs), len(repo_names)))
+        problems = []
+        for type, name, message in self.verify_packs(packs) + self.verify_repos(repo_names):
+            self.logger.error('Corrupt source item %s:%s: %s' % (type, name, message))
+            problems.append(('corrupt', type, name, message))
+        if quarantine:
+            quarantined = set((type, name) for _, type, name, _ in problems)
+            for type, name in sorted(quarantined):
+                self.quarantine(type, name)
+            # so that their bookkeeping is cleaned up right away
+            packs = [pack for pack in packs if pack[:2] not in quarantined]
+            repo_names = [name for name in repo_names if ('git', name) not in quarantined]
+        for type, name, path in self.find_orphans(packs, repo_names):
+            self.logger.warning('Orphaned %s' % path)
+            problems.append(('orphaned', type, name, path))
+            if quarantine:
+                # these only hold information derived from the item itself
+                if os.path.isdir(path):
+                    rmtree_write_protected(path)
                 else:
-                    progress = ProgressSpinner()
+                    silent_unlink(path)
+        return problems
+
+    def quarantine(self, type, name):
+        """Moves a source item to ``quarantine/<type>/`` in the cache"""
+        if type == 'git':
+            git_cache = GitSourceCache(self.source_cache)
+            git_cache._unshare_objects(name)
+            path = git_cache.get_bare_repo_path(name)
+        else:
+            path = ArchiveSourceCache(self.source_cache).get_pack_filename(type, name)
+        quarantine_dir = pjoin(self.cache_path, QUARANTINE_DIRNAME, type)
+        silent_makedirs(quarantine_dir)
+        target = tempfile.mkdtemp(prefix='%s-' % name, dir=quarantine_dir)
+        self.logger.warning('Moving %s:%s to %s' % (type, name, target))
+        try:
+            os.rename(path, pjoin(target, name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        alternates = pjoin(target, name, 'objects', 'info', 'alternates')
+        if type == 'git' and os.path.exists(alternates):
+            # the relative path to the pool does not hold from the quarantine;
+            # the objects stay there until the pool is next pruned
+            with open(alternates, 'w') as f:
+                f.write(pjoin(git_cache.get_bare_repo_path(GIT_POOL_NAME), 'objects') + '\n')
+        # the rest of the bookkeeping of the item is cleaned up as orphaned
+        if type != 'git':
+            silent_unlink(pjoin(self.cache_path, VERIFIED_DIRNAME, type, name))
+            extracted = ExtractedTreeCache(self.source_cache)
+            if os.path.exists(extracted.get_tree_path(type, name)):
+                extracted.remove(type, name)
+
+
+def get_disk_usage(path):
+    """Returns the total size in bytes of the file or directory tree at `path`"""
+    try:
+        st = os.lstat(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+    total = st.st_size
+    if stat.S_ISDIR(st.st_mode):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                try:
+                    total += os.lstat(pjoin(dirpath, name)).st_size
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+    return total
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+class MirrorStats(object):
+    """
+    Health statistics of source cache mirrors, persisted in a
+    :class:`~hashdist.core.cache.DiskCache` (with the class as the domain).
+
+    For each mirror URL we keep exponentially weighted averages of the
+    probe latency and download throughput, the number of attempts and
+    failures, and the number of consecutive failures. A mirror that
+    failed `bench_after` times in a row is skipped for a period which
+    doubles with each further failure (up to a day), after which it is
+    tried again.
+
+    Entries are updated while holding `lock` (by default, a lock private
+    to this object), which should be a :class:`~hashdist.core.fileutils.FileLock`
+    when processes share the cache, so that no update is lost.
+    """
+    smoothing = 0.3
+    bench_after = 2
+    bench_seconds = 60
+    max_bench_seconds = 24 * 3600
+
+    def __init__(self, cache, lock=None):
+        self.cache = cache
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def get(self, mirror):
+        return self.cache.get(MirrorStats, mirror, None) or {
+            'latency': None, 'throughput': None, 'attempts': 0, 'failures': 0,
+            'consecutive_failures': 0, 'last_failure': None}
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return (1 - self.smoothing) * old + self.smoothing * new
+
+    @contextlib.contextmanager
+    def _updating(self, mirror):
+        # Yields a copy of the entry of `mirror` as on disk, and stores it
+        # afterwards, with the lock held throughout
+        with self.lock:
+            self.cache.forget(MirrorStats, mirror)
+            s = dict(self.get(mirror))
+            yield s
+            self.cache.put(MirrorStats, mirror, s)
+
+    def record_success(self, mirror, latency=None, nbytes=None, seconds=None):
+        with self._updating(mirror) as s:
+            s['attempts'] += 1
+            s['consecutive_failures'] = 0
+            if latency is not None:
+                s['latency'] = self._average(s['latency'], latency)
+            if nbytes and seconds:
+                s['throughput'] = self._average(s['throughput'], nbytes / seconds)
+
+    def record_failure(self, mirror, now=None):
+        with self._updating(mirror) as s:
+            s['attempts'] += 1
+            s['failures'] += 1
+            s['consecutive_failures'] += 1
+            s['last_failure'] = time.time() if now is None else now
+
+    def is_benched(self, mirror, now=None):
+        s = self.get(mirror)
+        if s['consecutive_failures'] < self.bench_after:
+            return False
+        period = min(self.bench_seconds * 2 ** (s['consecutive_failures'] - self.bench_after),
+                     self.max_bench_seconds)
+        now = time.time() if now is None else now
+        return now < s['last_failure'] + period
+
+    def expected_seconds(self, mirror, size=None):
+        """Rough estimate of how long downloading `size` bytes from `mirror` will take,
+        for ordering mirrors; mirrors we know nothing about come last.
+        """
+        s = self.get(mirror)
+        if s['latency'] is None and s['throughput'] is None:
+            return float('inf')
+        t = s['latency'] or 0.
+        if size is not None and s['throughput']:
+            t += size / s['throughput']
+        failure_rate = float(s['failures']) / s['attempts'] if s['attempts'] else 0.
+        return t * (1 + failure_rate)
+
+
+class RangesNotSupported(Exception):
+    pass
+
+class SegmentedDownloadError(Exception):
+    pass
+
+class SegmentedDownload(object):
+    """
+    Downloads `url`, of `size` bytes, to `filename` as byte ranges fetched
+    by `connections` threads, each over its own persistent HTTP
+    connection. This helps with servers throttling each connection.
+
+    The file is preallocated and each segment is written at its offset
+    as it arrives. :meth:`run` calls `sink` with the contents in order as
+    soon as a prefix of the file is complete (reading it back, usually
+    from the page cache), so that it can be hashed and validated while
+    the rest is downloaded. Failed segments are retried on a new
+    connection; if a server answers a range request with the whole file,
+    :exc:`RangesNotSupported` is raised. After :meth:`run`, `completed`
+    is the number of bytes that were passed to `sink`.
+    """
+    segment_size = 8 * 1024 * 1024
+    chunk_size = 64 * 1024
+    retries = 3
+    timeout = 60
+
+    def __init__(self, url, size, filename, logger, connections=4):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Can not download %s in segments' % url)
+        self.url = url
+        self.size = size
+        self.filename = filename
+        self.logger = logger
+        self._parts = parts
+        self._path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        self._segment_count = max(1, (size + self.segment_size - 1) // self.segment_size)
+        self.connections = max(1, min(connections, self._segment_count))
+        self._lock = threading.Lock()
+        self._next_segment = 0
+        self._done = []
+        self._done_cond = threading.Condition(self._lock)
+        self._error = None
+        self.received = 0
+        self.completed = 0
+
+    def _connect(self):
+        cls = httplib.HTTPSConnection if self._parts.scheme == 'https' else httplib.HTTPConnection
+        return cls(self._parts.hostname, self._parts.port, timeout=self.timeout)
+
+    def _take_segment(self):
+        with self._lock:
+            if self._error is not None or self._next_segment == self._segment_count:
+                return None
+            self._next_segment += 1
+            return self._next_segment - 1
+
+    def _fetch_segment(self, conn, f, start, end):
+        conn.request('GET', self._path, headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+        response = conn.getresponse()
+        try:
+            if response.status == 200:
+                raise RangesNotSupported()
+            content_range = response.getheader('Content-Range', '')
+            if response.status != 206 or not content_range.startswith('bytes %d-%d/' %
+                                                                      (start, end - 1)):
+                raise IOError('unexpected response to range request (%d %s)' %
+                              (response.status, content_range))
+            f.seek(start)
+            pos = start
             try:
-                n = 0
+                while pos < end:
+                    data = response.read(min(self.chunk_size, end - pos))
+                    if not data:
+                        raise IOError('connection closed after %d of %d bytes of segment' %
+                                      (pos - start, end - start))
+                    f.write(data)
+                    pos += len(data)
+                    with self._lock:
+                        self.received += len(data)
+            except:
+                # the segment is fetched again from the start
+                with self._lock:
+                    self.received -= pos - start
+                raise
+        finally:
+            response.close()
+        f.flush()
+
+    def _worker(self):
+        conn = None
+        try:
+            with open(self.filename, 'r+b') as f:
                 while True:
-                    chunk = stream.read(self.chunk_size)
-                    if not chunk: break
-                    if use_urllib:
-                        n += len(chunk)
-                        progress.update(n)
-                    tee.write(chunk)
+                    index = self._take_segment()
+                    if index is None:
+                        break
+                    start = index * self.segment_size
+                    end = min(start + self.segment_size, self.size)
+                    for attempt in range(self.retries):
+                        if conn is None:
+                            conn = self._connect()
+                        try:
+                            self._fetch_segment(conn, f, start, end)
+                            break
+                        except (IOError, socket.error, httplib.HTTPException), e:
+                            conn.close()
+                            conn = None
+                            if attempt == self.retries - 1:
+                                raise
+                            self.logger.debug('Retrying bytes %d-%d of %s: %s' %
+                                              (start, end - 1, self.url, e))
+                    with self._lock:
+                        self._done.append(index)
+                        self._done_cond.notify()
+        except:
+            with self._lock:
+                if self._error is None:
+                    self._error = sys.exc_info()
+                self._done_cond.notify()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def run(self, sink, progress=None):
+        with open(self.filename, 'wb') as f:
+            f.truncate(self.size)
+        threads = [threading.Thread(target=self._worker) for i in range(self.connections)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        completed = set()
+        next_index = 0
+        try:
+            with open(self.filename, 'rb') as f:
+                while next_index < self._segment_count:
+                    with self._lock:
+                        while not self._done and self._error is None:
+                            # with a timeout, so that KeyboardInterrupt gets through
+                            self._done_cond.wait(1)
+                        error = self._error
+                        completed.update(self._done)
+                        del self._done[:]
+                        received = self.received
+                    if progress is not None:
+                        progress.update(received)
+                    while next_index in completed:
+                        f.seek(next_index * self.segment_size)
+                        remaining = min(self.segment_size,
+                                        self.size - next_index * self.segment_size)
+                        while remaining > 0:
+                            data = f.read(min(self.chunk_size, remaining))
+                            if not data:
+                                raise IOError('%s is shorter than expected' % self.filename)
+                            sink.write(data)
+                            remaining -= len(data)
+                        next_index += 1
+                    # raised once the complete prefix went to `sink`
+                    if error is not None:
+                        exc_type, exc_value, exc_tb = error
+                        raise exc_type, exc_value, exc_tb
+        finally:
+            self.completed = min(next_index * self.segment_size, self.size)
+            with self._lock:
+                if self._error is None and next_index < self._segment_count:
+                    self._error = (RuntimeError, RuntimeError('aborted'), None)
+            for thread in threads:
+                thread.join()
+
+
+SIMPLE_FILE_URL_RE = re.compile(r'^file:/?[^/]+.*$')
+
+class ArchiveSourceCache(object):
+    # Group together methods for working with the part of the source
+    # cache stored as archives.
+
+    chunk_size = 16 * 1024
+    mirror_probe_timeout = 10
+    # downloads of at least this size are split over several connections
+    # when the server supports ranges (see SegmentedDownload)
+    segmented_min_size = 64 * 1024 * 1024
+
+    def __init__(self, source_cache):
+        assert not isinstance(source_cache, str)
+        self.source_cache = source_cache
+        self.files_path = source_cache.cache_path
+        if source_cache.read_only:
+            self.packs_path = pjoin(source_cache.cache_path, PACKS_DIRNAME)
+        else:
+            self.packs_path = source_cache._ensure_subdir(PACKS_DIRNAME)
+        self.mirrors = source_cache.mirrors
+        self.logger = self.source_cache.logger
+
+    def get_pack_filename(self, type, hash):
+        d = self.files_path if type == 'files' else self.packs_path
+        type_dir = pjoin(d, type)
+        if not self.source_cache.read_only:
+            mkdir_if_not_exists(type_dir)
+        return pjoin(type_dir, hash)
+
+    #
+    # Tiers
+    #
+    # Packs found in one of the source_cache.tiers are either unpacked
+    # from there, or, if the tier is set to promote, first copied into
+    # this cache (verifying the copy against the key).
+    #
+
+    def _find_tier(self, type, hash):
+        for tier in self.source_cache.tiers:
+            if ArchiveSourceCache(tier).contains(type, hash):
+                return tier
+        return None
+
+    def _use_tier(self, type, hash):
+        """Looks for a pack in the tiers, promoting it if the tier says so
+
+        Returns the tier it was found in, or `None`.
+        """
+        tier = self._find_tier(type, hash)
+        if tier is not None and tier.promote:
+            self._promote(tier, type, hash)
+        return tier
+
+    def _promote(self, tier, type, hash):
+        key = '%s:%s' % (type, hash)
+        with self.source_cache.lock(key.replace(':', '-')):
+            if self.contains(type, hash):
+                return
+            self.logger.info('Copying %s from %s' % (key, tier.cache_path))
+            pack_filename = self.get_pack_filename(type, hash)
+            fd, temp_file = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(pack_filename))
+            try:
+                hasher = hashlib.sha256()
+                with os.fdopen(fd, 'wb') as f:
+                    with ArchiveSourceCache(tier).open_file(type, hash) as src:
+                        tee = HashingWriteStream(hasher, f)
+                        while True:
+                            chunk = src.read(1024 * 1024)
+                            if not chunk:
+                                break
+                            tee.write(chunk)
+                if type == 'files':
+                    with open(temp_file, 'rb') as f:
+                        with closing(HitPackReader(f)) as pack:
+                            pack.verify(key)
+                elif format_digest(hasher) != hash:
+                    raise CorruptSourceCacheError('%s in %s is corrupt' % (key, tier.cache_path))
+                os.chmod(temp_file, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.rename(temp_file, pack_filename)
+                if type != 'files':
+                    self._record_verified(type, hash, os.stat(pack_filename))
             finally:
-                stream.close()
-                f.close()
-                if use_urllib:
-                    progress.finish()
-        except Exception as e:
-            # Remove temporary file if there was a failure
-            os.unlink(temp_path)
-            msg = "Unhandled Exception in Download: %s" % e
+                silent_unlink(temp_file)
+
+    def _get_partial_filename(self, url, expected_hash):
+        h = hashlib.sha256('%s\0%s' % (url, expected_hash))
+        return pjoin(self.packs_path, 'partial-%s' % format_digest(h))
+
+    def _open_url(self, url, offset=0):
+        """Opens `url` for download, starting at byte `offset` (using an HTTP
+        Range request). Returns `None` if the server responded that the range
+        is not satisfiable.
+        """
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            return urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if offset and e.code == 416:
+                return None
+            msg = "urllib failed to download (code: %d): %s" % (e.code, url)
+            self.logger.error(msg)
+            raise RemoteFetchError(msg)
+        except urllib2.URLError, e:
+            msg = "urllib failed to download (reason: %s): %s" % (e.reason, url)
             self.logger.error(msg)
             raise RemoteFetchError(msg)
 
-        if not create_archive_handler(type).verify(temp_path):
+    def _resume_partial(self, url, partial_path, tee):
+        """Writes the existing partial download at `partial_path` to `tee`
+        (for hashing and validating it) and requests the rest from the server.
+
+        Returns (stream, offset); if resuming is not possible the partial download
+        is discarded (and `tee` must be discarded by the caller) and `offset` is 0.
+        """
+        offset = 0
+        try:
+            with open(partial_path, 'rb') as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk: break
+                    tee.write(chunk)
+                    offset += len(chunk)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        if offset == 0:
+            return self._open_url(url), 0
+        stream = self._open_url(url, offset)
+        content_range = stream.headers.get('Content-Range', '') if stream is not None else ''
+        if (stream is not None and stream.getcode() == 206 and
+                content_range.startswith('bytes %d-' % offset)):
+            self.logger.info("Resuming download of '%s' at %d bytes" % (url, offset))
+            return stream, offset
+        # Ranges not supported; a full response can be used as is
+        self.logger.info("Unable to resume download of '%s', starting over" % url)
+        silent_unlink(partial_path)
+        if stream is not None and stream.getcode() == 200:
+            return stream, 0
+        if stream is not None:
+            stream.close()
+        return self._open_url(url), 0
+
+    def _get_segmented_size(self, url, stream):
+        """Returns the size of the download `stream` if it should rather be
+        downloaded in segments (see :class:`SegmentedDownload`), else `None`
+
+        SegmentedDownload talks to the server directly, so downloads through
+        a proxy or with credentials in the URL are left to urllib2.
+        """
+        if self.source_cache.download_connections <= 1 or stream.getcode() != 200:
+            return None
+        parts = urlparse.urlsplit(stream.geturl())
+        if parts.scheme not in ('http', 'https'):
+            return None
+        if '@' in parts.netloc or '@' in urlparse.urlsplit(url).netloc:
+            return None
+        if parts.scheme in urllib.getproxies() and not urllib.proxy_bypass(parts.hostname):
+            return None
+        if stream.headers.get('Accept-Ranges', '').strip().lower() != 'bytes':
+            return None
+        try:
+            size = int(stream.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None
+        return size if size >= self.segmented_min_size else None
+
+    def _download_stream(self, stream, temp_path, offset, hasher, validator, use_urllib,
+                         show_progress):
+        # Appends `stream` to `temp_path`, which has `offset` bytes already
+        f = open(temp_path, 'ab' if offset else 'wb')
+        tee = HashingWriteStream(hasher, f)
+        expected_length = None
+        if use_urllib and 'Content-Length' in stream.headers:
+            expected_length = offset + int(stream.headers["Content-Length"])
+        if show_progress:
+            if expected_length is not None:
+                progress = ProgressBar(expected_length)
+            else:
+                progress = ProgressSpinner()
+        try:
+            n = offset
+            while True:
+                chunk = stream.read(self.chunk_size)
+                if not chunk: break
+                n += len(chunk)
+                if show_progress:
+                    progress.update(n)
+                tee.write(chunk)
+                if validator is not None:
+                    validator.write(chunk)
+        finally:
+            stream.close()
+            f.close()
+            if show_progress:
+                progress.finish()
+        if expected_length is not None and n < expected_length:
+            raise IOError('connection closed after %d of %d bytes' % (n, expected_length))
+
+    def _download_segmented(self, url, size, temp_path, sink, show_progress,
+                            partial_path=None):
+        """Downloads `url` with :class:`SegmentedDownload`. If that fails for
+        lack of connections, raises :exc:`SegmentedDownloadError`, after moving
+        the part of `temp_path` that was complete to `partial_path` (if given)
+        so that the download can be resumed over a single connection.
+        """
+        connections = self.source_cache.download_connections
+        self.logger.info("Downloading '%s' over %d connections" % (url, connections))
+        download = SegmentedDownload(url, size, temp_path, self.logger, connections)
+        progress = ProgressBar(size) if show_progress else None
+        try:
+            download.run(sink, progress)
+        except (IOError, socket.error, httplib.HTTPException), e:
+            if partial_path is not None and download.completed > 0:
+                with open(temp_path, 'r+b') as f:
+                    f.truncate(download.completed)
+                os.rename(temp_path, partial_path)
+            raise SegmentedDownloadError(str(e))
+        finally:
+            if show_progress:
+                progress.finish()
+
+    def _download_and_hash(self, url, type, expected_hash=None, segmented=True):
+        """Downloads file at url to a temporary location and hashes it
+
+        If `expected_hash` is given, downloads over HTTP and the like are
+        written to a partial file whose name is derived from `url` and
+        `expected_hash`, which is left behind if the download fails, and a
+        later call resumes it using a Range request. (It is discarded by
+        :meth:`_download_archive` if the final digest does not match.)
+
+        Large files are downloaded over several connections at once if the
+        server supports it (and `segmented` is set); if that fails, the
+        download continues over a single connection from the part that was
+        complete.
+
+        Tarballs are checked to be valid archives as they are downloaded
+        (see :class:`StreamingValidator`), zip files once they are complete.
+
+        Returns
+        -------
+
+        temp_file, digest
+        """
+        # Provide a special case for local files
+        use_urllib = not SIMPLE_FILE_URL_RE.match(url)
+        resumable = use_urllib and expected_hash is not None
+        handler = create_archive_handler(type)
+        validator = handler.open_validator()
+        segmented_size = None
+        partial_path = None
+        fall_back = False
+        try:
+            hasher = hashlib.sha256()
+            offset = 0
+            if not use_urllib:
+                try:
+                    stream = open(url[len('file:'):])
+                except IOError as e:
+                    raise SourceNotFoundError(str(e))
+            else:
+                # Make request.
+                sys.stderr.write('Downloading %s...\n' % url)
+                if resumable:
+                    temp_path = partial_path = self._get_partial_filename(url, expected_hash)
+                    stream, offset = self._resume_partial(url, temp_path,
+                                                          HashingWriteStream(hasher, validator))
+                    if offset == 0:
+                        hasher = hashlib.sha256()
+                        if validator is not None:
+                            validator.close()
+                            validator = handler.open_validator()
+                else:
+                    stream = self._open_url(url)
+                if segmented and offset == 0:
+                    segmented_size = self._get_segmented_size(url, stream)
+                    if segmented_size is not None:
+                        segmented_url = stream.geturl()
+                        stream.close()
+                        resumable = False
+
+            # Download file to a temporary file within self.packs_path, while hashing
+            # and validating it.
+            self.logger.info("Downloading '%s'" % url)
+            if not resumable:
+                temp_fd, temp_path = tempfile.mkstemp(prefix='downloading-', dir=self.packs_path)
+                os.close(temp_fd)
+            try:
+                show_progress = use_urllib and self.source_cache.show_progress
+                if segmented_size is not None:
+                    self._download_segmented(segmented_url, segmented_size, temp_path,
+                                             HashingWriteStream(hasher, validator), show_progress,
+                                             partial_path)
+                else:
+                    self._download_stream(stream, temp_path, offset, hasher, validator,
+                                          use_urllib, show_progress)
+            except RangesNotSupported:
+                os.unlink(temp_path)
+                self.logger.info("Server of '%s' does not honour ranges, downloading "
+                                 "over a single connection" % url)
+                fall_back = True
+            except SegmentedDownloadError as e:
+                silent_unlink(temp_path)
+                self.logger.warning("Downloading '%s' in segments failed (%s), continuing "
+                                    "over a single connection" % (url, e))
+                fall_back = True
+            except Exception as e:
+                if resumable:
+                    self.logger.info("Keeping partial download for resuming: %s" % temp_path)
+                else:
+                    # Remove temporary file if there was a failure
+                    os.unlink(temp_path)
+                msg = "Unhandled Exception in Download: %s" % e
+                self.logger.error(msg)
+                raise RemoteFetchError(msg)
+
+            if not fall_back:
+                valid = validator.close() if validator is not None else handler.verify(temp_path)
+        finally:
+            if validator is not None:
+                validator.close()
+
+        if fall_back:
+            return self._download_and_hash(url, type, expected_hash, segmented=False)
+        if not valid:
+            silent_unlink(temp_path)
             self.logger.error("File downloaded from '%s' is not a valid archive" % url)
             raise SourceNotFoundError("File downloaded from '%s' is not a valid archive" % url)
 
-        return temp_path, format_digest(tee)
+        return temp_path, format_digest(hasher)
 
     def _ensure_type(self, url, type):
         if type is not None:
@@ -737,14 +2694,92 @@ class ArchiveSourceCache(object):
     def contains(self, type, hash):
         return os.path.exists(self.get_pack_filename(type, hash))
 
+    def _get_mirror_url(self, mirror, type, hash):
+        return '%s/%s/%s/%s' % (mirror, PACKS_DIRNAME, type, hash)
+
+    def _probe_mirror(self, mirror, type, hash):
+        """Checks whether `mirror` has a pack without downloading it
+
+        Returns ``(status, latency, size)`` where `status` is one of
+        ``'hit'``, ``'miss'``, ``'error'`` (mirror unreachable), or
+        ``'unknown'`` (the URL scheme can not be probed).
+        """
+        url = self._get_mirror_url(mirror, type, hash)
+        if SIMPLE_FILE_URL_RE.match(url):
+            path = url[len('file:'):]
+            if os.path.exists(path):
+                return 'hit', 0., os.path.getsize(path)
+            return 'miss', 0., None
+        if urlparse.urlsplit(url).scheme not in ('http', 'https'):
+            return 'unknown', None, None
+        t0 = clock()
+        try:
+            response = urllib2.urlopen(HeadRequest(url), timeout=self.mirror_probe_timeout)
+        except urllib2.HTTPError, e:
+            return ('miss' if e.code in (403, 404, 410) else 'error'), clock() - t0, None
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
+            return 'error', None, None
+        latency = clock() - t0
+        try:
+            size = int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            size = None
+        response.close()
+        return 'hit', latency, size
+
     def fetch_from_mirrors(self, type, hash):
+        """Fetches a pack from the configured mirrors.
+
+        All mirrors are probed concurrently, and the pack is downloaded from
+        the one expected to be fastest, falling back to the others on failure.
+        Latency, throughput and failures are recorded in the :class:`MirrorStats`
+        so that mirrors that keep failing are skipped for a while.
+
+        Returns whether the pack was found.
+        """
+        if not self.mirrors:
+            return False
+        stats = MirrorStats(self.source_cache.cache, self.source_cache.lock('mirror-stats'))
+        mirrors = []
         for mirror in self.mirrors:
-            url = '%s/%s/%s/%s' % (mirror, PACKS_DIRNAME, type, hash)
+            if stats.is_benched(mirror):
+                self.logger.debug('Skipping mirror with recent failures: %s' % mirror)
+            else:
+                mirrors.append(mirror)
+        if not mirrors:
+            return False
+
+        pool = ThreadPool(len(mirrors))
+        try:
+            probes = pool.map_async(lambda mirror: self._probe_mirror(mirror, type, hash),
+                                    mirrors).get(2**31)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        candidates = []
+        for i, (mirror, (status, latency, size)) in enumerate(zip(mirrors, probes)):
+            if status == 'error':
+                stats.record_failure(mirror)
+            elif status == 'miss':
+                stats.record_success(mirror, latency=latency)
+            else:
+                if latency is not None:
+                    stats.record_success(mirror, latency=latency)
+                candidates.append((stats.expected_seconds(mirror, size), i, mirror))
+
+        for expected, i, mirror in sorted(candidates):
+            url = self._get_mirror_url(mirror, type, hash)
+            t0 = clock()
             try:
                 self._download_archive(url, type, hash)
-            except SourceNotFoundError:
+            except (SourceCacheError, RemoteFetchError, RuntimeError), e:
+                self.logger.info('Unable to fetch from mirror %s: %s' % (mirror, e))
+                stats.record_failure(mirror)
                 continue
             else:
+                nbytes = os.path.getsize(self.get_pack_filename(type, hash))
+                stats.record_success(mirror, nbytes=nbytes, seconds=clock() - t0)
                 return True # found it
         return False
 
@@ -755,17 +2790,21 @@ class ArchiveSourceCache(object):
             self.fetch_archive(url, type, hash)
 
     def fetch_archive(self, url, type, expected_hash):
-        if expected_hash is not None:
-            found = self.contains(type, expected_hash)
-            if not found:
-                found = self.fetch_from_mirrors(type, expected_hash)
-            if found:
-                return '%s:%s' % (type, expected_hash)
-        return self._download_archive(url, type, expected_hash)
+        if expected_hash is None:
+            return self._download_archive(url, type, expected_hash)
+        key = '%s:%s' % (type, expected_hash)
+        if self.contains(type, expected_hash) or self._use_tier(type, expected_hash):
+            return key
+        # Only one process downloads a given key; the others wait for it
+        # and then find it present
+        with self.source_cache.lock(key.replace(':', '-')):
+            if self.contains(type, expected_hash) or self.fetch_from_mirrors(type, expected_hash):
+                return key
+            return self._download_archive(url, type, expected_hash)
 
     def _download_archive(self, url, type, expected_hash):
         type = self._ensure_type(url, type)
-        temp_file, hash = self._download_and_hash(url, type)
+        temp_file, hash = self._download_and_hash(url, type, expected_hash)
         try:
             if expected_hash is not None and expected_hash != hash:
                 raise RuntimeError('File downloaded from "%s" has hash %s but expected %s' %
@@ -774,34 +2813,91 @@ class ArchiveSourceCache(object):
             # matter with, in this case, identical content. Make it
             # read-only and readable for everybody, everybody can read
             os.chmod(temp_file, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-            os.rename(temp_file, self.get_pack_filename(type, hash))
+            pack_filename = self.get_pack_filename(type, hash)
+            os.rename(temp_file, pack_filename)
+            self._record_verified(type, hash, os.stat(pack_filename))
         finally:
             silent_unlink(temp_file)
         return '%s:%s' % (type, hash)
 
-    def put(self, files):
-        if isinstance(files, dict):
-            files = files.items()
-        key = hit_pack(files)
+    def put(self, files, paths=()):
+        # Find the key first; in the common case the pack is present already
+        key = write_hit_pack(None, files, paths)
         type, hash = key.split(':')
         pack_filename = self.get_pack_filename(type, hash)
-        if not os.path.exists(pack_filename):
-            with file(pack_filename, 'w') as f:
-                hit_pack(files, f)
+        if not os.path.exists(pack_filename) and not self._use_tier(type, hash):
+            fd, temp_file = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(pack_filename))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    if write_hit_pack(f, files, paths) != key:
+                        raise RuntimeError('Files changed while being put in the source cache')
+                os.chmod(temp_file, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.rename(temp_file, pack_filename)
+            finally:
+                silent_unlink(temp_file)
         return key
 
     def unpack(self, type, hash, target_dir):
+        if not self.contains(type, hash):
+            tier = self._use_tier(type, hash)
+            if tier is not None and not tier.promote:
+                return ArchiveSourceCache(tier).unpack(type, hash, target_dir)
         infile = self.open_file(type, hash)
         with infile:
             if type == 'files':
-                files = hit_unpack(infile, 'files:%s' % hash)
-                scatter_files(files, target_dir)
+                with closing(HitPackReader(infile)) as pack:
+                    pack.unpack(target_dir, 'files:%s' % hash)
             else:
+                # stat the file we are actually reading from, before reading it
+                st = os.fstat(infile.fileno())
+                trusted = self._is_verified(type, hash, st)
                 try:
-                    create_archive_handler(type).unpack(infile, target_dir, hash)
+                    create_archive_handler(type).unpack(infile, target_dir, hash, trusted)
                 except SourceCacheError, e:
                     self.logger.error(str(e))
                     raise
+                if not trusted and not self.source_cache.read_only:
+                    self._record_verified(type, hash, st)
+
+    #
+    # Verification index
+    #
+    # For each pack we keep a sidecar file under verified/ recording the
+    # (inode, size, mtime, ctime) of the pack file when its digest was last
+    # checked. If the pack has not changed since then, unpacking skips
+    # hashing it. Any modification of the pack (including a chmod) changes
+    # its ctime, which can not be set from user space, so a tampered pack is
+    # always re-hashed.
+    #
+
+    def _get_verified_filename(self, type, hash):
+        return pjoin(self.source_cache.cache_path, VERIFIED_DIRNAME, type, hash)
+
+    def _stat_record(self, type, hash, st):
+        return {'path': self.get_pack_filename(type, hash),
+                'inode': st.st_ino, 'size': st.st_size,
+                'mtime': repr(st.st_mtime), 'ctime': repr(st.st_ctime),
+                'digest': hash}
+
+    def _is_verified(self, type, hash, st):
+        try:
+            with open(self._get_verified_filename(type, hash)) as f:
+                doc = json.load(f)
+        except (IOError, ValueError):
+            return False
+        return doc == self._stat_record(type, hash, st)
+
+    def _record_verified(self, type, hash, st):
+        d = os.path.dirname(self._get_verified_filename(type, hash))
+        silent_makedirs(d)
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp-', dir=d)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._stat_record(type, hash, st), f)
+            os.rename(temp_path, self._get_verified_filename(type, hash))
+        except:
+            silent_unlink(temp_path)
+            raise
 
     def open_file(self, type, hash):
         try:
@@ -815,8 +2911,8 @@ class ArchiveSourceCache(object):
     # hit packs
     #
     def _extract_hit_pack(self, f, key, target_dir):
-        files = hit_unpack(f, key)
-        scatter_files(files, target_dir)
+        with closing(HitPackReader(f)) as pack:
+            pack.unpack(target_dir, key)
 
 
 #
@@ -825,7 +2921,7 @@ class ArchiveSourceCache(object):
 
 def common_path_prefix(paths):
     if len(paths) == 0:
-        return 0
+        return ''
     sep = os.path.sep
     prefixes = [p.split(sep)[:-1] for p in paths]
     common_prefix = paths[0].split(sep)[:-1]
@@ -842,109 +2938,469 @@ def common_path_prefix(paths):
     else:
         return sep.join(common_prefix) + sep
 
+class DecompressingReadStream(object):
+    """
+    Read-only file-like object that decompresses `stream` on the fly.
+
+    `decompressor_factory` should return objects with the API of
+    ``zlib.decompressobj``/``bz2.BZ2Decompressor``. Concatenated
+    compressed streams (as written by e.g. ``pbzip2``) are supported by
+    starting a new decompressor whenever the data left after the end of
+    a stream starts with `magic`; anything else after the end of a stream
+    is ignored.
+    """
+    chunk_size = 16 * 1024
+
+    def __init__(self, stream, decompressor_factory, magic):
+        self.stream = stream
+        self.decompressor_factory = decompressor_factory
+        self.magic = magic
+        self._decompressor = decompressor_factory()
+        self._buf = ''
+        self._eof = False
+        # data after the end of a stream that may be the start of `magic`
+        self._pending = ''
+        # whether the data after the end of a stream was not another one
+        self._trailing = False
+
+    def _decompress(self, data):
+        out = []
+        data = self._pending + data
+        self._pending = ''
+        while data and not self._trailing:
+            try:
+                out.append(self._decompressor.decompress(data))
+                data = getattr(self._decompressor, 'unused_data', '')
+            except EOFError:
+                # bz2: the stream ended exactly at the end of the previous data
+                pass
+            if data:
+                if len(data) < len(self.magic) and self.magic.startswith(data):
+                    self._pending = data
+                    break
+                if not data.startswith(self.magic):
+                    self._trailing = True
+                    break
+                self._decompressor = self.decompressor_factory()
+        return ''.join(out)
+
+    def read(self, size=-1):
+        chunks = [self._buf]
+        n = len(self._buf)
+        while not self._eof and (size < 0 or n < size):
+            data = self.stream.read(self.chunk_size)
+            if not data:
+                self._eof = True
+                flush = getattr(self._decompressor, 'flush', None)
+                chunk = flush() if flush is not None else ''
+            else:
+                chunk = self._decompress(data)
+            chunks.append(chunk)
+            n += len(chunk)
+        buf = ''.join(chunks)
+        if size < 0:
+            result, self._buf = buf, ''
+        else:
+            result, self._buf = buf[:size], buf[size:]
+        return result
+
+    def close(self):
+        pass
+
+
+# Whether to decompress archives with external programs that use several
+# cores, when available (see TarballHandler.parallel_decompressors)
+use_external_decompressors = True
+
+def _find_program(name):
+    for location in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = pjoin(location, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+class ExternalDecompressingReadStream(object):
+    """
+    Read-only file-like object that decompresses `stream` on the fly by
+    piping it through an external program, e.g. ``['pigz', '-d', '-c']``.
+
+    `stream` is fed to the program from a background thread, so `stream`
+    must not be used by anyone else until the object is closed. Unless the
+    object is closed before the end of the decompressed data (which
+    terminates the program), `stream` is read to its end. An exit code
+    not in `ok_codes` is raised as an `IOError` at the end of the data.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream, cmd, ok_codes=(0,)):
+        self.stream = stream
+        self.cmd = cmd
+        self.ok_codes = ok_codes
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=self._stderr, close_fds=True)
+        self._eof = False
+        self._finished = False
+        self._killed = False
+        self._feed_error = None
+        self._thread = threading.Thread(target=self._feed)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _feed(self):
+        try:
+            while True:
+                data = self.stream.read(self.chunk_size)
+                if not data:
+                    break
+                self._proc.stdin.write(data)
+        except IOError, e:
+            # EPIPE means the program exited; its exit code tells why
+            if e.errno != errno.EPIPE:
+                self._feed_error = sys.exc_info()
+        except:
+            self._feed_error = sys.exc_info()
+        finally:
+            try:
+                self._proc.stdin.close()
+            except IOError:
+                pass
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self._thread.join()
+        retcode = self._proc.wait()
+        self._proc.stdout.close()
+        if self._feed_error is not None:
+            exc_type, exc_value, exc_tb = self._feed_error
+            raise exc_type, exc_value, exc_tb
+        if retcode not in self.ok_codes and not self._killed:
+            self._stderr.seek(0)
+            raise IOError('%s failed with code %d: %s' % (self.cmd[0], retcode,
+                                                          self._stderr.read().strip()))
+
+    def read(self, size=-1):
+        if self._eof:
+            return ''
+        data = self._proc.stdout.read() if size < 0 else self._proc.stdout.read(size)
+        if size < 0 or (size > 0 and len(data) < size):
+            self._eof = True
+            self._finish()
+        return data
+
+    def close(self):
+        try:
+            if not self._finished and not self._eof:
+                # don't wait for the rest to be decompressed
+                self._killed = True
+                try:
+                    self._proc.kill()
+                except OSError:
+                    pass
+            self._finish()
+        finally:
+            self._stderr.close()
+
+
+class StreamingValidator(object):
+    """
+    Write-only file-like object checking that the data written to it is a
+    valid archive, so that archives can be validated while they are
+    downloaded instead of reading them again afterwards.
+
+    The data is passed through a pipe to `verify_stream` (a function
+    taking a readable stream and returning whether it is valid), which
+    runs in a background thread. Whatever `verify_stream` leaves unread
+    is drained, so writing never blocks for long. :meth:`close` waits for
+    the verdict and returns it.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, verify_stream):
+        self.verify_stream = verify_stream
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, 'rb')
+        self._writer = os.fdopen(write_fd, 'wb')
+        self._result = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = self.verify_stream(self._reader)
+        except Exception:
+            self._result = False
+        finally:
+            try:
+                while self._reader.read(self.chunk_size):
+                    pass
+            finally:
+                self._reader.close()
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def close(self):
+        if not self._writer.closed:
+            self._writer.close()
+            self._thread.join()
+        return self._result
+
+
+@contextlib.contextmanager
+def staging_dir(target_dir):
+    """
+    Creates a temporary directory within `target_dir` to extract archives
+    to before they are verified; it is removed (with any contents left) on exit.
+    """
+    path = tempfile.mkdtemp(prefix='.unpacking-', dir=target_dir)
+    try:
+        yield path
+    finally:
+        rmtree_write_protected(path)
+
+def publish_tree(src, dst, replace=False):
+    """
+    Moves the contents of directory `src` into directory `dst` by
+    renaming, merging with any directories already present in `dst`.
+    Existing files in `dst` are replaced if `replace` is set; otherwise
+    an OSError(errno.EEXIST) is raised.
+    """
+    if not os.path.exists(src):
+        return
+    src_mode = os.stat(src).st_mode
+    os.chmod(src, src_mode | stat.S_IWUSR)
+    for name in os.listdir(src):
+        s = pjoin(src, name)
+        d = pjoin(dst, name)
+        s_is_dir = os.path.isdir(s) and not os.path.islink(s)
+        if s_is_dir and os.path.isdir(d) and not os.path.islink(d):
+            with allow_writes(d):
+                publish_tree(s, d, replace)
+        elif not replace and os.path.lexists(d):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), d)
+        elif s_is_dir:
+            # moving a directory to another parent needs write access to it (for '..')
+            mode = os.stat(s).st_mode
+            os.chmod(s, mode | stat.S_IWUSR)
+            os.rename(s, d)
+            os.chmod(d, mode)
+        elif replace:
+            os.rename(s, d)
+        else:
+            # unlike rename, link does not replace a file that appeared meanwhile
+            os.link(s, d)
+            os.unlink(s)
+
+def _reraise_unless_corrupt(tee, hash, filename):
+    """
+    Called from an except-clause during streaming unpack. Reads the rest of
+    `tee` and raises `CorruptSourceCacheError` if the digest does not match,
+    since that is the more likely root cause of any error; otherwise the
+    original exception is re-raised.
+    """
+    exc_type, exc_value, exc_tb = sys.exc_info()
+    while tee.read(TarballHandler.chunk_size):
+        pass
+    if format_digest(tee) != hash:
+        raise CorruptSourceCacheError("Corrupted file: '%s'" % filename)
+    raise exc_type, exc_value, exc_tb
+
 class TarballHandler(object):
     chunk_size = 16 * 1024
 
+    # External programs decompressing on several cores, in order of
+    # preference, as (command, successful exit codes)
+    parallel_decompressors = []
+
     def verify(self, filename):
+        with open(filename, 'rb') as f:
+            return self.verify_stream(f)
+
+    def verify_stream(self, stream):
         import tarfile
         try:
-            with closing(self.tarfileobj_from_name(filename)) as tarfileobj:
-                with closing(tarfile.open(fileobj=tarfileobj, mode=self.read_mode)) as archive:
+            with closing(self.open_decompressed(stream)) as decompressed:
+                with closing(tarfile.open(fileobj=decompressed, mode='r|')) as archive:
                     # Just in case, make sure we can actually read the archive:
-                    members = archive.getmembers()
-                return True
-        except tarfile.ReadError:
+                    for member in archive:
+                        pass
+            return True
+        except (tarfile.TarError, IOError, EOFError, zlib.error):
             return False
 
-    def unpack(self, infile, target_dir, hash):
-        import tarfile
-        target_dir = os.path.abspath(target_dir)
-
-        archive_data = infile.read()
-        if format_digest(hashlib.sha256(archive_data)) != hash:
-            raise CorruptSourceCacheError("Corrupted file: '%s'" % infile.name)
-
-        with closing(self.tarfileobj_from_data(archive_data)) as tarfileobj:
-            with closing(tarfile.open(fileobj=tarfileobj, mode=self.read_mode)) as archive:
-                members = archive.getmembers()
-                prefix_len = len(common_path_prefix([member.name for member in members
-                                                     if member.type != tarfile.DIRTYPE]))
-                # Filter away too short directory entries, remove prefix,
-                # and prevent directory escape attacks
-                filtered_members = []
-                for member in members:
-                    if len(member.name) <= prefix_len:
-                        continue
-                    if not os.path.abspath(pjoin(target_dir, member.name)).startswith(target_dir):
-                        raise SecurityError("Archive attempted to break out of target dir "
-                                            "with filename: %s" % member.name)
-                    member.name = member.name[prefix_len:]
-                archive.extractall(target_dir, members)
+    def open_validator(self):
+        """Returns a :class:`StreamingValidator` for archives of this type"""
+        return StreamingValidator(self.verify_stream)
 
-    def tarfileobj_from_name(self, filename):
-        return open(filename, 'r');
+    def unpack(self, infile, target_dir, hash, trusted=False):
+        """
+        Extracts `infile` to `target_dir` in a single streaming pass while
+        hashing it. The contents are extracted to a staging directory within
+        `target_dir` and only moved into place once the digest matches
+        `hash`, so that nothing from a tampered archive is left behind.
 
-    def tarfileobj_from_data(self, archive_data):
-        from StringIO import StringIO
-        return StringIO(archive_data)
+        If `trusted` is set, `infile` is known to match `hash` and is
+        not hashed again.
+        """
+        import tarfile
+        target_dir = os.path.abspath(target_dir)
+        tee = infile if trusted else HashingReadStream(hashlib.sha256(), infile)
+        with staging_dir(target_dir) as staging:
+            names = []
+            # symlinks leading out of the staging directory are only
+            # created once the archive is verified
+            deferred = None if trusted else []
+            try:
+                with closing(self.open_decompressed(tee)) as decompressed:
+                    with closing(tarfile.open(fileobj=decompressed, mode='r|')) as archive:
+                        archive.extractall(staging, self._checked_members(archive, staging, names,
+                                                                          deferred))
+                if not trusted:
+                    while tee.read(self.chunk_size):
+                        pass
+            except:
+                if trusted:
+                    raise
+                _reraise_unless_corrupt(tee, hash, infile.name)
+            if not trusted and format_digest(tee) != hash:
+                raise CorruptSourceCacheError("Corrupted file: '%s'" % infile.name)
+            if deferred:
+                create_symlinks(deferred, staging)
+            publish_tree(pjoin(staging, common_path_prefix(names)), target_dir, replace=True)
+
+    def _checked_members(self, archive, staging, names, deferred_symlinks=None):
+        # Prevent directory escape attacks, and record non-directory names
+        # to strip the common prefix once extraction is done
+        for member in checked_tar_members(archive, staging, SecurityError, deferred_symlinks):
+            if not member.isdir():
+                names.append(member.name)
+            yield member
+        if deferred_symlinks:
+            names.extend(member.name for member in deferred_symlinks)
+
+    def get_external_decompressor(self):
+        """
+        Returns (command, ok_codes) for the first of `parallel_decompressors`
+        found in the PATH, or `None`. The lookup is done once per class.
+        """
+        if not use_external_decompressors:
+            return None
+        cls = type(self)
+        if '_external_decompressor' not in cls.__dict__:
+            cls._external_decompressor = None
+            for cmd, ok_codes in cls.parallel_decompressors:
+                path = _find_program(cmd[0])
+                if path is not None:
+                    cls._external_decompressor = ([path] + cmd[1:], ok_codes)
+                    break
+        return cls._external_decompressor
+
+    def open_decompressed(self, stream):
+        """
+        Returns a file-like object with the decompressed contents of
+        `stream`; it must be closed after use. Uses one of the
+        `parallel_decompressors` if available, and Python otherwise.
+        """
+        external = self.get_external_decompressor()
+        if external is not None:
+            cmd, ok_codes = external
+            return ExternalDecompressingReadStream(stream, cmd, ok_codes)
+        return DecompressingReadStream(stream, self.decompressor, self.magic)
 
 
 class TarGzHandler(TarballHandler):
     type = 'tar.gz'
     exts = ['tar.gz', 'tgz']
-    read_mode = 'r:gz'
+    magic = '\x1f\x8b'
+    # exit code 2 is a warning about trailing garbage, which we ignore too
+    parallel_decompressors = [(['pigz', '-d', '-c'], (0, 2))]
+
+    def decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
 
 
 class TarBz2Handler(TarballHandler):
     type = 'tar.bz2'
     exts = ['tar.bz2', 'tb2', 'tbz2']
-    read_mode = 'r:bz2'
+    magic = 'BZh'
+    parallel_decompressors = [(['lbzip2', '-d', '-c'], (0,)),
+                              (['pbzip2', '-d', '-c'], (0,))]
+
+    def decompressor(self):
+        import bz2
+        return bz2.BZ2Decompressor()
 
 class TarXzHandler(TarballHandler):
     type = 'tar.xz'
     exts = ['tar.xz']
-    read_mode = 'r'
+    magic = '\xfd7zXZ\x00'
+    parallel_decompressors = [(['xz', '-d', '-c', '-T0'], (0,))]
 
     # XXX: tarfile has built-in 'r:xz' support only in Python 3,
     # XXX: so we use lzma module for Python 2 compatibility.
 
-    def tarfileobj_from_name(self, filename):
+    def decompressor(self):
         import lzma
-        return lzma.LZMAFile(filename)
-
-    def tarfileobj_from_data(self, archive_data):
-        # XXX: tarfile has built-in 'r:xz' support only in Python 3, so we use lzma module
-        # XXX: lzma.open() and lzma.LZMAFile() accept only file names, so we uncompress in memory
-        import lzma
-        from StringIO import StringIO
-        return StringIO(lzma.LZMADecompressor().decompress(archive_data))
+        return lzma.LZMADecompressor()
 
 class ZipHandler(object):
     type = 'zip'
     exts = ['zip']
+    chunk_size = 16 * 1024
+
     def verify(self, filename):
-        from zipfile import ZipFile
-        with closing(ZipFile(filename)) as f:
-            return f.testzip() is None # returns None if zip is OK
+        from zipfile import ZipFile, BadZipfile
+        try:
+            with closing(ZipFile(filename)) as f:
+                return f.testzip() is None # returns None if zip is OK
+        except (BadZipfile, IOError):
+            return False
+
+    def open_validator(self):
+        # the central directory is at the end, so zip files can only be
+        # validated once they are complete (see verify)
+        return None
 
-    def unpack(self, infile, target_dir, hash):
+    def unpack(self, infile, target_dir, hash, trusted=False):
+        """
+        ZipFile needs random access, so the archive is first copied to a
+        private snapshot in the staging directory while hashing it, and
+        then extracted from the verified snapshot. If `trusted` is set,
+        `infile` is known to match `hash` and is extracted from directly.
+        """
         from zipfile import ZipFile
-        from StringIO import StringIO
-        # only safe mode implemented as ZipFile does random access
-        archive_data = infile.read()
-        if format_digest(hashlib.sha256(archive_data)) != hash:
-            raise CorruptSourceCacheError("Corrupted file: '%s'" % infile.name)
-        with closing(ZipFile(StringIO(archive_data))) as f:
-            infolist = f.infolist()
-            if len(infolist) == 0:
-                return
-            # Scan through infolist to determine length of common prefix, and modify ZipInfo structs
-            # during extraction
-            prefix_len = len(common_path_prefix([info.filename for info in infolist]))
-            for info in infolist:
-                if len(info.filename) > prefix_len:
-                    info.filename = info.filename[prefix_len:]
-                    f.extract(info, target_dir)
+        target_dir = os.path.abspath(target_dir)
+        with staging_dir(target_dir) as staging:
+            if trusted:
+                snapshot = infile
+            else:
+                snapshot = pjoin(staging, 'archive.zip')
+                with open(snapshot, 'wb') as f:
+                    tee = HashingWriteStream(hashlib.sha256(), f)
+                    while True:
+                        chunk = infile.read(self.chunk_size)
+                        if not chunk: break
+                        tee.write(chunk)
+                if format_digest(tee) != hash:
+                    raise CorruptSourceCacheError("Corrupted file: '%s'" % infile.name)
+            tree = pjoin(staging, 'tree')
+            os.mkdir(tree)
+            with closing(ZipFile(snapshot)) as f:
+                infolist = f.infolist()
+                if len(infolist) == 0:
+                    return
+                # Determine length of common prefix, and modify ZipInfo structs
+                # during extraction
+                prefix_len = len(common_path_prefix([info.filename for info in infolist]))
+                for info in infolist:
+                    if len(info.filename) > prefix_len:
+                        info.filename = info.filename[prefix_len:]
+                        f.extract(info, tree)
+            publish_tree(tree, target_dir, replace=True)
 
 archive_ext_to_type = {}
 archive_handler_classes = {}
@@ -1035,6 +3491,240 @@ def hit_unpack(stream, key):
         raise CorruptSourceCacheError('hit-pack does not match key "%s"' % key)
     return files
 
+HIT_PACK_V1_MAGIC = 'HDSTPCK1'
+HIT_PACK_V2_MAGIC = 'HDSTPCK2'
+HIT_PACK_INDEX_MAGIC = 'HDSTIDX2'
+
+def write_hit_pack(stream, files=(), paths=()):
+    """
+    Writes a pack in the version 2 "hit-pack" format documented above
+    to `stream`, and returns the key. Unlike :func:`hit_pack`, contents
+    can be given as paths of files, which are streamed into the pack.
+
+    Parameters
+    ----------
+
+    stream : file-like
+        Result of the packing, or `None` if one only wishes to know
+        the key; files in `paths` are then only read once, to hash them.
+
+    files : dict or list of (filename, contents)
+        In-memory contents, as for :func:`hit_pack`.
+
+    paths : dict or list of (filename, path)
+        Contents to read from the files at `path`.
+
+    Returns
+    -------
+
+    The key of the resulting pack; this is the same as the key
+    :func:`hit_pack` gives for the same contents.
+    """
+    if isinstance(files, dict):
+        files = files.items()
+    if isinstance(paths, dict):
+        paths = paths.items()
+    entries = [(filename, contents, None) for filename, contents in files]
+    entries += [(filename, None, path) for filename, path in paths]
+    entries.sort()
+    for a, b in zip(entries[:-1], entries[1:]):
+        if a[0] == b[0]:
+            raise ValueError('Filename "%s" given more than once' % a[0])
+
+    hasher = hashlib.sha256()
+    hasher.update(HIT_PACK_V1_MAGIC)
+    if stream is not None:
+        stream.write(HIT_PACK_V2_MAGIC)
+    offset = len(HIT_PACK_V2_MAGIC)
+    index = []
+    for filename, contents, path in entries:
+        if path is None:
+            size = len(contents)
+            hasher.update(struct.pack('<II', len(filename), size))
+            hasher.update(filename)
+            hasher.update(contents)
+            if stream is not None:
+                stream.write(contents)
+        else:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                hasher.update(struct.pack('<II', len(filename), size))
+                hasher.update(filename)
+                n = 0
+                while True:
+                    buf = f.read(HitPackReader.chunk_size)
+                    if not buf:
+                        break
+                    n += len(buf)
+                    hasher.update(buf)
+                    if stream is not None:
+                        stream.write(buf)
+                if n != size:
+                    raise IOError('File "%s" changed size while being packed' % path)
+        index.append((offset, size, filename))
+        offset += size
+
+    if stream is not None:
+        stream.write(struct.pack('<I', len(index)))
+        for file_offset, size, filename in index:
+            stream.write(struct.pack('<QQI', file_offset, size, len(filename)))
+            stream.write(filename)
+        stream.write(struct.pack('<Q', offset))
+        stream.write(HIT_PACK_INDEX_MAGIC)
+    return 'files:%s' % format_digest(hasher)
+
+
+class HitPackReader(object):
+    """
+    Random access to the files in a hit-pack on disk, through ``mmap``.
+    Both version 1 and version 2 packs can be read; for version 1 packs
+    the index is built by skipping through the pack.
+
+    Nothing is verified against the key until :meth:`verify` or
+    :meth:`unpack` is called; :meth:`read` returns unverified contents.
+
+    Parameters
+    ----------
+
+    f : file
+        The pack, opened for reading; it can be closed once the reader
+        is created.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, f):
+        size = os.fstat(f.fileno()).st_size
+        if size < 8:
+            raise CorruptSourceCacheError('Not an hit-pack')
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic = self._map[:8]
+            if magic == HIT_PACK_V2_MAGIC:
+                self._index = self._read_v2_index()
+            elif magic == HIT_PACK_V1_MAGIC:
+                self._index = self._scan_v1()
+            else:
+                raise CorruptSourceCacheError('Not an hit-pack')
+        except struct.error:
+            self.close()
+            raise CorruptSourceCacheError('Truncated hit-pack')
+        except:
+            self.close()
+            raise
+        self._offsets = dict((filename, (offset, size))
+                             for filename, offset, size in self._index)
+
+    def _check_range(self, offset, size):
+        if offset < 0 or size < 0 or offset + size > len(self._map):
+            raise CorruptSourceCacheError('Corrupt hit-pack index')
+
+    def _read_v2_index(self):
+        m = self._map
+        end = len(m) - 16
+        if end < 8 or m[end + 8:] != HIT_PACK_INDEX_MAGIC:
+            raise CorruptSourceCacheError('Truncated hit-pack')
+        pos, = struct.unpack('<Q', m[end:end + 8])
+        self._check_range(pos, end - pos)
+        count, = struct.unpack('<I', m[pos:pos + 4])
+        pos += 4
+        index = []
+        for i in range(count):
+            offset, size, filename_len = struct.unpack('<QQI', m[pos:pos + 20])
+            pos += 20
+            filename = m[pos:pos + filename_len]
+            pos += filename_len
+            self._check_range(offset, size)
+            index.append((filename, offset, size))
+        return index
+
+    def _scan_v1(self):
+        m = self._map
+        pos = 8
+        index = []
+        while pos < len(m):
+            filename_len, size = struct.unpack('<II', m[pos:pos + 8])
+            pos += 8
+            filename = m[pos:pos + filename_len]
+            pos += filename_len
+            self._check_range(pos, size)
+            index.append((filename, pos, size))
+            pos += size
+        return index
+
+    def close(self):
+        self._map.close()
+
+    def names(self):
+        """Returns the filenames in the pack, in order"""
+        return [filename for filename, offset, size in self._index]
+
+    def size(self, filename):
+        return self._offsets[filename][1]
+
+    def read(self, filename):
+        """Returns the (unverified) contents of a single file"""
+        offset, size = self._offsets[filename]
+        return self._map[offset:offset + size]
+
+    def _iter_chunks(self, offset, size):
+        end = offset + size
+        while offset < end:
+            n = min(self.chunk_size, end - offset)
+            yield self._map[offset:offset + n]
+            offset += n
+
+    def _hash_file_header(self, hasher, filename, size):
+        hasher.update(struct.pack('<II', len(filename), size))
+        hasher.update(filename)
+
+    def _check_key(self, hasher, key):
+        if not key.startswith('files:'):
+            raise ValueError('invalid key')
+        if key[len('files:'):] != format_digest(hasher):
+            raise CorruptSourceCacheError('hit-pack does not match key "%s"' % key)
+
+    def verify(self, key):
+        """Raises `CorruptSourceCacheError` unless the pack matches `key`"""
+        hasher = hashlib.sha256()
+        hasher.update(HIT_PACK_V1_MAGIC)
+        for filename, offset, size in self._index:
+            self._hash_file_header(hasher, filename, size)
+            for buf in self._iter_chunks(offset, size):
+                hasher.update(buf)
+        self._check_key(hasher, key)
+
+    def unpack(self, target_dir, key):
+        """
+        Writes the files to `target_dir` while verifying the pack against
+        `key`. The files are written to a staging directory and only moved
+        into place once the pack is verified. Will not overwrite files
+        (raises an OSError(errno.EEXIST)).
+        """
+        target_dir = os.path.abspath(target_dir)
+        silent_makedirs(target_dir)
+        hasher = hashlib.sha256()
+        hasher.update(HIT_PACK_V1_MAGIC)
+        with staging_dir(target_dir) as staging:
+            existing_dir_cache = set([staging])
+            for filename, offset, size in self._index:
+                self._hash_file_header(hasher, filename, size)
+                path = os.path.abspath(pjoin(staging, filename))
+                if not path.startswith(staging + os.path.sep):
+                    raise SecurityError('hit-pack attempted to break out of target dir '
+                                        'with filename: %s' % filename)
+                dirname = os.path.dirname(path)
+                if dirname not in existing_dir_cache:
+                    silent_makedirs(dirname)
+                    existing_dir_cache.add(dirname)
+                fd = os.open(path, os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0600)
+                with os.fdopen(fd, 'w') as f:
+                    for buf in self._iter_chunks(offset, size):
+                        hasher.update(buf)
+                        f.write(buf)
+            self._check_key(hasher, key)
+            publish_tree(staging, target_dir)
+
+
 def scatter_files(files, target_dir):
     """
     Given a list of filenames and their contents, write them to the file system.
@@ -1068,6 +3758,6 @@ def scatter_files(files, target_dir):
 
 def silent_unlink(path):
     try:
-        os.unlink(temp_file)
+        os.unlink(path)
     except:
         pass
@@ -0,0 +1,182 @@
+"""
+:mod:`hashdist.core.source_server` --- Serving the source cache over HTTP
+=========================================================================
+
+Serves the archives of a local source cache laid out the way
+:class:`~hashdist.core.source_cache.SourceCache` expects of its mirrors,
+i.e., ``<url>/packs/<type>/<hash>`` (and ``<url>/files/<hash>`` for
+hit-packs), so that one host can act as the source mirror of others
+without a separate web server.
+
+Responses are sent with ``sendfile(2)`` where available, single byte
+ranges are supported (so that interrupted downloads can be resumed), and
+in read-through mode requests for archives that are not present are first
+fetched from the mirrors the source cache itself is configured with.
+
+Module reference
+----------------
+
+"""
+
+import os
+import re
+import copy
+import errno
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from .source_cache import ArchiveSourceCache, archive_types
+from .fileutils import sendfile
+
+HASH_RE = re.compile(r'^[a-z0-9]+$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SourceCacheServer(object):
+    """
+    Threaded HTTP server for the packs of `source_cache`.
+
+    Parameters
+    ----------
+
+    source_cache : :class:`~hashdist.core.source_cache.SourceCache`
+
+    host, port :
+        Address to listen on; port 0 picks a free port (see :attr:`url`).
+
+    read_through : bool
+        Whether to fetch archives that are not present from the mirrors
+        of `source_cache` before answering.
+    """
+
+    def __init__(self, source_cache, host='', port=8000, read_through=False):
+        # downloads from several threads would garble progress bars
+        self.source_cache = copy.copy(source_cache)
+        self.source_cache.show_progress = False
+        self.logger = source_cache.logger
+        self.read_through = read_through
+        self.httpd = _ThreadingHTTPServer((host, port), self._make_handler_class())
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host if host not in ('', '0.0.0.0') else 'localhost', port)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Serves from a background thread; stop with :meth:`shutdown`"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_filename(self, path):
+        """Maps a request path to ``(type, hash, filename)``, or `None`"""
+        parts = path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'packs':
+            type, hash = parts[1:]
+        elif len(parts) == 2 and parts[0] == 'files':
+            type, hash = parts
+        else:
+            return None
+        if (type not in archive_types and type != 'files') or not HASH_RE.match(hash):
+            return None
+        return type, hash, ArchiveSourceCache(self.source_cache).get_pack_filename(type, hash)
+
+    def _fetch_missing(self, type, hash):
+        if type == 'files' or not self.source_cache.mirrors:
+            return
+        key = '%s:%s' % (type, hash)
+        archives = ArchiveSourceCache(self.source_cache)
+        with self.source_cache.lock(key.replace(':', '-')):
+            if not archives.contains(type, hash):
+                self.logger.info('Fetching %s from upstream mirrors' % key)
+                archives.fetch_from_mirrors(type, hash)
+
+    def _make_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                server.logger.debug('%s - %s' % (self.client_address[0], format % args))
+
+            def do_HEAD(self):
+                self.send_pack(send_body=False)
+
+            def do_GET(self):
+                self.send_pack(send_body=True)
+
+            def send_empty(self, code, extra_headers=()):
+                self.send_response(code)
+                for name, value in extra_headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def send_pack(self, send_body):
+                found = server.get_filename(self.path)
+                if found is None:
+                    self.send_empty(404)
+                    return
+                type, hash, filename = found
+                if server.read_through and not os.path.exists(filename):
+                    try:
+                        server._fetch_missing(type, hash)
+                    except Exception, e:
+                        server.logger.warning('Could not fetch %s:%s: %s' % (type, hash, e))
+                try:
+                    f = open(filename, 'rb')
+                except IOError, e:
+                    if e.errno not in (errno.ENOENT, errno.EACCES):
+                        raise
+                    self.send_empty(404)
+                    return
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    start, end = 0, size
+                    range_header = self.headers.get('Range')
+                    m = RANGE_RE.match(range_header.strip()) if range_header else None
+                    if m and (m.group(1) or m.group(2)):
+                        if m.group(1):
+                            start = int(m.group(1))
+                            if m.group(2):
+                                end = min(int(m.group(2)) + 1, size)
+                        else:
+                            start = max(0, size - int(m.group(2)))
+                        if start >= end:
+                            self.send_empty(416, [('Content-Range', 'bytes */%d' % size)])
+                            return
+                        self.send_response(206)
+                        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+                    else:
+                        self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(end - start))
+                    self.send_header('Accept-Ranges', 'bytes')
+                    self.end_headers()
+                    if send_body:
+                        self.wfile.flush()
+                        try:
+                            sendfile(self.connection.fileno(), f.fileno(), start, end - start)
+                        except (IOError, OSError), e:
+                            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                                raise
+                            # client went away
+                            self.close_connection = 1
+                            return
+                        server.source_cache.record_access(type, hash)
+
+        return Handler
@@ -0,0 +1,99 @@
+import os
+from os.path import join as pjoin
+
+from nose.tools import eq_
+
+from .utils import logger, temp_dir, assert_raises
+from . import utils
+from .test_build_store import fixture
+
+from .. import build_store
+from ..binary_cache import BinaryCache, CorruptArtifactPackError
+from ..fileutils import rmtree_write_protected
+
+
+def make_store(root, binary_caches):
+    for d in ['tmp', 'bld', 'gcroots']:
+        os.makedirs(pjoin(root, d))
+    return build_store.BuildStore(pjoin(root, 'tmp'), pjoin(root, 'bld'), pjoin(root, 'gcroots'),
+                                  logger, binary_caches=binary_caches)
+
+def build_spec(text, absolute=False):
+    target = '$ARTIFACT/share/text'
+    return {"name": "foo",
+            "files": [{"target": target, "text": [text], "expandvars": absolute}],
+            "build": {"commands": [{"hit": ["build-write-files", "--key=files", "build.json"]}]}}
+
+@fixture()
+def test_push_and_pull(tempdir, sc, bldr, config):
+    cache_dir = pjoin(tempdir, 'cache')
+    spec = build_spec('hello')
+    artifact_id, path = bldr.ensure_present(spec, config)
+    cache = BinaryCache(cache_dir, logger)
+    assert not cache.contains(artifact_id)
+    assert bldr.push(artifact_id, cache)
+    assert cache.contains(artifact_id)
+    assert not bldr.push(artifact_id, cache)
+    eq_(bldr.artifact_root, cache.get_info(artifact_id)['artifact_root'])
+    # readable by others sharing the cache
+    for ext in ['tar.gz', 'json']:
+        eq_(0o644, os.stat(pjoin(cache_dir, '%s.%s' % (artifact_id, ext))).st_mode & 0o777)
+
+    for url in [False, True]:
+        with temp_dir() as other_dir:
+            location = 'file:' + cache_dir if url else cache_dir
+            other = make_store(other_dir, [BinaryCache(location, logger)])
+            # fetched by ensure_present instead of built
+            got_id, other_path = other.ensure_present(spec, config)
+            eq_(artifact_id, got_id)
+            assert other_path.startswith(other.artifact_root)
+            eq_('hello', utils.cat(pjoin(other_path, 'share', 'text')))
+            eq_(artifact_id, utils.cat(pjoin(other_path, 'id')).strip())
+            eq_(sorted(os.listdir(path)), sorted(os.listdir(other_path)))
+            eq_(None, other.pull('foo/' + 'a' * 32))
+            os.system('chmod -R +w %s' % other_dir)
+
+@fixture()
+def test_pull_corrupt_or_unrelocatable(tempdir, sc, bldr, config):
+    cache_dir = pjoin(tempdir, 'cache')
+    cache = BinaryCache(cache_dir, logger)
+    relocatable_id, _ = bldr.ensure_present(build_spec('hello'), config)
+    absolute_id, _ = bldr.ensure_present(build_spec('${ARTIFACT}', absolute=True), config)
+    for artifact_id in [relocatable_id, absolute_id]:
+        bldr.push(artifact_id, cache)
+
+    with temp_dir() as other_dir:
+        other = make_store(other_dir, [cache])
+        # refers to the artifact root it was built under
+        eq_(None, other.pull(absolute_id))
+        # a truncated pack is detected by its hash
+        tarball = pjoin(cache_dir, relocatable_id + '.tar.gz')
+        with open(tarball, 'rb') as f:
+            data = f.read()
+        with open(tarball, 'wb') as f:
+            f.write(data[:-10])
+        eq_(None, other.pull(relocatable_id))
+        with assert_raises(CorruptArtifactPackError):
+            cache.install(other, relocatable_id)
+        # no partial artifact is left behind
+        name = relocatable_id.split('/')[0]
+        eq_([], os.listdir(pjoin(other.artifact_root, name)))
+        eq_(None, other.resolve(relocatable_id))
+        # so is a pack that is not a tarball at all
+        with open(tarball, 'wb') as f:
+            f.write('<html>Not found</html>')
+        with assert_raises(CorruptArtifactPackError):
+            cache.install(other, relocatable_id)
+        # a JSON document that does not parse is logged and skipped
+        with open(pjoin(cache_dir, relocatable_id + '.json'), 'w') as f:
+            f.write('<html>Not found</html>')
+        with assert_raises(CorruptArtifactPackError):
+            cache.get_info(relocatable_id)
+        eq_(None, other.pull(relocatable_id))
+        eq_([], os.listdir(pjoin(other.artifact_root, name)))
+        os.system('chmod -R +w %s' % other_dir)
+
+    # the same artifact root does not need relocation
+    rmtree_write_protected(bldr.resolve(absolute_id))
+    bldr.binary_caches = [cache]
+    assert bldr.pull(absolute_id) is not None
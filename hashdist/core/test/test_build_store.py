@@ -7,8 +7,13 @@ from textwrap import dedent
 from pprint import pprint
 import gzip
 import json
-from contextlib import closing
+import errno
+from contextlib import closing, contextmanager
 import subprocess
+import time
+import multiprocessing
+import hashlib
+import sqlite3
 from pprint import pprint
 
 from nose.tools import eq_
@@ -19,6 +24,7 @@ from . import utils
 
 from .. import source_cache, build_store, InvalidBuildSpecError, BuildFailedError, InvalidJobSpecError
 from ..common import SHORT_ARTIFACT_ID_LEN, IllegalBuildStoreError
+from ..fileutils import FileLock
 
 
 #
@@ -294,3 +300,268 @@ def test_virtual_dependencies(tempdir, sc, bldr, config):
     build_mock_packages(bldr, config, [numpy], virtuals={"virtual:blas/1.2.3": blas_id},
                         name_to_artifact={"blas": ("virtual:blas/1.2.3", blas_path)})
 
+@fixture()
+def test_gc_rooted_source_keys(tempdir, sc, bldr, config):
+    used_key = sc.put({'build.sh': 'true'})
+    unused_key = sc.put({'build.sh': 'false'})
+    spec = {
+        "name": "foo",
+        "sources": [{"target": ".", "key": used_key}],
+        "build": {"commands": [{"cmd": ["/bin/bash", "build.sh"]}]}
+        }
+    artifact_id, path = bldr.ensure_present(spec, config)
+    eq_(bldr.get_gc_rooted_source_keys(), set())
+    bldr.create_symlink_to_artifact(artifact_id, pjoin(tempdir, 'profile'))
+    eq_(bldr.get_gc_rooted_source_keys(), set([used_key]))
+
+    removed = sc.gc(keep_keys=bldr.get_gc_rooted_source_keys(), max_bytes=0)
+    eq_([(type, hash) for _, _, type, hash in removed], [tuple(unused_key.split(':'))])
+
+
+@fixture()
+def test_index(tempdir, sc, bldr, config):
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    numpy = MockPackage("numpy", [blas, libc])
+    artifacts = build_mock_packages(bldr, config, [libc, blas, numpy])
+    libc_id, blas_id, numpy_id = [artifacts[x][0] for x in ['libc', 'blas', 'numpy']]
+    eq_(sorted([libc_id, blas_id]), bldr.index.get_dependencies(numpy_id))
+    eq_(sorted([libc_id, blas_id, numpy_id]), [row[0] for row in bldr.index.list_artifacts()])
+    # found through the index only
+    shutil.rmtree(artifacts['blas'][1])
+    eq_(artifacts['blas'][1], bldr.resolve(blas_id))
+    eq_(2, bldr.reindex())
+    eq_(None, bldr.resolve(blas_id))
+
+    # an index created later is filled from disk, and artifacts not in the
+    # index are still found
+    os.unlink(pjoin(bldr.artifact_root, '.index.sqlite'))
+    other = build_store.BuildStore.create_from_config(config, logger)
+    eq_(sorted([libc_id, numpy_id]), [row[0] for row in other.index.list_artifacts()])
+    with other.index.transaction() as conn:
+        conn.execute('DELETE FROM artifacts')
+    eq_(artifacts['libc'][1], other.resolve(libc_id))
+    eq_([], other.get_dependencies(libc_id))
+
+    # users who can not write to the index can still use the store
+    def readonly_transaction(*args):
+        raise sqlite3.OperationalError('attempt to write a readonly database')
+    other.index.transaction = readonly_transaction
+    eq_(artifacts['libc'], build_mock_packages(other, config, [libc])['libc'])
+    other.create_symlink_to_artifact(libc_id, pjoin(tempdir, 'libc-profile'))
+    del other.index.transaction
+    os.unlink(pjoin(tempdir, 'libc-profile'))
+    # ...or add artifacts found on disk to it
+    other.index.remove(libc_id)
+    other.index.add = readonly_transaction
+    eq_(artifacts['libc'][1], other.resolve(libc_id))
+    del other.index.add
+    # ...or create or upgrade it, then it is indexed in memory
+    index_file = pjoin(bldr.artifact_root, '.index.sqlite')
+    with other.index.transaction() as conn:
+        conn.execute('PRAGMA user_version = 1')
+    def fail_create_file():
+        raise OSError(errno.EACCES, 'Permission denied')
+    for setup in ['outdated', 'missing']:
+        readonly_store = build_store.BuildStore.create_from_config(config, logger)
+        readonly_store.index._create = readonly_transaction
+        if setup == 'missing':
+            os.unlink(index_file)
+            readonly_store.index._create_file = fail_create_file
+        eq_(sorted([libc_id, numpy_id]),
+            [row[0] for row in readonly_store.index.list_artifacts()])
+        eq_(artifacts['libc'][1], readonly_store.resolve(libc_id))
+        assert not os.path.exists(index_file) or setup == 'outdated'
+
+    # gc keeps the index in sync, and also finds what is not in it
+    other = build_store.BuildStore.create_from_config(config, logger)
+    with other.index.transaction() as conn:
+        conn.execute('DELETE FROM artifacts')
+    other.gc(grace_seconds=0)
+    eq_([], other.index.list_artifacts())
+    assert not os.path.exists(artifacts['numpy'][1])
+    eq_(None, other.resolve(numpy_id))
+
+    # the database is writable by whoever may write to the artifact root
+    os.unlink(index_file)
+    os.chmod(bldr.artifact_root, 0o775)
+    old_umask = os.umask(0o022)
+    try:
+        build_store.BuildStore.create_from_config(config, logger).index.list_artifacts()
+    finally:
+        os.umask(old_umask)
+    eq_(0o664, os.stat(index_file).st_mode & 0o777)
+
+@contextmanager
+def lock_held_by_other_process(path):
+    # locks are per process, so taking it here would not exclude ourselves
+    locked, done = multiprocessing.Event(), multiprocessing.Event()
+    def hold():
+        with FileLock(path):
+            locked.set()
+            done.wait()
+    process = multiprocessing.Process(target=hold)
+    process.start()
+    try:
+        locked.wait()
+        yield
+    finally:
+        done.set()
+        process.join()
+
+@fixture()
+def test_gc(tempdir, sc, bldr, config):
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    numpy = MockPackage("numpy", [blas])
+    zlib = MockPackage("zlib", [])
+    artifacts = build_mock_packages(bldr, config, [libc, blas, numpy, zlib])
+    bldr.create_symlink_to_artifact(artifacts['numpy'][0], pjoin(tempdir, 'profile'))
+
+    # incomplete artifacts: crashed long ago, being built, or recent
+    old = time.time() - 7200
+    for name in ['crashed', 'building', 'recent']:
+        os.makedirs(pjoin(bldr.artifact_root, 'foo', name))
+        with open(pjoin(bldr.artifact_root, 'foo', name, 'data'), 'w') as f:
+            f.write('x' * 1000)
+        if name != 'recent':
+            os.utime(pjoin(bldr.artifact_root, 'foo', name), (old, old))
+    build_lock = bldr._get_build_lock_path(pjoin(bldr.artifact_root, 'foo', 'building'))
+
+    # a dry run does not index what it finds
+    bldr.index.remove(artifacts['libc'][0])
+    bldr.gc(dry_run=True)
+    eq_(None, bldr.index.lookup(artifacts['libc'][0]))
+
+    # zlib is unreferenced, but was built too recently
+    with lock_held_by_other_process(build_lock):
+        eq_([pjoin(bldr.artifact_root, 'foo', 'crashed')],
+            [name for nbytes, name in bldr.gc(dry_run=True)])
+        bldr.index.touch(artifacts['zlib'][0], old)
+        removed = bldr.gc(dry_run=True)
+    eq_([artifacts['zlib'][0], pjoin(bldr.artifact_root, 'foo', 'crashed')],
+        [name for nbytes, name in removed])
+    assert all(nbytes > 1000 for nbytes, name in removed)
+    assert os.path.exists(artifacts['zlib'][1])
+
+    # the dependencies of a build in progress are kept, however long it takes
+    building_json = pjoin(bldr.artifact_root, 'foo', 'building', 'artifact.json')
+    with open(building_json, 'w') as f:
+        json.dump({'id': 'foo/building', 'dependencies': [artifacts['zlib'][0]]}, f)
+    os.utime(pjoin(bldr.artifact_root, 'foo', 'building'), (old, old))
+    with lock_held_by_other_process(build_lock):
+        eq_([pjoin(bldr.artifact_root, 'foo', 'crashed')],
+            [name for nbytes, name in bldr.gc(dry_run=True)])
+    os.unlink(building_json)
+    os.utime(pjoin(bldr.artifact_root, 'foo', 'building'), (old, old))
+
+    # an artifact used after it was listed is kept
+    list_artifacts = bldr.index.list_artifacts
+    def list_then_touch():
+        rows = list_artifacts()
+        bldr.index.touch(artifacts['zlib'][0])
+        return rows
+    bldr.index.list_artifacts = list_then_touch
+    try:
+        with lock_held_by_other_process(build_lock):
+            removed = bldr.gc()
+    finally:
+        del bldr.index.list_artifacts
+    eq_([pjoin(bldr.artifact_root, 'foo', 'crashed')], [name for nbytes, name in removed])
+    assert os.path.exists(artifacts['zlib'][1])
+    bldr.index.touch(artifacts['zlib'][0], old)
+    os.makedirs(pjoin(bldr.artifact_root, 'foo', 'crashed'))
+    os.utime(pjoin(bldr.artifact_root, 'foo', 'crashed'), (old, old))
+
+    # the lock left behind by a killed build goes too
+    with open(pjoin(bldr.artifact_root, 'foo', '.killed.lock'), 'w') as f:
+        f.write('somehost 1\n')
+    with lock_held_by_other_process(build_lock):
+        removed = bldr.gc(jobs=2)
+    eq_(2, len(removed))
+    eq_(artifacts['libc'][1], pjoin(bldr.artifact_root, bldr.index.lookup(artifacts['libc'][0])))
+    eq_(['building', 'recent'], sorted(os.listdir(pjoin(bldr.artifact_root, 'foo'))))
+    for name in ['libc', 'blas', 'numpy']:
+        assert os.path.exists(artifacts[name][1])
+    assert not os.path.exists(artifacts['zlib'][1])
+    eq_(None, bldr.resolve(artifacts['zlib'][0]))
+    eq_([], os.listdir(pjoin(bldr.artifact_root, '.trash')))
+
+    # without the lock, abandoned builds go as well
+    eq_(2, len(bldr.gc(grace_seconds=0)))
+    eq_([], os.listdir(pjoin(bldr.artifact_root, 'foo')))
+
+@fixture()
+def test_optimise(tempdir, sc, bldr, config):
+    def build(name, text):
+        spec = {"name": name,
+                "files": [{"target": "$ARTIFACT/share/doc", "text": [text], "expandvars": True},
+                          {"target": "$ARTIFACT/share/writable", "text": [text], "expandvars": True}],
+                "build": {"commands": [{"hit": ["build-write-files", "--key=files", "build.json"]},
+                                       {"cmd": [which('touch'), "-d", "@1000000000",
+                                                "${ARTIFACT}/share/doc"]},
+                                       {"cmd": [which('chmod'), "a-w", "${ARTIFACT}/share/doc"]}]}}
+        return bldr.ensure_present(spec, config)
+
+    a_id, a_path = build('a', 'x' * 10000)
+    b_id, b_path = build('b', 'x' * 10000)
+    c_id, c_path = build('c', 'y' * 10000)
+    eq_(10000, bldr.optimise(jobs=2))
+    inode = lambda *path: os.stat(pjoin(*path)).st_ino
+    eq_(inode(a_path, 'share', 'doc'), inode(b_path, 'share', 'doc'))
+    assert inode(a_path, 'share', 'writable') != inode(b_path, 'share', 'writable')
+    eq_('x' * 10000, utils.cat(pjoin(b_path, 'share', 'doc')))
+    eq_(0, bldr.optimise())
+
+    # files already linked are not hashed again, even when all artifacts
+    # are looked at again
+    d_id, d_path = build('d', 'y' * 10000)
+    hashed = []
+    orig_sha256 = hashlib.sha256
+    build_store.hashlib.sha256 = lambda: hashed.append(1) or orig_sha256()
+    try:
+        eq_(10000, bldr.optimise([d_id]))
+        assert hashed
+        del hashed[:]
+        bldr.reindex()
+        eq_(0, bldr.optimise())
+    finally:
+        build_store.hashlib.sha256 = orig_sha256
+    eq_([], hashed)
+    eq_(inode(c_path, 'share', 'doc'), inode(d_path, 'share', 'doc'))
+
+    # files that differ in their mtime are not merged
+    f_id, f_path = build('f', 'x' * 10000)
+    os.utime(pjoin(f_path, 'share', 'doc'), None)
+    eq_(0, bldr.optimise([f_id]))
+    assert inode(a_path, 'share', 'doc') != inode(f_path, 'share', 'doc')
+    eq_(1000000000, os.stat(pjoin(a_path, 'share', 'doc')).st_mtime)
+
+    # files no artifact links to any more are removed by gc
+    links_dir = pjoin(bldr.artifact_root, '.links')
+    assert inode(c_path, 'share', 'doc') in [inode(links_dir, x) for x in os.listdir(links_dir)]
+    bldr.create_symlink_to_artifact(b_id, pjoin(tempdir, 'profile'))
+    bldr.gc(grace_seconds=0)
+    b_inodes = set(inode(b_path, x) for x in ['build.json', 'build.log.gz', 'share/doc'])
+    eq_(b_inodes, set(inode(links_dir, x) for x in os.listdir(links_dir)))
+    eq_('x' * 10000, utils.cat(pjoin(b_path, 'share', 'doc')))
+    # and so are their digests
+    rows = bldr.index._connect().execute('SELECT ino FROM file_digests').fetchall()
+    eq_(b_inodes, set(row[0] for row in rows))
+
+    # a file with the same stat data, except for the ctime, is hashed again
+    filename = pjoin(tempdir, 'file')
+    with open(filename, 'w') as f:
+        f.write('x')
+    st = os.stat(filename)
+    bldr.index.put_file_digests([(st, 'digest')])
+    eq_('digest', bldr.index.get_file_digest(st))
+    time.sleep(0.01)
+    os.chmod(filename, 0o444)
+    os.utime(filename, (st.st_atime, st.st_mtime))
+    eq_(None, bldr.index.get_file_digest(os.stat(filename)))
+
+    # the build store can be set to optimise after each build
+    bldr.optimise_after_build = True
+    e_id, e_path = build('e', 'x' * 10000)
+    eq_(inode(b_path, 'share', 'doc'), inode(e_path, 'share', 'doc'))
@@ -1,9 +1,15 @@
 import os
+import stat
+import errno
+import time
+import threading
 from os.path import join as pjoin
 
 from .utils import temp_dir, assert_raises
 from .. import fileutils
 
+from nose.tools import eq_
+
 def test_rmtree_up_to():
     with temp_dir() as d:
         # Incomplete removal
@@ -23,3 +29,102 @@ def test_rmtree_up_to():
         # Parent is exclusive
         fileutils.rmtree_up_to(d, d)
         assert os.path.exists(d)
+
+def _hold_lock_in_child(path):
+    # Returns (pid, write end of pipe); the child holds the lock at `path`
+    # until the pipe is closed
+    r, w = os.pipe()
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(w)
+            with fileutils.FileLock(path):
+                os.write(ready_w, 'x')
+                os.read(r, 1)
+        finally:
+            os._exit(0)
+    os.close(r)
+    os.read(ready_r, 1)
+    return pid, w
+
+def test_file_lock():
+    with temp_dir() as d:
+        path = pjoin(d, 'locks', 'foo.lock')
+        pid, w = _hold_lock_in_child(path)
+        try:
+            lock = fileutils.FileLock(path)
+            assert not lock.acquire(timeout=0.3)
+        finally:
+            os.close(w)
+            os.waitpid(pid, 0)
+        # released by the other process
+        with fileutils.FileLock(path):
+            assert os.path.exists(path)
+        assert not os.path.exists(path)
+
+def test_file_lock_threads():
+    with temp_dir() as d:
+        path = pjoin(d, 'foo.lock')
+        holders = []
+        max_holders = []
+
+        def worker():
+            for i in range(5):
+                with fileutils.FileLock(path):
+                    holders.append(1)
+                    max_holders.append(len(holders))
+                    time.sleep(0.01)
+                    holders.pop()
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert max(max_holders) == 1
+        assert not os.path.exists(path)
+        # a thread waiting for a lock held in the same process times out
+        with fileutils.FileLock(path):
+            result = []
+            t = threading.Thread(target=lambda: result.append(
+                fileutils.FileLock(path).acquire(timeout=0.3)))
+            t.start()
+            t.join()
+            assert result == [False]
+            assert os.path.exists(path)
+
+def test_file_lock_permissions():
+    with temp_dir() as d:
+        # others who may create the lock file may also open it, whatever the umask
+        os.chmod(d, 0o2775)
+        path = pjoin(d, 'foo.lock')
+        old_umask = os.umask(0o077)
+        try:
+            with fileutils.FileLock(path):
+                eq_(0o664, stat.S_IMODE(os.stat(path).st_mode))
+        finally:
+            os.umask(old_umask)
+
+        if os.getuid() != 0:
+            with open(path, 'w'):
+                pass
+            os.chmod(path, 0o444)
+            with assert_raises(OSError) as e:
+                fileutils.FileLock(path).acquire(timeout=0)
+            eq_(errno.EACCES, e.exc_val.errno)
+            assert 'another user' in str(e.exc_val)
+
+def test_file_lock_stale():
+    with temp_dir() as d:
+        path = pjoin(d, 'foo.lock')
+        pid, w = _hold_lock_in_child(path)
+        try:
+            # stale because it hasn't been refreshed
+            os.utime(path, (0, 0))
+            lock = fileutils.FileLock(path, stale_seconds=60)
+            assert lock.acquire(timeout=1)
+            lock.release()
+        finally:
+            os.close(w)
+            os.waitpid(pid, 0)
+
@@ -6,6 +6,7 @@ import subprocess
 import hashlib
 from StringIO import StringIO
 import stat
+from glob import glob
 import errno
 from contextlib import closing
 
@@ -14,12 +15,15 @@ pjoin = os.path.join
 from ..source_cache import (ArchiveSourceCache, SourceCache,
         CorruptSourceCacheError, hit_pack, hit_unpack, scatter_files,
         KeyNotFoundError, SourceNotFoundError, SecurityError, RemoteFetchError)
+from ..source_cache import (_find_program, SourceCacheGC, SourceCacheVerifier,
+                             GitSourceCache, ExtractedTreeCache)
 from ..hasher import Hasher, format_digest
 
 from .utils import temp_dir, working_directory, VERBOSE, logger, assert_raises, MemoryLogger
 from . import utils
 
 from nose.tools import eq_
+from nose import SkipTest
 
 #
 # Fixture
@@ -157,6 +161,49 @@ def test_trap_tarball_attack():
                     sc.unpack(key, d)
                 assert any('attempted to break out' in line for line in logger.lines)
 
+def make_tarball_with_symlink(d, linkname, through_link):
+    # pkg/link -> linkname, and optionally a file written through it
+    import tarfile
+    tarball = pjoin(d, 'symlink.tar.gz')
+    with closing(tarfile.open(tarball, 'w:gz')) as tf:
+        info = tarfile.TarInfo('pkg/link')
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+        tf.addfile(info)
+        name = 'pkg/link/evil' if through_link else 'pkg/README'
+        info = tarfile.TarInfo(name)
+        info.size = 4
+        tf.addfile(info, StringIO('evil'))
+    with open(tarball, 'rb') as f:
+        return tarball, format_digest(hashlib.sha256(f.read()))
+
+def test_trap_tarball_symlink_attack():
+    from ..source_cache import create_archive_handler
+    handler = create_archive_handler('tar.gz')
+    with temp_dir() as d:
+        outside = pjoin(d, 'outside')
+        os.mkdir(outside)
+        tarball, sha = make_tarball_with_symlink(d, outside, through_link=True)
+        for hash in [sha, 'wrong']:
+            with temp_dir() as target:
+                with open(tarball, 'rb') as f:
+                    with assert_raises(SecurityError if hash == sha else CorruptSourceCacheError):
+                        handler.unpack(f, target, hash)
+            eq_([], os.listdir(outside))
+        # with a verified archive, symlinks out of the target are created
+        # once the hash is checked
+        tarball, sha = make_tarball_with_symlink(d, outside, through_link=False)
+        with temp_dir() as target:
+            with open(tarball, 'rb') as f:
+                handler.unpack(f, target, sha)
+            eq_(outside, os.readlink(pjoin(target, 'link')))
+            eq_('evil', utils.cat(pjoin(target, 'README')))
+        with temp_dir() as target:
+            with open(tarball, 'rb') as f:
+                with assert_raises(CorruptSourceCacheError):
+                    handler.unpack(f, target, 'wrong')
+            eq_([], os.listdir(target))
+
 def test_tarball():
     with temp_source_cache() as sc:
         key = sc.fetch_archive('file:' + mock_tarball)
@@ -242,6 +289,190 @@ def test_git_fetch_submodules():
                     s = f.read()
                     assert s == content
 
+def test_git_unpack_archive():
+    root_repo, master_commit, devel_commit = make_mock_git_repo(submodules={'subdir/submod': mock_git_repo,
+                                                                            'submod': mock_git_repo})
+    with temp_source_cache() as sc:
+        sc.fetch(root_repo, 'git:' + master_commit, 'rootproject')
+        sc.git_unpack = 'archive'
+        with temp_dir() as d:
+            sc.unpack('git:' + master_commit, d)
+            assert not os.path.exists(pjoin(d, '.git'))
+            for path, content in {('README',): 'First revision',
+                                  ('submod', 'README'): 'Second revision',
+                                  ('subdir', 'submod', 'README'): 'Second revision'}.items():
+                with open(pjoin(d, *path)) as f:
+                    eq_(f.read(), content)
+            eq_([x for x in os.listdir(d) if x.startswith('.unpacking-')], [])
+        # No temporary branches are left around by either mode
+        sc.git_unpack = 'checkout'
+        with temp_dir() as d:
+            sc.unpack('git:' + master_commit, d)
+        assert not os.path.exists(pjoin(sc.cache_path, 'git', 'rootproject', 'refs', 'heads', 'tempmark'))
+
+def count_commits(sc, repo_name, commit):
+    env = dict(os.environ, GIT_DIR=pjoin(sc.cache_path, 'git', repo_name))
+    p = subprocess.Popen(['git', 'rev-list', '--count', commit], env=env, stdout=subprocess.PIPE)
+    out, err = p.communicate()
+    return int(out)
+
+@contextlib.contextmanager
+def git_config_env(**config):
+    # Pass configuration on to all git processes (including upload-pack)
+    old = dict(os.environ)
+    n = int(os.environ.get('GIT_CONFIG_COUNT', '0'))
+    for key, value in config.items():
+        os.environ['GIT_CONFIG_KEY_%d' % n] = key.replace('_', '.')
+        os.environ['GIT_CONFIG_VALUE_%d' % n] = value
+        n += 1
+    os.environ['GIT_CONFIG_COUNT'] = str(n)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(old)
+
+def test_git_fetch_shallow():
+    from ..source_cache import GitSourceCache
+    with temp_source_cache() as sc:
+        git_cache = GitSourceCache(sc)
+        sc.fetch(mock_git_repo, 'git:' + mock_git_devel_branch_commit, 'foo')
+        eq_(count_commits(sc, 'foo', mock_git_devel_branch_commit), 1)
+        eq_(git_cache.get_shallow_commits('foo'), {mock_git_devel_branch_commit: mock_git_repo})
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_devel_branch_commit, d)
+            with open(pjoin(d, 'README')) as f:
+                eq_(f.read(), 'Second revision')
+
+        # fetching the same commit shallowly again records it once
+        assert git_cache._fetch_shallow('foo', mock_git_repo, mock_git_devel_branch_commit)
+        with open(git_cache._get_shallow_record_filename('foo')) as f:
+            eq_(1, len(f.readlines()))
+
+        git_cache.deepen('foo')
+        eq_(count_commits(sc, 'foo', mock_git_devel_branch_commit), 2)
+        eq_(git_cache.get_shallow_commits('foo'), {})
+
+    # A server refusing requests for unadvertised commits gets a full fetch
+    hiding_repo, master_commit, devel_commit = make_mock_git_repo()
+    try:
+        repo = pjoin(hiding_repo, '.git')
+        git('--git-dir', repo, 'config', 'uploadpack.hideRefs', 'refs/heads/master', repo=repo)
+        with temp_source_cache() as sc:
+            with git_config_env(protocol_version='0'):
+                sc.fetch(hiding_repo, 'git:' + master_commit, 'foo')
+            eq_(GitSourceCache(sc).get_shallow_commits('foo'), {})
+            eq_(count_commits(sc, 'foo', devel_commit), 2)
+    finally:
+        shutil.rmtree(hiding_repo)
+
+def test_git_commit_index():
+    from ..source_cache import GitSourceCache
+    with temp_source_cache() as sc:
+        sc.fetch_git(mock_git_repo, 'master', 'foo')
+        sc.fetch_git(mock_git_repo, 'devel', 'bar')
+        git_cache = GitSourceCache(sc)
+        eq_(git_cache._lookup_commit(mock_git_commit), 'foo')
+        eq_(git_cache._lookup_commit(mock_git_devel_branch_commit), 'bar')
+
+        def check_unpack(commit, content):
+            with temp_dir() as d:
+                sc.unpack('git:' + commit, pjoin(d, 'x'))
+                with open(pjoin(d, 'x', 'README')) as f:
+                    eq_(f.read(), content)
+
+        # Lost index is rebuilt from the inuse/* branches
+        shutil.rmtree(git_cache.index_path)
+        check_unpack(mock_git_commit, 'First revision')
+        eq_(git_cache._lookup_commit(mock_git_commit), 'foo')
+        eq_(git_cache._lookup_commit(mock_git_devel_branch_commit), 'bar')
+
+        # A wrong entry is detected and corrected
+        git_cache._index_commit('nonexisting', mock_git_devel_branch_commit)
+        check_unpack(mock_git_devel_branch_commit, 'Second revision')
+        eq_(git_cache._lookup_commit(mock_git_devel_branch_commit), 'bar')
+
+def git_count_objects(sc, repo_name):
+    env = dict(os.environ, GIT_DIR=pjoin(sc.cache_path, 'git', repo_name))
+    p = subprocess.Popen(['git', 'count-objects', '-v'], env=env, stdout=subprocess.PIPE)
+    out, err = p.communicate()
+    return dict((key, int(value)) for key, value in
+                (line.split(': ') for line in out.splitlines()) if value.isdigit())
+
+def count_local_objects(sc, repo_name):
+    counts = git_count_objects(sc, repo_name)
+    return counts['count'] + counts['in-pack']
+
+def test_git_object_pool():
+    with temp_source_cache() as sc:
+        git_cache = GitSourceCache(sc)
+        # a full fetch ends up in the pool, and is then present under any name
+        sc.fetch_git(mock_git_repo, 'devel', 'foo')
+        eq_(0, count_local_objects(sc, 'foo'))
+        sc.fetch('git://not-valid', 'git:' + mock_git_devel_branch_commit, 'bar')
+        eq_([mock_git_devel_branch_commit], git_cache._list_inuse_commits('bar'))
+        eq_(0, count_local_objects(sc, 'bar'))
+
+        # removing a repository leaves the others working
+        SourceCacheGC(sc).remove('git', 'foo')
+        eq_(['bar'], git_cache._list_repo_names())
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_devel_branch_commit, pjoin(d, 'x'))
+            eq_('Second revision', utils.cat(pjoin(d, 'x', 'README')))
+
+    with temp_source_cache() as sc:
+        # shallow fetches stay out of the pool, but are fetched locally
+        # rather than downloaded again under another name
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'foo')
+        assert count_local_objects(sc, 'foo') > 0
+        sc.fetch('git://not-valid', 'git:' + mock_git_commit, 'bar')
+        eq_({mock_git_commit: mock_git_repo}, GitSourceCache(sc).get_shallow_commits('bar'))
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_commit, pjoin(d, 'x'))
+            eq_('First revision', utils.cat(pjoin(d, 'x', 'README')))
+
+def test_git_maintain():
+    with temp_source_cache() as sc:
+        git_cache = GitSourceCache(sc)
+        sc.fetch_git(mock_git_repo, 'master', 'foo')
+        sc.fetch_git(mock_git_repo, 'devel', 'bar')
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'shallow')
+        inuse = dict((name, git_cache._list_inuse_commits(name)) for name in ['foo', 'bar', 'shallow'])
+        sc.maintain(jobs=2)
+        for name in ['foo', 'bar', 'shallow', '.pool']:
+            eq_([], os.listdir(pjoin(sc.cache_path, 'git', name, 'refs', 'heads')))
+            eq_(0, git_count_objects(sc, name)['count'])
+        for name, commits in inuse.items():
+            eq_(commits, git_cache._list_inuse_commits(name))
+            assert git_cache._does_branch_exist(name, 'inuse/' + commits[0])
+        assert not git_cache._does_branch_exist('foo', 'inuse/' + mock_git_devel_branch_commit)
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_commit, pjoin(d, 'x'))
+            eq_('First revision', utils.cat(pjoin(d, 'x', 'README')))
+
+        # objects only used by a removed repository are kept in the pool
+        # unless pruned, and then only once they are old enough
+        pool_objects = count_local_objects(sc, '.pool')
+        SourceCacheGC(sc).remove('git', 'bar')
+        sc.maintain()
+        eq_(pool_objects, count_local_objects(sc, '.pool'))
+        sc.maintain(prune_pool=True)
+        eq_(pool_objects, count_local_objects(sc, '.pool'))
+        git_cache.pool_prune_expire = 'now'
+        git_cache.prune_pool()
+        assert count_local_objects(sc, '.pool') < pool_objects
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_commit, pjoin(d, 'x'))
+
+    # automatically after every so many fetches
+    with temp_dir() as d:
+        sc = SourceCache(d, logger, git_maintain_after=2)
+        inuse_dir = pjoin(d, 'git', 'foo', 'refs', 'heads', 'inuse')
+        sc.fetch_git(mock_git_repo, 'master', 'foo')
+        eq_(1, len(os.listdir(inuse_dir)))
+        sc.fetch_git(mock_git_repo, 'devel', 'foo')
+        assert not os.path.exists(inuse_dir)
+
 def test_unpack_nonexisting_git():
     with temp_source_cache() as sc:
         with temp_dir() as d:
@@ -341,6 +572,72 @@ def test_hdist_pack():
     unpacked_files = hit_unpack(StringIO(pack), key)
     assert sorted(files) == sorted(unpacked_files)
 
+def test_hit_pack_v2():
+    from ..source_cache import write_hit_pack, HitPackReader
+    files = [('foo', 'contains foo'),
+             ('a/b', 'in a subdir')]
+    with temp_dir() as d:
+        for name, contents in [('bar', 'contains bar'), ('a/c', 'also in subdir')]:
+            with open(pjoin(d, name.replace('/', '_')), 'w') as f:
+                f.write(contents)
+        paths = [('bar', pjoin(d, 'bar')), ('a/c', pjoin(d, 'a_c'))]
+
+        # Same key as the v1 format for the same contents
+        pack_path = pjoin(d, 'pack')
+        with open(pack_path, 'wb') as f:
+            key = write_hit_pack(f, files, paths)
+        eq_(key, 'files:ruwkpei2ot2fp77myn2n2n4ttefuabab')
+        eq_(write_hit_pack(None, dict(files), dict(paths)), key)
+
+        with open(pack_path, 'rb') as f:
+            reader = HitPackReader(f)
+        with closing(reader):
+            eq_(reader.names(), ['a/b', 'a/c', 'bar', 'foo'])
+            eq_(reader.read('bar'), 'contains bar')
+            reader.verify(key)
+            with assert_raises(CorruptSourceCacheError):
+                reader.verify('files:ruwkpei2ot2fp77myn2n2n4ttefuabaa')
+            reader.unpack(pjoin(d, 'out'), key)
+            # existing files are not overwritten
+            with assert_raises(OSError) as cm:
+                reader.unpack(pjoin(d, 'out'), key)
+            eq_(errno.EEXIST, cm.exc_val.errno)
+        with open(pjoin(d, 'out', 'a', 'c')) as f:
+            eq_(f.read(), 'also in subdir')
+        eq_(sorted(os.listdir(pjoin(d, 'out'))), ['a', 'bar', 'foo'])
+
+        # Old v1 packs are read as well
+        v1_path = pjoin(d, 'v1pack')
+        with open(v1_path, 'wb') as f:
+            hit_pack(files + [('bar', 'contains bar'), ('a/c', 'also in subdir')], f)
+        with open(v1_path, 'rb') as f:
+            with closing(HitPackReader(f)) as reader:
+                eq_(reader.read('a/b'), 'in a subdir')
+                reader.verify(key)
+
+        # A tampered pack is detected and nothing is unpacked
+        with open(pack_path, 'rb') as f:
+            data = f.read()
+        with open(pack_path, 'wb') as f:
+            f.write(data.replace('contains foo', 'contains fOo'))
+        with open(pack_path, 'rb') as f:
+            with closing(HitPackReader(f)) as reader:
+                os.mkdir(pjoin(d, 'out2'))
+                with assert_raises(CorruptSourceCacheError):
+                    reader.unpack(pjoin(d, 'out2'), key)
+        eq_(os.listdir(pjoin(d, 'out2')), [])
+
+def test_put_paths():
+    with temp_source_cache() as sc:
+        with temp_dir() as d:
+            with open(pjoin(d, 'patch'), 'w') as f:
+                f.write('the patch')
+            key = sc.put({'build.sh': 'the script'}, {'patch': pjoin(d, 'patch')})
+            eq_(key, sc.put({'build.sh': 'the script', 'patch': 'the patch'}))
+            sc.unpack(key, pjoin(d, 'out'))
+            with open(pjoin(d, 'out', 'patch')) as f:
+                eq_(f.read(), 'the patch')
+
 def test_scatter_files():
     files = [('foo', 'contains foo'),
              ('bar', 'contains bar'),
@@ -377,6 +674,96 @@ def test_corrupt_archive():
             with assert_raises(SourceNotFoundError):
                 sc.fetch_archive('file:' + archive_path2)
 
+def snapshot_tree(path):
+    result = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(pjoin(dirpath, name))
+            result.append((pjoin(dirpath, name), st.st_mtime, st.st_size))
+    return sorted(result)
+
+def test_tiers():
+    root_repo, master_commit, devel_commit = make_mock_git_repo(submodules={'submod': mock_git_repo})
+    try:
+        with temp_source_cache() as shared:
+            tarball_key = shared.fetch_archive('file:' + mock_tarball)
+            files_key = shared.put({'a': 'a'})
+            shared.fetch(root_repo, 'git:' + master_commit, 'rootproject')
+            before = snapshot_tree(shared.cache_path)
+
+            for promote in [False, True]:
+                tier = SourceCache(shared.cache_path, logger, read_only=True, promote=promote)
+                with temp_dir() as local_dir:
+                    sc = SourceCache(local_dir, logger, tiers=[tier])
+                    asc = ArchiveSourceCache(sc)
+                    sc.fetch(None, tarball_key)
+                    eq_(files_key, sc.put({'a': 'a'}))
+                    with temp_dir() as d:
+                        sc.unpack(tarball_key, pjoin(d, 'tarball'))
+                        sc.unpack(files_key, pjoin(d, 'files'))
+                        sc.unpack('git:' + master_commit, pjoin(d, 'git'))
+                        eq_('file contents', utils.cat(pjoin(d, 'tarball', '0', 'README')))
+                        eq_('a', utils.cat(pjoin(d, 'files', 'a')))
+                        eq_('Second revision', utils.cat(pjoin(d, 'git', 'submod', 'README')))
+                    eq_(promote, asc.contains(*tarball_key.split(':')))
+                    eq_(promote, asc.contains(*files_key.split(':')))
+                    # git commits are always fetched locally
+                    eq_(['rootproject', 'rootproject.submod'],
+                        GitSourceCache(sc)._list_repo_names())
+                    with assert_raises(KeyNotFoundError):
+                        sc.unpack(mock_zipfile_hash, local_dir)
+            # nothing was written to the shared cache
+            eq_(before, snapshot_tree(shared.cache_path))
+
+            # a corrupt pack is not promoted
+            pack = ArchiveSourceCache(shared).get_pack_filename(*tarball_key.split(':'))
+            os.chmod(pack, stat.S_IRUSR | stat.S_IWUSR)
+            with open(pack, 'r+b') as f:
+                f.seek(50)
+                f.write('corrupt')
+            with temp_dir() as local_dir:
+                tier = SourceCache(shared.cache_path, logger, read_only=True, promote=True)
+                sc = SourceCache(local_dir, logger, tiers=[tier])
+                with assert_raises(CorruptSourceCacheError):
+                    sc.fetch(None, tarball_key)
+                assert not ArchiveSourceCache(sc).contains(*tarball_key.split(':'))
+    finally:
+        shutil.rmtree(root_repo)
+
+def test_tiers_from_config():
+    with temp_dir() as local_dir, temp_dir() as shared_dir:
+        config = {'source_caches': [{'dir': shared_dir, 'read_only': True},
+                                    {'dir': local_dir, 'download_connections': 2},
+                                    {'url': 'http://example.com/src'}]}
+        sc = SourceCache.create_from_config(config, logger)
+        eq_(os.path.realpath(local_dir), sc.cache_path)
+        eq_(2, sc.download_connections)
+        eq_([os.path.realpath(shared_dir)], [tier.cache_path for tier in sc.tiers])
+        eq_([(True, False)], [(tier.read_only, tier.promote) for tier in sc.tiers])
+        eq_(['http://example.com/src'], sc.mirrors)
+        with assert_raises(NotImplementedError):
+            SourceCache.create_from_config({'source_caches': config['source_caches'][:1]}, logger)
+
+def test_validation_while_downloading():
+    from ..source_cache import TarGzHandler
+    def verify(self, filename):
+        raise AssertionError('archive was read again after downloading')
+    with temp_dir() as d:
+        with open(pjoin(d, 'garbage.tar.gz'), 'wb') as f:
+            f.write('\x1f\x8b' + 'not an archive' * 1000)
+        shutil.copy(mock_tarball, pjoin(d, 'archive.tar.gz'))
+        TarGzHandler.verify = verify
+        try:
+            with utils.http_server(d) as (url, state):
+                with temp_source_cache() as sc:
+                    eq_(mock_tarball_hash, sc.fetch_archive(url + '/archive.tar.gz'))
+                    with assert_raises(SourceNotFoundError):
+                        sc.fetch_archive(url + '/garbage.tar.gz')
+                    eq_([mock_tarball_hash.split(':')[1]],
+                        os.listdir(pjoin(sc.cache_path, 'packs', 'tar.gz')))
+        finally:
+            del TarGzHandler.verify
+
 def test_mirrors():
     with temp_dir() as sc_dir:
         with temp_dir() as mirror1:
@@ -390,3 +777,597 @@ def test_mirrors():
                 sc.fetch('http://nonexisting.com', mock_tarball_hash)
                 assert [sha] == os.listdir(pjoin(sc_dir, 'packs', 'tar.gz'))
 
+
+def test_gc():
+    import time
+    root_repo, master_commit, devel_commit = make_mock_git_repo(submodules={'submod': mock_git_repo})
+    with temp_source_cache() as sc:
+        key_a = sc.put({'a': 'a' * 1000})
+        key_b = sc.put({'b': 'b' * 1000})
+        tarball_key = sc.fetch_archive('file:' + mock_tarball)
+        sc.fetch(root_repo, 'git:' + master_commit, 'rootproject')
+        sc.fetch_git(mock_git_repo, 'master', 'other')
+
+        def set_access(key, t):
+            type, name = key.split(':')
+            os.utime(pjoin(sc.cache_path, 'access', type, name), (t, t))
+
+        now = time.time()
+        set_access(key_a, now - 10 * 24 * 3600)
+        set_access(key_b, now - 100)
+        set_access(tarball_key, now - 200)
+        set_access('git:other', now - 300)
+
+        def names(removed):
+            return [(type, name) for _, _, type, name in removed]
+
+        # Nothing to do without limits; a dry run removes nothing
+        eq_(sc.gc(), [])
+        eq_(names(sc.gc(max_age=24 * 3600, dry_run=True)), [tuple(key_a.split(':'))])
+        assert os.path.exists(pjoin(sc.cache_path, 'files', key_a.split(':')[1]))
+
+        # Age limit, then least recently used first; the git repository
+        # holding a kept commit is kept along with its submodule repositories
+        sizes = dict((name, nbytes) for _, nbytes, _, name in SourceCacheGC(sc).list_items())
+        pool_size = SourceCacheGC(sc).get_pool_size()
+        assert pool_size > 0
+        quota = pool_size + sum(sizes.values()) - sum(sizes[key.split(':')[1]]
+                                                      for key in [key_a, tarball_key, 'git:other'])
+        removed = sc.gc(keep_keys=['git:' + master_commit], max_age=24 * 3600, max_bytes=quota)
+        eq_(names(removed), [('files', key_a.split(':')[1]), ('git', 'other'),
+                             tuple(tarball_key.split(':'))])
+        eq_(GitSourceCache(sc)._list_repo_names(), ['rootproject', 'rootproject.submod'])
+        assert not os.path.exists(pjoin(sc.cache_path, 'files', key_a.split(':')[1]))
+        with temp_dir() as d:
+            sc.unpack(key_b, d)
+            sc.unpack('git:' + master_commit, pjoin(d, 'git'))
+            with assert_raises(KeyNotFoundError):
+                sc.unpack(tarball_key, d)
+        # The tarball can be fetched again
+        sc.fetch_archive('file:' + mock_tarball)
+
+def test_verify():
+    with temp_source_cache() as sc:
+        files_key = sc.put({'a': 'a' * 1000})
+        tarball_key = sc.fetch_archive('file:' + mock_tarball)
+        zip_key = sc.fetch_archive('file:' + mock_zipfile)
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'good')
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'broken')
+        with temp_dir() as d:
+            sc.unpack(zip_key, d)
+        for jobs in [1, 4]:
+            eq_([], sc.verify(jobs=jobs))
+
+        def corrupt(filename):
+            os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR)
+            with open(filename, 'r+b') as f:
+                f.seek(100)
+                f.write('corrupt')
+        ac = ArchiveSourceCache(sc)
+        corrupt(ac.get_pack_filename(*tarball_key.split(':')))
+        corrupt(ac.get_pack_filename(*files_key.split(':')))
+        broken_objects = pjoin(sc.cache_path, 'git', 'broken', 'objects')
+        for dirpath, dirnames, filenames in os.walk(broken_objects):
+            for filename in filenames:
+                os.unlink(pjoin(dirpath, filename))
+        os.unlink(ac.get_pack_filename(*zip_key.split(':')))
+
+        problems = sc.verify(jobs=4)
+        eq_([('corrupt', 'files', files_key.split(':')[1]),
+             ('corrupt', 'git', 'broken'),
+             ('corrupt', 'tar.gz', tarball_key.split(':')[1]),
+             ('orphaned', 'zip', zip_key.split(':')[1])],
+            sorted(set(problem[:3] for problem in problems)))
+        # nothing was touched
+        eq_(problems, sc.verify(jobs=4))
+
+        sc.verify(quarantine=True)
+        eq_([], sc.verify())
+        eq_(['files', 'git', 'tar.gz'], sorted(os.listdir(pjoin(sc.cache_path, 'quarantine'))))
+        with temp_dir() as d:
+            with assert_raises(KeyNotFoundError):
+                sc.unpack(tarball_key, d)
+            sc.unpack('git:' + mock_git_commit, d)
+        # the quarantined items are simply fetched again
+        eq_(tarball_key, sc.fetch_archive('file:' + mock_tarball))
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'broken')
+        eq_([], sc.verify())
+        # a quarantined repository still finds its objects in the pool
+        SourceCacheVerifier(sc).quarantine('git', 'good')
+        quarantined, = glob(pjoin(sc.cache_path, 'quarantine', 'git', 'good-*', 'good'))
+        subprocess.check_call(['git', '--git-dir=' + quarantined, 'cat-file', '-e',
+                               mock_git_commit])
+
+def test_fetch_many():
+    with temp_source_cache() as sc:
+        sc.fetch('file:' + mock_tarball, mock_tarball_hash)
+        missing_hash = mock_tarball_hash[:-8] + 'aaaaaaaa'
+        results = sc.fetch_many([('file:' + mock_tarball, mock_tarball_hash, 'foo'),
+                                 ('file:' + mock_zipfile, mock_zipfile_hash, 'bar'),
+                                 ('file:' + mock_zipfile, mock_zipfile_hash, 'bar'),
+                                 (mock_git_repo, 'git:' + mock_git_commit, 'baz'),
+                                 ('file:' + mock_zipfile, missing_hash, 'qux')],
+                                worker_count=3)
+        eq_([mock_tarball_hash, mock_zipfile_hash, 'git:' + mock_git_commit, missing_hash],
+            [r.key for r in results])
+        eq_([True, False, False, False], [r.was_present for r in results])
+        eq_([True, True, True, False], [r.ok for r in results])
+        eq_(os.path.getsize(mock_zipfile), results[1].nbytes)
+        with temp_dir() as d:
+            sc.unpack('git:' + mock_git_commit, d)
+            with open(pjoin(d, 'README')) as f:
+                eq_('First revision', f.read())
+
+def test_tampered_tarball_leaves_nothing_behind():
+    other_tmpdir, other_tarball, other_hash = utils.make_temporary_tarball(
+        [('a/b/0/README', 'tampered contents')])
+    try:
+        with temp_source_cache() as sc:
+            sc.fetch_archive('file:' + mock_tarball)
+            pack_filename = pjoin(sc.cache_path, 'packs', 'tar.gz', mock_tarball_hash.split(':')[1])
+            os.chmod(pack_filename, stat.S_IRUSR | stat.S_IWUSR)
+            shutil.copy(other_tarball, pack_filename)
+            with temp_dir() as d:
+                with assert_raises(CorruptSourceCacheError):
+                    sc.unpack(mock_tarball_hash, d)
+                eq_([], os.listdir(d))
+    finally:
+        shutil.rmtree(other_tmpdir)
+
+def test_unpack_merges_into_existing_dirs():
+    with temp_source_cache() as sc:
+        key = sc.fetch_archive('file:' + mock_tarball)
+        with temp_dir() as d:
+            os.mkdir(pjoin(d, '0'))
+            with open(pjoin(d, '0', 'existing'), 'w') as f:
+                f.write('was here')
+            sc.unpack(key, d)
+            eq_(['0', '1'], sorted(os.listdir(d)))
+            eq_(['README', 'existing'], sorted(os.listdir(pjoin(d, '0'))))
+
+@contextlib.contextmanager
+def external_decompressor(handler_cls, cmd, ok_codes=(0,)):
+    old = handler_cls.__dict__.get('parallel_decompressors')
+    handler_cls.parallel_decompressors = [(cmd, ok_codes)]
+    if '_external_decompressor' in handler_cls.__dict__:
+        del handler_cls._external_decompressor
+    try:
+        yield
+    finally:
+        handler_cls.parallel_decompressors = old
+        if '_external_decompressor' in handler_cls.__dict__:
+            del handler_cls._external_decompressor
+
+def test_external_decompressor():
+    from ..source_cache import TarGzHandler, ExternalDecompressingReadStream
+    if _find_program('gzip') is None:
+        raise SkipTest('gzip not available')
+    # plain gzip stands in for pigz here
+    with external_decompressor(TarGzHandler, ['gzip', '-d', '-c'], (0, 2)):
+        assert TarGzHandler().get_external_decompressor() is not None
+        with temp_source_cache() as sc:
+            key = sc.fetch_archive('file:' + mock_tarball)
+            with temp_dir() as d:
+                sc.unpack(key, d)
+                with open(pjoin(d, '0', 'README')) as f:
+                    eq_(f.read(), 'file contents')
+
+        # failures of the program are reported
+        with closing(ExternalDecompressingReadStream(StringIO('not gzip'),
+                                                     ['gzip', '-d', '-c'])) as stream:
+            with assert_raises(IOError):
+                stream.read()
+
+        # closing early does not wait for the rest
+        data = os.urandom(1024) * 4096
+        compressed = StringIO()
+        with closing(gzip_file(compressed)) as f:
+            f.write(data)
+        stream = ExternalDecompressingReadStream(StringIO(compressed.getvalue()),
+                                                 ['gzip', '-d', '-c'])
+        eq_(stream.read(10), data[:10])
+        stream.close()
+
+def gzip_file(fileobj):
+    import gzip
+    return gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+def test_tampered_tarball_external_decompressor():
+    from ..source_cache import TarGzHandler
+    if _find_program('gzip') is None:
+        raise SkipTest('gzip not available')
+    with external_decompressor(TarGzHandler, ['gzip', '-d', '-c'], (0, 2)):
+        test_tampered_tarball_leaves_nothing_behind()
+
+def test_decompression_benchmark():
+    # Compares unpacking with the parallel decompressors (where available)
+    # against the pure Python fallback
+    from .. import source_cache
+    for handler_cls in [source_cache.TarGzHandler, source_cache.TarBz2Handler,
+                        source_cache.TarXzHandler]:
+        yield check_decompression_speed, handler_cls
+
+def check_decompression_speed(handler_cls):
+    import tarfile
+    import time
+    from .. import source_cache
+    if handler_cls().get_external_decompressor() is None:
+        raise SkipTest('no parallel decompressor for %s' % handler_cls.type)
+    try:
+        handler_cls().decompressor()
+        has_python_decompressor = True
+    except ImportError:
+        has_python_decompressor = False
+
+    with temp_dir() as d:
+        # Some compressible data
+        words = ['%x' % i for i in range(4096)]
+        with open(pjoin(d, 'data'), 'w') as f:
+            for i in range(300000):
+                f.write(words[(i * 7919) % len(words)] + ' ')
+        tarball = pjoin(d, 'bench.tar')
+        with closing(tarfile.open(tarball, 'w')) as tf:
+            for i in range(4):
+                tf.add(pjoin(d, 'data'), 'bench/data%d' % i)
+        compress = {'tar.gz': ['gzip'], 'tar.bz2': ['bzip2'], 'tar.xz': ['xz']}[handler_cls.type]
+        if _find_program(compress[0]) is None:
+            raise SkipTest('%s not available' % compress[0])
+        subprocess.check_call(compress + [tarball])
+        archive = tarball + '.' + handler_cls.type.split('.')[1]
+
+        with temp_source_cache() as sc:
+            key = sc.fetch_archive('file:' + archive)
+            timings = {}
+            backends = [True, False] if has_python_decompressor else [True]
+            for use_external in backends:
+                source_cache.use_external_decompressors = use_external
+                try:
+                    t0 = time.time()
+                    sc.unpack(key, pjoin(d, 'out-%s' % use_external))
+                    timings[use_external] = time.time() - t0
+                finally:
+                    source_cache.use_external_decompressors = True
+                with open(pjoin(d, 'out-%s' % use_external, 'data3')) as f:
+                    with open(pjoin(d, 'data')) as f2:
+                        assert f.read() == f2.read()
+    msg = '%s: %.3fs with %s' % (handler_cls.type, timings[True],
+                                 handler_cls().get_external_decompressor()[0][0])
+    if False in timings:
+        msg += ', %.3fs in Python (%.1fx speedup)' % (timings[False],
+                                                     timings[False] / timings[True])
+    logger.info(msg)
+
+def test_decompressing_read_stream_concatenated():
+    import gzip
+    from ..source_cache import DecompressingReadStream, TarGzHandler
+    buf = StringIO()
+    for part in ['first part, ', 'second part']:
+        member = StringIO()
+        with closing(gzip.GzipFile(fileobj=member, mode='wb')) as f:
+            f.write(part)
+        buf.write(member.getvalue())
+    buf.write('\0' * 10) # trailing garbage is ignored
+    handler = TarGzHandler()
+    stream = DecompressingReadStream(StringIO(buf.getvalue()), handler.decompressor, handler.magic)
+    eq_('first', stream.read(5))
+    eq_(' part, second part', stream.read())
+    eq_('', stream.read(5))
+
+def test_decompressing_read_stream_bz2():
+    import bz2
+    from ..source_cache import DecompressingReadStream, TarBz2Handler
+    handler = TarBz2Handler()
+    first, second = bz2.compress('first part, '), bz2.compress('second part')
+    for chunk_size in [1, 7, len(first), 16 * 1024]:
+        # trailing data after the last stream is ignored
+        for trailing in ['', '\0' * 100]:
+            stream = DecompressingReadStream(StringIO(first + second + trailing),
+                                             handler.decompressor, handler.magic)
+            stream.chunk_size = chunk_size
+            eq_('first part, second part', stream.read())
+
+def test_verification_index():
+    with temp_source_cache() as sc:
+        key = sc.fetch_archive('file:' + mock_tarball)
+        type, hash = key.split(':')
+        asc = ArchiveSourceCache(sc)
+        pack_filename = asc.get_pack_filename(type, hash)
+        # recorded on download
+        assert asc._is_verified(type, hash, os.stat(pack_filename))
+        with temp_dir() as d:
+            sc.unpack(key, d)
+            eq_(['0', '1'], sorted(os.listdir(d)))
+        # touching the file invalidates the record; the next unpack re-verifies
+        # and records it again
+        os.utime(pack_filename, (0, 0))
+        assert not asc._is_verified(type, hash, os.stat(pack_filename))
+        with temp_dir() as d:
+            sc.unpack(key, d)
+        assert asc._is_verified(type, hash, os.stat(pack_filename))
+
+def test_extracted_trees():
+    with temp_dir() as cache_dir:
+        sc = SourceCache(cache_dir, logger, extracted_max_bytes=10**6)
+        key = sc.fetch_archive('file:' + mock_tarball)
+        zip_key = sc.fetch_archive('file:' + mock_zipfile)
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'foo')
+        type, hash = key.split(':')
+        tree = pjoin(cache_dir, 'extracted', type, hash)
+        for i in range(2):
+            with temp_dir() as d:
+                sc.unpack(key, d)
+                assert os.path.isdir(tree)
+                eq_(['0', '1'], sorted(os.listdir(d)))
+                with open(pjoin(d, '0', 'README'), 'a') as f:
+                    f.write('modified in the build dir')
+                eq_(os.stat(pjoin(tree, '0', 'README')).st_mtime,
+                    os.stat(pjoin(d, '1', 'README')).st_mtime)
+            with open(pjoin(tree, '0', 'README')) as f:
+                eq_('file contents', f.read())
+        # git trees are kept per unpack mode
+        for mode in ['checkout', 'archive', 'checkout']:
+            sc.git_unpack = mode
+            with temp_dir() as d:
+                sc.unpack('git:' + mock_git_commit, d)
+                with open(pjoin(d, 'README')) as f:
+                    eq_('First revision', f.read())
+                eq_(mode == 'checkout', os.path.exists(pjoin(d, '.git')))
+            assert os.path.isdir(pjoin(cache_dir, 'extracted', 'git-' + mode, mock_git_commit))
+        sc.git_unpack = 'checkout'
+
+        # the trees count towards the size of their item in gc, and go with it
+        extracted = ExtractedTreeCache(sc)
+        sizes = dict(((type, name), nbytes) for _, nbytes, type, name
+                     in SourceCacheGC(sc).list_items())
+        tree_sizes = dict(((type, hash), size) for _, size, type, hash in extracted.list_trees())
+        assert sizes[('git', 'foo')] > (tree_sizes[('git-checkout', mock_git_commit)] +
+                                        tree_sizes[('git-archive', mock_git_commit)])
+        assert sizes[tuple(key.split(':'))] > tree_sizes[tuple(key.split(':'))]
+        sc.gc(keep_keys=[key, zip_key], max_bytes=0)
+        eq_([tuple(key.split(':'))], [(type, hash) for _, _, type, hash in extracted.list_trees()])
+        sc.fetch(mock_git_repo, 'git:' + mock_git_commit, 'foo')
+
+        # a small quota evicts the least recently used trees
+        sc.extracted_max_bytes = 1
+        with temp_dir() as d:
+            sc.unpack(zip_key, d)
+            eq_(['0', '1'], sorted(os.listdir(d)))
+        eq_(['zip'], [x for x in os.listdir(pjoin(cache_dir, 'extracted'))
+                      if os.listdir(pjoin(cache_dir, 'extracted', x))])
+        sc.delete_all()
+
+def test_resume_download():
+    with utils.http_server(mock_tarball_tmpdir) as (url, state):
+        url += '/archive.tar.gz'
+        size = os.path.getsize(mock_tarball)
+        sha = mock_tarball_hash.split(':')[1]
+        with temp_source_cache() as sc:
+            asc = ArchiveSourceCache(sc)
+            partial = asc._get_partial_filename(url, sha)
+            state.truncate_after = size // 2
+            with assert_raises(RemoteFetchError):
+                asc._download_archive(url, 'tar.gz', sha)
+            eq_(size // 2, os.path.getsize(partial))
+            asc._download_archive(url, 'tar.gz', sha)
+            eq_('bytes=%d-' % (size // 2), state.requests[-1][2])
+            assert not os.path.exists(partial)
+            assert asc.contains('tar.gz', sha)
+
+        # server ignoring the Range header
+        with temp_source_cache() as sc:
+            asc = ArchiveSourceCache(sc)
+            state.support_ranges = False
+            state.truncate_after = size // 2
+            with assert_raises(RemoteFetchError):
+                asc._download_archive(url, 'tar.gz', sha)
+            asc._download_archive(url, 'tar.gz', sha)
+            assert asc.contains('tar.gz', sha)
+
+        # a partial download that does not match the key is discarded
+        with temp_source_cache() as sc:
+            asc = ArchiveSourceCache(sc)
+            state.support_ranges = True
+            partial = asc._get_partial_filename(url, sha)
+            with open(partial, 'wb') as f:
+                f.write('garbage')
+            with assert_raises(SourceNotFoundError):
+                asc._download_archive(url, 'tar.gz', sha)
+            assert not os.path.exists(partial)
+            asc._download_archive(url, 'tar.gz', sha)
+            assert asc.contains('tar.gz', sha)
+
+def make_incompressible_tarball(d, nbytes):
+    import tarfile
+    with open(pjoin(d, 'data'), 'wb') as f:
+        f.write(os.urandom(nbytes))
+    tarball = pjoin(d, 'big.tar.gz')
+    with closing(tarfile.open(tarball, 'w:gz')) as tf:
+        tf.add(pjoin(d, 'data'), 'big/data')
+    with open(tarball, 'rb') as f:
+        return tarball, format_digest(hashlib.sha256(f.read()))
+
+@contextlib.contextmanager
+def segment_size(nbytes):
+    from ..source_cache import SegmentedDownload
+    old = SegmentedDownload.segment_size
+    SegmentedDownload.segment_size = nbytes
+    try:
+        yield
+    finally:
+        SegmentedDownload.segment_size = old
+
+def test_segmented_download():
+    from ..source_cache import SegmentedDownload
+    from ..hasher import HashingWriteStream
+    with temp_dir() as d:
+        tarball, sha = make_incompressible_tarball(d, 1000000)
+        with utils.http_server(d) as (url, state), segment_size(100 * 1024):
+            url += '/big.tar.gz'
+            with temp_source_cache() as sc:
+                asc = ArchiveSourceCache(sc)
+                asc.segmented_min_size = 0
+                eq_('tar.gz:' + sha, asc._download_archive(url, 'tar.gz', sha))
+                ranges = [r[2] for r in state.requests if r[2] is not None]
+                eq_(10, len(ranges))
+                assert 'bytes=102400-204799' in ranges
+                # one connection for the first request, and then one for each
+                # of the (persistent) connections used for the segments
+                assert len(state.clients) <= 1 + sc.download_connections
+                assert os.listdir(asc.packs_path) == ['tar.gz']
+
+            # a segment cut short is fetched again
+            del state.requests[:]
+            state.truncate_after = 1000
+            download = SegmentedDownload(url, os.path.getsize(tarball), pjoin(d, 'out'), logger)
+            hasher = hashlib.sha256()
+            download.run(HashingWriteStream(hasher, None))
+            eq_(sha, format_digest(hasher))
+            eq_(11, len(state.requests))
+
+            # servers not supporting ranges get a single stream
+            with temp_source_cache() as sc:
+                asc = ArchiveSourceCache(sc)
+                asc.segmented_min_size = 0
+                state.support_ranges = False
+                del state.requests[:]
+                eq_('tar.gz:' + sha, asc._download_archive(url, 'tar.gz', sha))
+                eq_(1, len(state.requests))
+
+            # small archives are not worth it
+            with temp_source_cache() as sc:
+                state.support_ranges = True
+                del state.requests[:]
+                eq_('tar.gz:' + sha, sc.fetch_archive(url))
+                eq_([None], [r[2] for r in state.requests])
+
+def test_segmented_download_fallback():
+    import socket
+    import urllib2
+    from ..source_cache import SegmentedDownload
+    with temp_dir() as d:
+        tarball, sha = make_incompressible_tarball(d, 1000000)
+        with utils.http_server(d) as (url, state), segment_size(100 * 1024):
+            url += '/big.tar.gz'
+            # segments after the first three fail for good; the download
+            # continues over a single connection from the complete part
+            old_fetch_segment = SegmentedDownload._fetch_segment
+            def fetch_segment(self, conn, f, start, end):
+                if start >= 3 * self.segment_size:
+                    raise socket.error('connection refused')
+                old_fetch_segment(self, conn, f, start, end)
+            SegmentedDownload._fetch_segment = fetch_segment
+            try:
+                with temp_source_cache() as sc:
+                    asc = ArchiveSourceCache(sc)
+                    asc.segmented_min_size = 0
+                    eq_('tar.gz:' + sha, asc._download_archive(url, 'tar.gz', sha))
+                    last_range = state.requests[-1][2]
+                    # what was complete in order is not fetched again
+                    if last_range is not None:
+                        offset = int(last_range[len('bytes='):-1])
+                        eq_(0, offset % (100 * 1024))
+                    eq_(['tar.gz'], os.listdir(asc.packs_path))
+            finally:
+                SegmentedDownload._fetch_segment = old_fetch_segment
+
+            # not through a proxy
+            with temp_source_cache() as sc:
+                asc = ArchiveSourceCache(sc)
+                asc.segmented_min_size = 0
+                stream = urllib2.urlopen(url)
+                try:
+                    assert asc._get_segmented_size(url, stream) is not None
+                    old_environ = dict(os.environ)
+                    os.environ['http_proxy'] = 'http://proxy.example.com:3128'
+                    os.environ.pop('no_proxy', None)
+                    try:
+                        assert asc._get_segmented_size(url, stream) is None
+                    finally:
+                        os.environ.clear()
+                        os.environ.update(old_environ)
+                    user_url = url.replace('http://', 'http://user:secret@')
+                    assert asc._get_segmented_size(user_url, stream) is None
+                finally:
+                    stream.close()
+
+def test_segmented_download_benchmark():
+    # Downloads from a server limiting the throughput of each connection
+    import time
+    with temp_dir() as d:
+        tarball, sha = make_incompressible_tarball(d, 2 * 1024 * 1024)
+        timings = {}
+        with utils.http_server(d) as (url, state), segment_size(256 * 1024):
+            state.throttle = 4 * 1024 * 1024
+            for connections in [1, 4]:
+                with temp_source_cache() as sc:
+                    sc.download_connections = connections
+                    asc = ArchiveSourceCache(sc)
+                    asc.segmented_min_size = 0
+                    t0 = time.time()
+                    asc._download_archive(url + '/big.tar.gz', 'tar.gz', sha)
+                    timings[connections] = time.time() - t0
+    logger.info('Throttled download: %.3fs over one connection, %.3fs over 4 (%.1fx speedup)' %
+                (timings[1], timings[4], timings[1] / timings[4]))
+    assert timings[4] < timings[1]
+
+def test_concurrent_fetch_downloads_once():
+    with utils.http_server(mock_tarball_tmpdir) as (url, state):
+        url += '/archive.tar.gz'
+        state.delay = 0.3
+        with temp_source_cache() as sc:
+            pids = []
+            for i in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        sc.show_progress = False
+                        sc.fetch(url, mock_tarball_hash)
+                        status = 0
+                    finally:
+                        os._exit(status)
+                pids.append(pid)
+            for pid in pids:
+                eq_(os.waitpid(pid, 0)[1], 0)
+            eq_([r for r in state.requests if r[0] == 'GET'],
+                [('GET', '/archive.tar.gz', None)])
+            assert ArchiveSourceCache(sc).contains(*mock_tarball_hash.split(':'))
+            eq_(os.listdir(pjoin(sc.cache_path, 'locks')), [])
+
+def test_mirror_selection_and_stats():
+    from ..source_cache import MirrorStats
+    from ..cache import DiskCache
+    sha = mock_tarball_hash.split(':')[1]
+    with temp_dir() as mirror_with, temp_dir() as mirror_without, temp_dir() as cache_dir:
+        destdir = pjoin(mirror_with, 'packs', 'tar.gz')
+        os.makedirs(destdir)
+        shutil.copy(mock_tarball, pjoin(destdir, sha))
+        with utils.http_server(mirror_with) as (url_with, state_with):
+            with utils.http_server(mirror_without) as (url_without, state_without):
+                dead = 'http://127.0.0.1:1'
+                cache = DiskCache(cache_dir)
+                for i in range(2):
+                    with temp_source_cache() as sc:
+                        sc.mirrors = [dead, url_without, url_with]
+                        sc.cache = cache
+                        sc.fetch('http://nonexisting.com', mock_tarball_hash)
+                        assert ArchiveSourceCache(sc).contains('tar.gz', sha)
+                # the mirror without the pack was only probed
+                eq_(['HEAD', 'HEAD'], [r[0] for r in state_without.requests])
+                eq_(['HEAD', 'GET', 'HEAD', 'GET'], [r[0] for r in state_with.requests])
+
+                stats = MirrorStats(DiskCache(cache_dir))
+                eq_(2, stats.get(dead)['failures'])
+                assert stats.is_benched(dead)
+                assert not stats.is_benched(url_with)
+                assert stats.get(url_with)['throughput'] > 0
+                assert stats.expected_seconds(url_with) < stats.expected_seconds(dead)
+                # benching expires
+                assert not stats.is_benched(dead, now=stats.get(dead)['last_failure'] + 61)
+
+                # updates by others sharing the cache are not lost
+                other = MirrorStats(DiskCache(cache_dir))
+                eq_(2, other.get(dead)['attempts'])
+                stats.record_failure(dead)
+                other.record_failure(dead)
+                eq_(4, MirrorStats(DiskCache(cache_dir)).get(dead)['attempts'])
@@ -0,0 +1,92 @@
+import os
+import shutil
+import urllib2
+import contextlib
+from os.path import join as pjoin
+
+from nose.tools import eq_
+
+from ..source_cache import SourceCache, ArchiveSourceCache
+from ..source_server import SourceCacheServer
+from .utils import temp_dir, logger, assert_raises
+from . import utils
+
+
+@contextlib.contextmanager
+def serving(source_cache, **kw):
+    server = SourceCacheServer(source_cache, '127.0.0.1', 0, **kw)
+    server.start()
+    try:
+        yield server.url
+    finally:
+        server.shutdown()
+
+def get(url, range=None, method=None):
+    request = urllib2.Request(url)
+    if range is not None:
+        request.add_header('Range', range)
+    if method is not None:
+        request.get_method = lambda: method
+    response = urllib2.urlopen(request)
+    try:
+        return response.getcode(), response.info(), response.read()
+    finally:
+        response.close()
+
+def test_serve_sources():
+    tmpdir, tarball, key = utils.make_temporary_tarball([('a/README', 'file contents')])
+    try:
+        with open(tarball, 'rb') as f:
+            data = f.read()
+        type, hash = key.split(':')
+        with temp_dir() as served_dir, temp_dir() as client_dir:
+            served = SourceCache(served_dir, logger)
+            served.fetch_archive('file:' + tarball)
+            files_key = served.put({'foo': 'bar'})
+            with serving(served) as url:
+                code, info, body = get('%s/packs/%s/%s' % (url, type, hash))
+                eq_((200, data), (code, body))
+                eq_('bytes', info['Accept-Ranges'])
+
+                code, info, body = get('%s/packs/%s/%s' % (url, type, hash), range='bytes=10-')
+                eq_((206, data[10:]), (code, body))
+                eq_('bytes 10-%d/%d' % (len(data) - 1, len(data)), info['Content-Range'])
+                code, info, body = get('%s/packs/%s/%s' % (url, type, hash), range='bytes=-5')
+                eq_((206, data[-5:]), (code, body))
+                code, info, body = get('%s/packs/%s/%s' % (url, type, hash), method='HEAD')
+                eq_((200, str(len(data)), ''), (code, info['Content-Length'], body))
+
+                with assert_raises(urllib2.HTTPError):
+                    get('%s/packs/%s/%s' % (url, type, hash), range='bytes=%d-' % len(data))
+                for path in ['/packs/tar.gz/nonexisting', '/packs/../../etc/passwd', '/foo']:
+                    with assert_raises(urllib2.HTTPError):
+                        get(url + path)
+                eq_(200, get('%s/files/%s' % (url, files_key.split(':')[1]))[0])
+
+                # used as a mirror
+                client = SourceCache(client_dir, logger, mirrors=[url])
+                client.fetch('http://nonexisting.com/foo.tar.gz', key)
+                assert ArchiveSourceCache(client).contains(type, hash)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_serve_sources_read_through():
+    tmpdir, tarball, key = utils.make_temporary_tarball([('a/README', 'file contents')])
+    try:
+        type, hash = key.split(':')
+        with temp_dir() as upstream_dir, temp_dir() as served_dir:
+            os.makedirs(pjoin(upstream_dir, 'packs', type))
+            shutil.copy(tarball, pjoin(upstream_dir, 'packs', type, hash))
+            with utils.http_server(upstream_dir) as (upstream_url, state):
+                served = SourceCache(served_dir, logger, mirrors=[upstream_url])
+                with serving(served) as url:
+                    with assert_raises(urllib2.HTTPError):
+                        get('%s/packs/%s/%s' % (url, type, hash))
+                with serving(served, read_through=True) as url:
+                    for i in range(2):
+                        code, info, body = get('%s/packs/%s/%s' % (url, type, hash))
+                        eq_(200, code)
+                eq_(1, len([r for r in state.requests if r[0] == 'GET']))
+                assert ArchiveSourceCache(served).contains(type, hash)
+    finally:
+        shutil.rmtree(tmpdir)
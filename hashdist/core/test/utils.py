@@ -1,4 +1,5 @@
 import os
+import time
 import sys
 import tempfile
 import shutil
@@ -185,3 +186,123 @@ def make_temporary_tarball(files):
     with file(archive_filename) as f:
         key = 'tar.gz:' + format_digest(hashlib.sha256(f.read()))
     return container_dir, archive_filename, key
+
+
+#
+# Local HTTP server
+#
+class MockHTTPServerState(object):
+    """Settings and request log of :func:`http_server`
+
+    Attributes
+    ----------
+
+    support_ranges : bool
+        Whether to honour ``Range`` headers (otherwise the full file is sent).
+
+    truncate_after : int or None
+        If set, the next response is cut off after this many bytes of the body,
+        and then reset to `None`.
+
+    delay : float
+        Seconds to wait before answering each request.
+
+    throttle : int or None
+        If set, the bytes per second sent over each connection.
+
+    requests : list of (method, path, range_header)
+
+    clients : set of (host, port)
+        The client end of each connection made.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.support_ranges = True
+        self.truncate_after = None
+        self.delay = 0
+        self.throttle = None
+        self.requests = []
+        self.clients = set()
+
+@contextlib.contextmanager
+def http_server(root):
+    """Serves the files in `root` over HTTP on localhost in a background thread
+
+    Yields ``(url, state)``; see :class:`MockHTTPServerState`.
+    """
+    import threading
+    import BaseHTTPServer
+    import SocketServer
+
+    state = MockHTTPServerState(root)
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.do_GET(send_body=False)
+
+        def do_GET(self, send_body=True):
+            range_header = self.headers.get('Range')
+            state.requests.append((self.command, self.path, range_header))
+            state.clients.add(self.client_address)
+            if state.delay:
+                time.sleep(state.delay)
+            filename = pjoin(state.root, *self.path.lstrip('/').split('/'))
+            if not os.path.isfile(filename):
+                self.send_error(404)
+                return
+            with open(filename, 'rb') as f:
+                data = f.read()
+            start, end = 0, len(data)
+            if range_header and state.support_ranges:
+                first, last = range_header[len('bytes='):].split('-')
+                start = int(first)
+                if last:
+                    end = min(int(last) + 1, end)
+                if start >= len(data):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Accept-Ranges', 'bytes' if state.support_ranges else 'none')
+            self.end_headers()
+            if send_body:
+                body = data[start:end]
+                if state.truncate_after is not None:
+                    body = body[:state.truncate_after]
+                    state.truncate_after = None
+                    self.close_connection = 1
+                if state.throttle:
+                    chunk_size = max(1, state.throttle // 20)
+                    for i in range(0, len(body), chunk_size):
+                        self.wfile.write(body[i:i + chunk_size])
+                        time.sleep(chunk_size / float(state.throttle))
+                else:
+                    self.wfile.write(body)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            # clients closing the connection early are expected
+            import errno
+            e = sys.exc_info()[1]
+            if getattr(e, 'errno', None) not in (errno.EPIPE, errno.ECONNRESET):
+                BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_address[1], state
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -23,7 +23,8 @@ config_schema = {
             "items": {
                 "type": "object",
                 "properties": {
-                    "dir": {"type": "string"}
+                    "dir": {"type": "string"},
+                    "optimise": {"type": "boolean"}
                 },
                 "required": ["dir"]
             },
@@ -38,11 +39,32 @@ config_schema = {
                     # programatically we require one or the other of these
                     "url": {"type": "string"},
                     "dir": {"type": "string"},
+                    "extracted_max_mb": {"type": "integer", "minimum": 0},
+                    "extracted_hardlink": {"type": "boolean"},
+                    "git_unpack": {"enum": ["checkout", "archive"]},
+                    "gc_max_mb": {"type": "integer", "minimum": 0},
+                    "gc_max_age_days": {"type": "number", "minimum": 0},
+                    "download_connections": {"type": "integer", "minimum": 1},
+                    "git_maintain_after": {"type": "integer", "minimum": 0},
+                    "read_only": {"type": "boolean"},
+                    "promote": {"type": "boolean"},
                 }
             },
             "minItems": 1
         },
 
+        "binary_caches": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    # programatically we require one or the other of these
+                    "url": {"type": "string"},
+                    "dir": {"type": "string"},
+                }
+            }
+        },
+
         "build_temp": {"type": "string"},
         "cache": {"type": "string"},
         "gc_roots": {"type": "string"},
@@ -78,6 +100,11 @@ def load_config_file(filename, logger):
             raise ValidationError(entry.start_mark, 'Exactly one of "url" and "dir" must be specified')
         if 'dir' in entry:
             entry['dir'] = _ensure_dir(_make_abs(basedir, entry['dir']), logger)
+    for entry in doc.get('binary_caches', []):
+        if sum(['url' in entry, 'dir' in entry]) != 1:
+            raise ValidationError(entry.start_mark, 'Exactly one of "url" and "dir" must be specified')
+        if 'dir' in entry:
+            entry['dir'] = _ensure_dir(_make_abs(basedir, entry['dir']), logger)
     for key in ['build_temp', 'cache', 'gc_roots']:
         doc[key] = _ensure_dir(_make_abs(basedir, doc[key]), logger)
     return doc
@@ -1,10 +1,13 @@
+import sys
+import time
+import multiprocessing
 from pprint import pprint
 from . import package
 from . import utils
 from . import hook
 from . import hook_api
 from ..formats.marked_yaml import load_yaml_from_file
-from ..core import BuildSpec, ArtifactBuilder
+from ..core import BuildSpec, ArtifactBuilder, BuildFailedError
 from .utils import to_env_var
 from .exceptions import PackageError, ProfileError
 
@@ -143,6 +146,47 @@ class ProfileBuilder(object):
                 }
             })
 
+    def get_source_items(self, include_built=False):
+        """
+        Return ``[(url, key, repo_name)]`` for the ``sources`` clauses of all
+        packages that need to be built (or of all packages if `include_built`).
+        """
+        items = []
+        for pkgname in sorted(self._package_specs):
+            if pkgname in self._built and not include_built:
+                continue
+            for source_clause in self._package_specs[pkgname].doc.get('sources', []):
+                items.append((source_clause['url'], source_clause['key'], pkgname))
+        return items
+
+    def prefetch_sources(self, worker_count, include_built=False):
+        """
+        Download the missing sources of all packages that still need to be
+        built, `worker_count` at a time, and log a summary.
+
+        Failures are logged but not raised; :meth:`build` fetches (and
+        reports errors for) any sources that are still missing.
+
+        Returns the list of :class:`~hashdist.core.source_cache.FetchResult`.
+        """
+        items = self.get_source_items(include_built)
+        if len(items) == 0:
+            return []
+        results = self.source_cache.fetch_many(items, worker_count)
+        fetched = [r for r in results if not r.was_present]
+        if len(fetched) == 0:
+            return results
+        total_bytes = 0
+        for r in fetched:
+            nbytes = '-' if r.nbytes is None else '%.1fMB' % (r.nbytes / 1024.**2)
+            status = 'ok' if r.ok else 'FAILED: %s' % r.error
+            self.logger.info('%-20s %-45s %10s %7.1fs %s' % (r.repo_name, r.key, nbytes, r.seconds, status))
+            total_bytes += r.nbytes or 0
+        failed = [r for r in fetched if not r.ok]
+        self.logger.info('Fetched %d sources (%.1fMB), %d failed' % (
+            len(fetched) - len(failed), total_bytes / 1024.**2, len(failed)))
+        return results
+
     def build(self, pkgname, config, worker_count, keep_build='never', debug=False):
         self._package_specs[pkgname].fetch_sources(self.source_cache)
         extra_env = {'HASHDIST_CPU_COUNT': str(worker_count)}
@@ -150,6 +194,94 @@ class ProfileBuilder(object):
                                         keep_build=keep_build, debug=debug)
         self._built.add(pkgname)
 
+    def build_all(self, config, cpu_count, jobs=1, keep_build='never', debug=False,
+                  keep_going=False):
+        """
+        Build all packages that are not built yet, `jobs` at a time.
+
+        Each package is built as soon as its build dependencies are. With
+        ``jobs > 1`` builds run in child processes (logging and hooks rely
+        on global state), and the `cpu_count` cores are split between
+        them: each build gets an even share of the cores not used by the
+        builds already running, so that a build running alone gets all of
+        them.
+
+        When a build fails, no further builds are started, but those
+        running are waited for; with `keep_going`, everything that does
+        not depend on a failed package is built first. Raises
+        :class:`~hashdist.core.BuildFailedError` naming the failed
+        packages; with ``jobs == 1`` (and no `keep_going`) the exception
+        of the build is raised as is. `debug` implies ``jobs == 1``.
+        """
+        if debug:
+            jobs = 1
+        failed = []
+        running = {}  # { pkgname : (process, cpus) }
+        while True:
+            if failed and not keep_going:
+                ready = []
+            else:
+                ready = sorted(name for name in self.get_ready_list()
+                               if name not in self._in_progress and name not in failed)
+            built_inline = False
+            while ready and len(running) < jobs:
+                free = cpu_count - sum(cpus for process, cpus in running.values())
+                cpus = max(1, free // min(jobs - len(running), len(ready)))
+                pkgname = ready.pop(0)
+                if jobs == 1:
+                    try:
+                        self.build(pkgname, config, cpus, keep_build, debug)
+                    except Exception, e:
+                        if not keep_going:
+                            raise
+                        self.logger.error('Building %s failed: %s' % (pkgname, e))
+                        failed.append(pkgname)
+                    built_inline = True
+                    break # dependants may be ready now
+                process = multiprocessing.Process(target=self._build_in_child,
+                                                  args=(pkgname, config, cpus, keep_build))
+                process.start()
+                self._in_progress.add(pkgname)
+                running[pkgname] = (process, cpus)
+            if not running:
+                if built_inline:
+                    continue
+                break
+            finished = self._wait_for_any(running)
+            for pkgname in finished:
+                process, cpus = running.pop(pkgname)
+                self._in_progress.discard(pkgname)
+                if process.exitcode == 0:
+                    self._built.add(pkgname)
+                else:
+                    self.logger.error('Building %s failed' % pkgname)
+                    failed.append(pkgname)
+        if failed:
+            not_built = sorted(set(self._package_specs) - self._built - set(failed))
+            if not_built:
+                self.logger.error('Not built as they depend on failed packages: %s'
+                                  % ', '.join(not_built))
+            raise BuildFailedError('Failed to build: %s' % ', '.join(failed), None)
+
+    def _build_in_child(self, pkgname, config, cpus, keep_build):
+        try:
+            self.build(pkgname, config, cpus, keep_build)
+        except Exception, e:
+            self.logger.error('Building %s failed: %s' % (pkgname, e))
+            sys.exit(1)
+
+    def _wait_for_any(self, running, poll_interval=0.1):
+        # multiprocessing can't wait for one of several processes in
+        # Python 2, so poll
+        while True:
+            finished = [pkgname for pkgname, (process, cpus) in running.items()
+                        if not process.is_alive()]
+            if finished:
+                for pkgname in finished:
+                    running[pkgname][0].join()
+                return sorted(finished)
+            time.sleep(poll_interval)
+
     def build_profile(self, config):
         profile_build_spec = self.get_profile_build_spec()
         return self.build_store.ensure_present(profile_build_spec, config)
@@ -143,15 +143,14 @@ class PackageSpec(object):
         The key associated to the files in the source cache.
         """
         build_script = self.assemble_build_script(ctx)
-        files = {}
+        paths = {}
         for to_name, from_name in ctx._bundled_files.iteritems():
             p = profile.find_package_file(self.name, from_name)
             if p is None:
                 raise ProfileError(from_name, 'file "%s" not found' % from_name)
-            with open(profile.resolve(p)) as f:
-                files['_hashdist/' + to_name] = f.read()
-        files['_hashdist/build.sh'] = build_script
-        return source_cache.put(files)
+            paths['_hashdist/' + to_name] = profile.resolve(p)
+        files = {'_hashdist/build.sh': build_script}
+        return source_cache.put(files, paths)
 
     def assemble_link_dsl(self, target, link_type='relative'):
         """
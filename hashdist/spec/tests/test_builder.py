@@ -6,7 +6,7 @@ import subprocess
 from os.path import join as pjoin
 from nose.tools import eq_, ok_
 
-from ...core import SourceCache
+from ...core import SourceCache, BuildFailedError
 from ...core.test.utils import *
 from ...core.test.test_build_store import fixture as build_store_fixture
 from .. import profile
@@ -94,6 +94,74 @@ def test_basic_build(tmpdir, sc, bldr, config):
     
     p = profile.load_profile(null_logger, profile.TemporarySourceCheckouts(None), pjoin(d, "profile.yaml"))
     pb = builder.ProfileBuilder(logger, sc, bldr, p)
+    results = pb.prefetch_sources(2)
+    eq_([(mock_tarball_hash, True)], [(r.key, r.ok) for r in results])
     pb.build('the_dependency', config, 1, "never", False)
     pb.build('copy_readme', config, 1, "never", False)
 
+
+
+@build_store_fixture()
+def test_build_all_parallel(tmpdir, sc, bldr, config):
+    d = pjoin(tmpdir, 'tmp', 'profile')
+    rendezvous = pjoin(tmpdir, 'tmp', 'rendezvous')
+    os.mkdir(rendezvous)
+    dump(pjoin(d, 'profile.yaml'), """\
+        package_dirs: [pkgs]
+        packages: {a:, b:, c:, failing:, after_failing:}
+        parameters:
+          BASH: /bin/bash
+    """)
+    # a and b can only both succeed if they are built at the same time
+    for name, other in [('a', 'b'), ('b', 'a')]:
+        dump(pjoin(d, 'pkgs', '%s.yaml' % name), """\
+            build_stages:
+              - name: build
+                handler: bash
+                bash: |
+                  echo $HASHDIST_CPU_COUNT > ${ARTIFACT}/cpus
+                  : > %(rendezvous)s/%(name)s
+                  for i in {1..300}; do [ -e %(rendezvous)s/%(other)s ] && break; /bin/sleep 0.1; done
+                  [ -e %(rendezvous)s/%(other)s ]
+        """ % dict(rendezvous=rendezvous, name=name, other=other))
+    dump(pjoin(d, 'pkgs', 'c.yaml'), """\
+        dependencies:
+          build: [a, b]
+        build_stages:
+          - name: build
+            handler: bash
+            bash: |
+              echo $HASHDIST_CPU_COUNT > ${ARTIFACT}/cpus
+    """)
+    dump(pjoin(d, 'pkgs', 'failing.yaml'), """\
+        build_stages:
+          - name: build
+            handler: bash
+            bash: |
+              exit 1
+    """)
+    dump(pjoin(d, 'pkgs', 'after_failing.yaml'), """\
+        dependencies:
+          build: [failing]
+    """)
+
+    p = profile.load_profile(null_logger, profile.TemporarySourceCheckouts(None), pjoin(d, "profile.yaml"))
+    pb = builder.ProfileBuilder(logger, sc, bldr, p)
+    with assert_raises(BuildFailedError):
+        pb.build_all(config, 4, jobs=2, keep_going=True)
+    eq_(set(['a', 'b', 'c']), pb._built)
+    eq_(set(), pb._in_progress)
+
+    def cpus(pkgname):
+        with open(pjoin(bldr.resolve(pb.get_build_spec(pkgname).artifact_id), 'cpus')) as f:
+            return int(f.read())
+    # the cores are split between the builds running at the same time
+    eq_((2, 2), (cpus('a'), cpus('b')))
+    assert cpus('c') in (2, 4)
+
+    # the rest is found built in the store
+    pb = builder.ProfileBuilder(logger, sc, bldr, p)
+    eq_(set(['a', 'b', 'c']), pb._built)
+    with assert_raises(BuildFailedError):
+        pb.build_all(config, 4, jobs=2)
+    eq_(set(['a', 'b', 'c']), pb._built)